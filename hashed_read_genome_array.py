@@ -1,7 +1,12 @@
 from plastid.genomics.genome_array import BAMGenomeArray
+from plastid.genomics.roitools import GenomicSegment
 import re
+import os
 import numpy
 import itertools
+import bisect
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 # Regular expressions for identifying the number of mismatches at the 5' end of a read
 NMIS_RE_PLUS = re.compile(r'^(0[ACGTN])*')
@@ -29,12 +34,214 @@ def read_length_nmis(read):
     return len(read.positions)-nmis, nmis
 
 
-def ReadKeyMapFactory(offset_dict, read_key_fun=lambda read: len(read.positions)):
+def read_length(read):
+    """Get the aligned length of a read. Default read_key_fun for ReadKeyMapFactory()
+
+    Parameters
+    ----------
+    read : :py:class:`pysam.AlignedSegment`
+        Read to assign a key
+
+    Returns
+    -------
+    int
+        Number of aligned (reference-consuming, non-gap) positions in the read
+    """
+    return len(read.positions)
+
+
+# Number of reads pulled into arrays at a time when mapping in batches
+MAP_BATCH_SIZE = 65536
+
+
+def _extract_batch(reads, read_key_fun, max_reads=MAP_BATCH_SIZE, strand='.', filters=()):
+    """Pull the information needed to map a batch of up to max_reads reads from an iterator into arrays, skipping reads that are not on
+    strand ('+' or '-'; '.' for either) or that fail any of filters. Fewer than max_reads reads are returned only if the iterator is
+    exhausted. Keys are computed here only for arbitrary read_key_funs; keys from read_length() and read_length_nmis() are derived later
+    from the returned arrays.
+
+    Returns
+    -------
+    is_reverse : numpy.ndarray<bool>
+        Whether each read is on the reverse strand
+
+    nblocks : numpy.ndarray<int>
+        Number of aligned blocks (see :py:meth:`pysam.AlignedSegment.get_blocks`) in each read
+
+    block_starts, block_lens : numpy.ndarray<int>
+        Reference start and length of every aligned block, concatenated across reads
+
+    nmis : numpy.ndarray<int> or None
+        Number of 5' mismatches in each read, only if read_key_fun is read_length_nmis()
+
+    keys : list or None
+        Key of each read, only if read_key_fun is neither read_length() nor read_length_nmis()
+    """
+    is_reverse = []
+    nblocks = []
+    blocks = []
+    nmis = [] if read_key_fun is read_length_nmis else None
+    keys = [] if read_key_fun not in (read_length, read_length_nmis) else None
+    # bind methods locally; this loop is the only per-read python code in the mapping
+    (is_reverse_append, nblocks_append, blocks_extend) = (is_reverse.append, nblocks.append, blocks.extend)
+    skip_reverse = {'+': True, '-': False}.get(strand)  # None if reads on both strands are kept
+    nreads = 0
+    for read in reads:
+        rev = read.is_reverse
+        if rev == skip_reverse or (filters and not all(my_filter(read) for my_filter in filters)):
+            continue
+        read_blocks = read.get_blocks()
+        is_reverse_append(rev)
+        nblocks_append(len(read_blocks))
+        blocks_extend(read_blocks)
+        if nmis is not None:
+            md = read.opt('MD')
+            if md[-1 if rev else 0] != '0':
+                nmis.append(0)  # no mismatch at the 5' end, so no need for the regular expression
+            else:
+                nmis.append(len((NMIS_RE_MINUS if rev else NMIS_RE_PLUS).search(md).group())/2)
+        elif keys is not None:
+            keys.append(read_key_fun(read))
+        nreads += 1
+        if nreads == max_reads:
+            break
+    blocks = numpy.array(blocks, dtype=numpy.int64).reshape((-1, 2))
+    return (numpy.array(is_reverse, dtype=numpy.bool), numpy.array(nblocks, dtype=numpy.int64), blocks[:, 0], blocks[:, 1] - blocks[:, 0],
+            None if nmis is None else numpy.array(nmis, dtype=numpy.int64), keys)
+
+
+def _key_table(read_keys, read_key_fun, max_key_val):
+    """Lookup table for vectorized conversion of read lengths (and 5' mismatches) to the index of the read key in read_keys, or -1 if absent"""
+    if read_key_fun is read_length_nmis:
+        table = numpy.full((max_key_val[0]+1, max_key_val[1]+1), -1, dtype=numpy.int64)
+        for (key_num, (rdlen, nmis)) in enumerate(read_keys):
+            if rdlen >= 0 and nmis >= 0:
+                table[rdlen, nmis] = key_num
+    else:
+        table = numpy.full(max_key_val+1, -1, dtype=numpy.int64)
+        for (key_num, rdlen) in enumerate(read_keys):
+            if rdlen >= 0:
+                table[rdlen] = key_num
+    return table
+
+
+def _read_lengths(nblocks, block_lens):
+    """Aligned length of each read in a batch extracted by _extract_batch()"""
+    return numpy.bincount(numpy.repeat(numpy.arange(len(nblocks)), nblocks), weights=block_lens, minlength=len(nblocks)).astype(numpy.int64)
+
+
+def _offset_table(offset_dict, read_keys, read_key_fun):
+    """Array of offsets in the order of read_keys, and the matching lookup table from _key_table()"""
+    offsets = numpy.array([offset_dict[key] for key in read_keys], dtype=numpy.int64)
+    if read_key_fun is read_length_nmis:
+        key_table = _key_table(read_keys, read_key_fun, (max([0]+[rdlen for (rdlen, nmis) in read_keys]),
+                                                         max([0]+[nmis for (rdlen, nmis) in read_keys])))
+    elif read_key_fun is read_length:
+        key_table = _key_table(read_keys, read_key_fun, max([0]+list(read_keys)))
+    else:
+        key_table = None
+    return offsets, key_table
+
+
+def _map_batch(batch, read_keys, offsets, read_key_fun, key_table):
+    """Vectorized P-site mapping of one batch of reads, as extracted by _extract_batch(). Returns the key index, P-site, and strand of every
+    read with a key in read_keys, along with the index of each such read within the batch."""
+    (is_reverse, nblocks, block_starts, block_lens, nmis, keys) = batch
+    cumlen = numpy.cumsum(block_lens)
+    rdlens = _read_lengths(nblocks, block_lens)
+    preceding_len = numpy.cumsum(rdlens) - rdlens  # aligned length of all reads before each read in the batch
+
+    if read_key_fun is read_length_nmis:
+        trimmed_lens = rdlens - nmis
+        valid = (trimmed_lens >= 0) & (trimmed_lens < key_table.shape[0]) & (nmis < key_table.shape[1])
+        key_nums = numpy.full(len(rdlens), -1, dtype=numpy.int64)
+        key_nums[valid] = key_table[trimmed_lens[valid], nmis[valid]]
+    elif read_key_fun is read_length:
+        valid = (rdlens < len(key_table))
+        key_nums = numpy.full(len(rdlens), -1, dtype=numpy.int64)
+        key_nums[valid] = key_table[rdlens[valid]]
+    else:
+        key_lookup = {key: key_num for (key_num, key) in enumerate(read_keys)}
+        key_nums = numpy.array([key_lookup.get(key, -1) for key in keys], dtype=numpy.int64)
+
+    mapped = numpy.flatnonzero(key_nums >= 0)
+    key_nums = key_nums[mapped]
+    is_reverse = is_reverse[mapped]
+    rdlens = rdlens[mapped]
+    read_offsets = offsets[key_nums]
+    # index into the aligned positions of each read, following python indexing rules exactly as read.positions[offset] would
+    pos_idx = numpy.where(is_reverse, -read_offsets - 1, read_offsets)
+    pos_idx[pos_idx < 0] += rdlens[pos_idx < 0]
+    if ((pos_idx < 0) | (pos_idx >= rdlens)).any():
+        raise IndexError('P-site offset lies beyond the end of a read')
+    aligned_idx = preceding_len[mapped] + pos_idx
+    block_idx = cumlen.searchsorted(aligned_idx, side='right')
+    p_sites = block_starts[block_idx] + aligned_idx - (cumlen[block_idx] - block_lens[block_idx])
+    return key_nums, p_sites, is_reverse, mapped
+
+
+def map_psites(reads, offset_dict, read_key_fun=read_length, read_keys=None, strand='.', filters=()):
+    """Identify the genomic P-site of each of a collection of reads, without restricting to any region. Reads are mapped at an offset from
+    their 5' ends exactly as by mapping functions generated by ReadKeyMapFactory(). Reads are pulled into arrays and mapped in batches,
+    and keys are computed without calling read_key_fun on each read if read_key_fun is read_length() or read_length_nmis().
+
+    Parameters
+    ----------
+    reads : iterable of :py:class:`pysam.AlignedSegment`
+        Reads to map
+
+    offset_dict : dict
+        Dictionary mapping read keys (from read_key_fun) to offsets from the 5' end of reads. Reads whose keys are not in offset_dict
+        are silently dropped
+
+    read_key_fun : function
+        Function to assign appropriate key for each read
+
+    read_keys : list, optional
+        Order in which to number the read keys (Default: offset_dict.keys())
+
+    strand : str, optional
+        If '+' or '-', only map reads on that strand (Default: '.', map reads on either strand)
+
+    filters : list of functions, optional
+        Only map reads for which every function in `filters` returns `True`
+
+    Returns
+    -------
+    numpy.ndarray<int>
+        Index into read_keys of the key of each mapped read
+
+    numpy.ndarray
+        Genomic P-site position of each mapped read
+
+    numpy.ndarray<bool>
+        Whether each mapped read is on the reverse strand
+    """
+    if read_keys is None:
+        read_keys = offset_dict.keys()
+    (offsets, key_table) = _offset_table(offset_dict, read_keys, read_key_fun)
+    reads = iter(reads)
+    res = []
+    while True:
+        batch = _extract_batch(reads, read_key_fun, MAP_BATCH_SIZE, strand, filters)
+        if len(batch[0]) > 0:
+            res.append(_map_batch(batch, read_keys, offsets, read_key_fun, key_table)[:3])
+        if len(batch[0]) < MAP_BATCH_SIZE:
+            break
+    if not res:
+        return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.bool)
+    return tuple(numpy.concatenate(x) for x in zip(*res))
+
+
+def ReadKeyMapFactory(offset_dict, read_key_fun=read_length):
     """Returns a mapping function for HashedReadBAMGenomeNDArray. Reads are mapped
     at a specified offset from the 5' end of the alignment, which can vary with
     the value returned by read_key_fun (e.g. with position or sequence). This
     function is NOT compatible with BAMGenomeArray.
 
+    Reads are mapped in batches by map_psites(), and counts are accumulated with a
+    single call to numpy.bincount().
+
     Parameters
     ----------
     offset_dict : dict
@@ -71,35 +278,241 @@ def ReadKeyMapFactory(offset_dict, read_key_fun=lambda read: len(read.positions)
             self.read_key_fun
         """
 
+    read_keys = offset_dict.keys()
+
     def map_func(reads,seg):
-        # reads_out = []
-        count_array = {k: numpy.zeros(len(seg)) for k in offset_dict}
-        for read in reads:
-            read_key = read_key_fun(read)
-            if read_key in offset_dict:
-                offset = offset_dict[read_key]
-                if not read.is_reverse:
-                    p_site = read.positions[offset]
-                else:
-                    p_site = read.positions[-offset - 1]
-
-                if p_site >= seg.start and p_site < seg.end:
-                    # reads_out.append(read)
-                    count_array[read_key][p_site - seg.start] += 1
-        return count_array
-        # return reads_out, count_array
-    map_func.read_keys = offset_dict.keys()
+        (key_nums, p_sites, _) = map_psites(reads, offset_dict, read_key_fun, read_keys)
+        in_seg = (p_sites >= seg.start) & (p_sites < seg.end)
+        count_array = numpy.bincount(key_nums[in_seg]*len(seg) + p_sites[in_seg] - seg.start,
+                                     minlength=len(read_keys)*len(seg)).astype(numpy.float64).reshape((len(read_keys), len(seg)))
+        return dict(zip(read_keys, count_array))
+    map_func.read_keys = read_keys
     map_func.read_key_fun = read_key_fun
+    map_func.offset_dict = offset_dict
     map_func.__doc__ = docstring
     return map_func
 
 
+def count_read_keys(reads, read_key_fun=read_length, filters=()):
+    """Count the reads in a collection with each read key, without mapping them. Keys are computed in batches as by map_psites().
+
+    Parameters
+    ----------
+    reads : iterable of :py:class:`pysam.AlignedSegment`
+        Reads to count
+
+    read_key_fun : function
+        Function to assign appropriate key for each read
+
+    filters : list of functions, optional
+        Only count reads for which every function in `filters` returns `True`
+
+    Returns
+    -------
+    dict
+        Number of reads with each key observed
+    """
+    reads = iter(reads)
+    totals = {}
+    while True:
+        (_, nblocks, _, block_lens, nmis, keys) = _extract_batch(reads, read_key_fun, MAP_BATCH_SIZE, '.', filters)
+        if read_key_fun is read_length_nmis:
+            (uniq_keys, counts) = numpy.unique(numpy.column_stack((_read_lengths(nblocks, block_lens) - nmis, nmis)), axis=0, return_counts=True)
+            batch_totals = {(int(rdlen), int(curr_nmis)): count for ((rdlen, curr_nmis), count) in zip(uniq_keys, counts)}
+        elif read_key_fun is read_length:
+            counts = numpy.bincount(_read_lengths(nblocks, block_lens))
+            batch_totals = {int(rdlen): counts[rdlen] for rdlen in numpy.flatnonzero(counts)}
+        else:
+            batch_totals = {}
+            for key in keys:
+                batch_totals[key] = batch_totals.get(key, 0) + 1
+        for (key, count) in batch_totals.iteritems():
+            totals[key] = totals.get(key, 0) + int(count)
+        if len(nblocks) < MAP_BATCH_SIZE:
+            break
+    return totals
+
+
+def key_totals_path(bamfile, read_key_fun):
+    """Location of the file of per-key read totals for a BAM file, as saved by HashedReadBAMGenomeArray.hashed_sum()
+
+    Parameters
+    ----------
+    bamfile : str
+        Path to the BAM file
+
+    read_key_fun : function
+        read_length() or read_length_nmis()
+
+    Returns
+    -------
+    str
+        Path to the totals file, e.g. /path/to/myfile.read_length_nmis.totals for /path/to/myfile.bam
+    """
+    return '%s.%s.totals' % (os.path.splitext(bamfile)[0], read_key_fun.__name__)
+
+
+def _load_key_totals(totalsfile):
+    """Read per-key read totals, saved by _save_key_totals(), as a dict"""
+    totals = {}
+    with open(totalsfile, 'rU') as infile:
+        for line in infile:
+            ls = [int(x) for x in line.strip().split()]
+            totals[ls[0] if len(ls) == 2 else tuple(ls[:-1])] = ls[-1]
+    return totals
+
+
+def _save_key_totals(totalsfile, totals):
+    """Save per-key read totals, writing to a temporary file first so that concurrent readers never see a partial file. Failure to write
+    (e.g. to a read-only directory) is not an error, as the totals can always be recounted."""
+    tmpfile = '%s.%d.tmp' % (totalsfile, os.getpid())
+    try:
+        with open(tmpfile, 'w') as outfile:
+            for key in sorted(totals):
+                outfile.write('\t'.join(str(x) for x in (key if isinstance(key, tuple) else (key,)) + (totals[key],)) + '\n')
+        os.rename(tmpfile, totalsfile)
+    except (IOError, OSError):
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+
+def _concat_psites(res):
+    """Concatenate a list of (key_nums, p_sites, weights) tuples, as returned by get_hashed_psites()"""
+    if not res:
+        return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0)
+    return tuple(numpy.concatenate(x) for x in zip(*res))
+
+
+# Thread pools for fetching from several BAM files at once, by process and number of threads (pools cannot be shared across a fork)
+_FETCH_POOLS = {}
+
+
+def _fetch_pool(nthreads):
+    """Thread pool with nthreads threads, created once per process"""
+    key = (os.getpid(), nthreads)
+    if key not in _FETCH_POOLS:
+        _FETCH_POOLS[key] = ThreadPool(nthreads)
+    return _FETCH_POOLS[key]
+
+
+class RegionCountCache(object):
+    """Memory-bounded, least-recently-used cache of the P-sites mapped within regions, which can be shared by several
+    HashedReadBAMGenomeArrays (e.g. across passes over the same transcripts in one process). Entries are keyed by (chrom, strand, start,
+    end, mapping identity), and cached regions with the same chrom, strand, and mapping identity never overlap: a region that is only
+    partly cached is served by slicing the cached regions it overlaps, and only the gaps between them need to be mapped (and are then
+    cached in turn). Entries are evicted least recently used first once their arrays exceed the byte budget. Cached arrays must not be
+    modified.
+    """
+
+    def __init__(self, max_bytes):
+        """Create RegionCountCache
+
+        Parameters
+        ----------
+        max_bytes : int
+            Maximum total size of the cached arrays, in bytes
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0  # lookups served entirely from the cache
+        self.partial_hits = 0  # lookups served in part from the cache
+        self.misses = 0  # lookups not served from the cache at all
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (psites, nbytes), from least to most recently used
+        self._regions = {}  # (chrom, strand, mapping identity) -> sorted list of cached (start, end)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, chrom, strand, start, end, mapping_id):
+        """Find the cached parts of a region
+
+        Parameters
+        ----------
+        chrom, strand : str
+            Chromosome and strand of the region
+
+        start, end : int
+            Start and end of the region (0-based, half-open)
+
+        mapping_id : hashable
+            Identity of the reads and the rule by which they were mapped
+
+        Returns
+        -------
+        list
+            (key_nums, p_sites, weights) for the P-sites within each cached part of the region, as views of the cached arrays
+
+        list
+            (start, end) of each part of the region that is not cached
+        """
+        regions = self._regions.get((chrom, strand, mapping_id), [])
+        i = bisect.bisect_left(regions, (start,))
+        if i > 0 and regions[i-1][1] > start:
+            i -= 1
+        cached = []
+        gaps = []
+        pos = start
+        while i < len(regions) and regions[i][0] < end:
+            (region_start, region_end) = regions[i]
+            if region_start > pos:
+                gaps.append((pos, region_start))
+            key = (chrom, strand, region_start, region_end, mapping_id)
+            entry = self._entries.pop(key)
+            self._entries[key] = entry  # reinsert as most recently used
+            (key_nums, p_sites, weights) = entry[0]
+            (lo, hi) = p_sites.searchsorted([max(pos, region_start), min(end, region_end)])
+            cached.append((key_nums[lo:hi], p_sites[lo:hi], weights[lo:hi]))
+            pos = region_end
+            i += 1
+        if pos < end:
+            gaps.append((pos, end))
+        if not gaps:
+            self.hits += 1
+        elif cached:
+            self.partial_hits += 1
+        else:
+            self.misses += 1
+        return cached, gaps
+
+    def put(self, chrom, strand, start, end, mapping_id, psites):
+        """Cache the P-sites mapped within a region, which must not overlap any region already cached for the same chrom, strand, and
+        mapping identity (e.g. a gap returned by lookup()). Least recently used entries are evicted as needed; regions larger than the
+        entire budget are not cached.
+
+        Parameters
+        ----------
+        chrom, strand, start, end, mapping_id
+            As for lookup()
+
+        psites : tuple
+            (key_nums, p_sites, weights) for the P-sites within the region, sorted by P-site position
+        """
+        nbytes = sum(x.nbytes for x in psites)
+        if nbytes > self.max_bytes:
+            return
+        while self.nbytes + nbytes > self.max_bytes:
+            ((old_chrom, old_strand, old_start, old_end, old_mapping_id), (_, old_nbytes)) = self._entries.popitem(last=False)
+            old_regions = self._regions[(old_chrom, old_strand, old_mapping_id)]
+            del old_regions[bisect.bisect_left(old_regions, (old_start, old_end))]
+            self.nbytes -= old_nbytes
+            self.evictions += 1
+        self._entries[(chrom, strand, start, end, mapping_id)] = (psites, nbytes)
+        bisect.insort(self._regions.setdefault((chrom, strand, mapping_id), []), (start, end))
+        self.nbytes += nbytes
+
+    def summary(self):
+        """One-line description of cache usage, for logging"""
+        return '%d hits, %d partial hits, %d misses, %d evictions; %.1f MB in %d regions' % \
+            (self.hits, self.partial_hits, self.misses, self.evictions, self.nbytes/1048576., len(self._entries))
+
+
 class HashedReadBAMGenomeArray(BAMGenomeArray):
     """Identical to a BAMGenomeArray, but keeps reads classified by a hash
     function (e.g. read length)
     """
 
-    def __init__(self,bamfiles,mapping):
+    def __init__(self,bamfiles,mapping,fetch_threads=1,region_cache=None):
         """Create HashedReadBAMGenomeArray
 
         Parameters
@@ -107,6 +520,8 @@ class HashedReadBAMGenomeArray(BAMGenomeArray):
         bamfile : list
             An list of open :py:class:`pysam.AlignmentFile` s. Note: the
             corresponding `BAM`_ files must be sorted and indexed by `samtools`_.
+            To also decompress each file on several threads, open them with
+            pysam's `threads` argument.
 
         mapping : func
             Mapping function that determines how each read alignment is mapped to a
@@ -115,32 +530,110 @@ class HashedReadBAMGenomeArray(BAMGenomeArray):
             at each position, keyed according to a supplied function. Must have a
             list of valid keys stored as mapping.read_keys.
             Typically generated using ReadKeyMapFactory().
+
+        fetch_threads : int, optional
+            Number of threads with which to fetch and map reads from several
+            BAM files concurrently (Default: 1)
+
+        region_cache : RegionCountCache, optional
+            Cache of mapped P-sites, which may be shared with other
+            HashedReadBAMGenomeArrays. Used only if `mapping` was generated
+            by ReadKeyMapFactory(). (Default: None, no caching)
         """
         BAMGenomeArray.__init__(self,bamfiles,mapping=mapping)
+        self.fetch_threads = fetch_threads
+        self.region_cache = region_cache
+        self._normalize_per_key = False
+        self._hashed_sum = None
 
-    def get_reads_and_hashed_counts(self,roi,roi_order=True):
-        """Returns reads covering a region, and a dict of count vectors mapping
-        reads to specific positions in the region, following rules specified by
-        self.map_fn
+    def set_normalize(self,value=True,per_key=False):
+        """Toggle normalization of reported values to reads per million
 
         Parameters
         ----------
-        roi : |GenomicSegment|
-            Region of interest
+        value : bool
+            If `True`, all values fetched will be normalized to reads per
+            million mapped in the dataset (see :meth:`BAMGenomeArray.sum`).
+            If `False`, all values will not be normalized.
+
+        per_key : bool, optional
+            If `True`, normalize the counts for each read key instead to reads
+            per million with that key (see hashed_sum()). (Default: `False`)
+        """
+        BAMGenomeArray.set_normalize(self,value)
+        self._normalize_per_key = per_key
 
+    def reset_sum(self):
+        """Reset the sum to the total number of mapped reads in the BAM
+        indexes (see :meth:`BAMGenomeArray.reset_sum`), and clear per-key
+        totals, which will be recounted by hashed_sum() when next needed"""
+        BAMGenomeArray.reset_sum(self)
+        self._hashed_sum = None
+
+    def add_filter(self,name,func):
+        """Apply a function to filter reads retrieved from regions before
+        mapping and counting (see :meth:`BAMGenomeArray.add_filter`)"""
+        BAMGenomeArray.add_filter(self,name,func)
+        self._hashed_sum = None
+
+    def remove_filter(self,name):
+        """Remove a filter (see :meth:`BAMGenomeArray.remove_filter`)"""
+        self._hashed_sum = None
+        return BAMGenomeArray.remove_filter(self,name)
+
+    def hashed_sum(self):
+        """Returns the total number of reads with each read key, summed over
+        all BAM files and after applying any filters. Totals are counted
+        once, by a single pass through each BAM file. If no filters have been
+        added and reads are keyed by read_length() or read_length_nmis(), the
+        totals for every key are also saved next to each BAM file (see
+        key_totals_path()), so that other processes and later runs need not
+        recount them. The sum of the totals may also be passed to
+        :meth:`BAMGenomeArray.set_sum`, to normalize to reads per million
+        with any key in use.
 
         Returns
         -------
-        list
-            List of reads (as :class:`pysam.AlignedSegment`)
-            covering region of interest
-
-        dict<numpy.ndarray>
-            Counts at each position of `roi`, keyed according to the map_fn
+        dict
+            Number of reads with each key in self.read_keys
         """
+        if self._hashed_sum is None:
+            totals = {}
+            for bamfile in self.bamfiles:
+                for (key, count) in self._bam_key_totals(bamfile).iteritems():
+                    totals[key] = totals.get(key, 0) + count
+            self._hashed_sum = {key: totals.get(key, 0) for key in self.read_keys}
+        return self._hashed_sum
+
+    def _bam_key_totals(self,bamfile):
+        """Number of reads in one BAM file with each key, loaded from or saved to the totals file next to the BAM where possible"""
+        read_key_fun = self.map_fn.read_key_fun
+        totalsfile = None
+        if read_key_fun in (read_length, read_length_nmis) and not self._filters:
+            totalsfile = key_totals_path(bamfile.filename, read_key_fun)
+            if os.path.isfile(totalsfile) and os.path.getmtime(totalsfile) >= os.path.getmtime(bamfile.filename):
+                return _load_key_totals(totalsfile)
+        totals = count_read_keys(bamfile.fetch(), read_key_fun, self._filters.values())
+        if totalsfile is not None:
+            _save_key_totals(totalsfile, totals)
+        return totals
+
+    def _norm_factors(self):
+        """Factor by which to multiply the counts for each key in self.read_keys, when normalizing"""
+        if self._normalize_per_key:
+            totals = numpy.array([self.hashed_sum()[key] for key in self.read_keys], dtype=numpy.float64)
+            return 1.0e6/numpy.maximum(totals, 1)  # keys without reads have no counts to normalize
+        return numpy.full(len(self.read_keys), 1.0e6/self.sum())
+
+    @property
+    def read_keys(self):
+        """Read keys of self.map_fn, in the order used by get_hashed_psites()"""
+        return self.map_fn.read_keys
+
+    def _fetch_reads(self,roi):
+        """Fetch reads overlapping a region from all BAM files, strand-matched
+        to `roi` and passed through any filters that have been added"""
         # fetch all reads
-        if roi.chrom not in self.chroms():
-            return [], {k: numpy.zeros(len(roi)) for k in self.map_fn.read_keys}
         reads = itertools.chain.from_iterable((X.fetch(reference=roi.chrom,
                                                        start=roi.start,
                                                        end=roi.end) for X in self.bamfiles))
@@ -155,13 +648,123 @@ class HashedReadBAMGenomeArray(BAMGenomeArray):
         # been added)
         for my_filter in self._filters.values():
             reads = filter(my_filter, reads)
+        return reads
+
+    def _map_region(self,roi):
+        """Fetch and map the reads from each BAM file for get_hashed_psites(), with a mapping function from ReadKeyMapFactory()"""
+        filters = self._filters.values()
+
+        def _map_bamfile(bamfile):
+            # strand and filters are applied as reads are pulled into batches
+            (key_nums, p_sites, _) = map_psites(bamfile.fetch(reference=roi.chrom, start=roi.start, end=roi.end), self.map_fn.offset_dict,
+                                                self.map_fn.read_key_fun, self.map_fn.read_keys, roi.strand, filters)
+            in_roi = (p_sites >= roi.start) & (p_sites < roi.end)
+            return key_nums[in_roi], p_sites[in_roi], numpy.ones(in_roi.sum())
+
+        if self.fetch_threads > 1 and len(self.bamfiles) > 1:
+            return _concat_psites(_fetch_pool(self.fetch_threads).map(_map_bamfile, self.bamfiles))
+        return _concat_psites(map(_map_bamfile, self.bamfiles))
+
+    def _mapping_id(self):
+        """Identity of the reads and mapping rule in use, to key a RegionCountCache shared with other genome arrays"""
+        return (tuple(bamfile.filename for bamfile in self.bamfiles), self.map_fn.read_key_fun,
+                tuple(sorted(self.map_fn.offset_dict.iteritems())), tuple(sorted(self._filters.keys())))
+
+    def _map_region_cached(self,roi):
+        """Same as _map_region(), but serving whatever parts of `roi` are in self.region_cache from there, and mapping and caching the rest"""
+        mapping_id = self._mapping_id()
+        (res, gaps) = self.region_cache.lookup(roi.chrom, roi.strand, roi.start, roi.end, mapping_id)
+        for (gap_start, gap_end) in gaps:
+            psites = self._map_region(GenomicSegment(roi.chrom, gap_start, gap_end, roi.strand))
+            order = psites[1].argsort(kind='mergesort')
+            psites = tuple(x[order] for x in psites)
+            self.region_cache.put(roi.chrom, roi.strand, gap_start, gap_end, mapping_id, psites)
+            res.append(psites)
+        return _concat_psites(res)
+
+    def get_hashed_psites(self,roi):
+        """Returns the P-sites of reads mapping within a region as flat arrays,
+        fetching reads only once from each BAM file. Unlike
+        get_reads_and_hashed_counts(), no array spanning the region is
+        allocated, so `roi` may cheaply span e.g. every exon of a transcript.
+        P-sites are served from self.region_cache, if any, where cached.
+
+        Parameters
+        ----------
+        roi : |GenomicSegment|
+            Region of interest
+
+        Returns
+        -------
+        numpy.ndarray<int>
+            Index into self.read_keys of the key of each P-site
+
+        numpy.ndarray<int>
+            Genomic position of each P-site, within `roi`
+
+        numpy.ndarray<float>
+            Number of reads (or reads per million, if normalized) at each P-site
+        """
+        if roi.chrom not in self.chroms():
+            return _concat_psites([])
+        if hasattr(self.map_fn, 'offset_dict'):
+            if self.region_cache is not None:
+                (key_nums, p_sites, weights) = self._map_region_cached(roi)
+            else:
+                (key_nums, p_sites, weights) = self._map_region(roi)
+        else:
+            # arbitrary mapping functions can only be applied to whole regions
+            count_dict = self.map_fn(self._fetch_reads(roi), roi)
+            count_array = numpy.array([count_dict[k] for k in self.map_fn.read_keys]).reshape((len(self.map_fn.read_keys), len(roi)))
+            (key_nums, pos) = count_array.nonzero()
+            (p_sites, weights) = (pos + roi.start, count_array[key_nums, pos])
+        if self._normalize:
+            weights = weights*self._norm_factors()[key_nums]
+        return key_nums, p_sites, weights
+
+    def get_reads_and_hashed_counts(self,roi,roi_order=True):
+        """Returns reads covering a region, and a dict of count vectors mapping
+        reads to specific positions in the region, following rules specified by
+        self.map_fn
+
+        Parameters
+        ----------
+        roi : |GenomicSegment|
+            Region of interest
+
+
+        Returns
+        -------
+        list
+            List of reads (as :class:`pysam.AlignedSegment`)
+            covering region of interest. Empty if self.map_fn was generated
+            by ReadKeyMapFactory(), as reads are then mapped in batches
+            without being kept
+
+        dict<numpy.ndarray>
+            Counts at each position of `roi`, keyed according to the map_fn
+        """
+        if roi.chrom not in self.chroms():
+            return [], {k: numpy.zeros(len(roi)) for k in self.map_fn.read_keys}
+        if hasattr(self.map_fn, 'offset_dict'):
+            # map reads in batches, without keeping them (see get_hashed_psites())
+            (key_nums, p_sites, weights) = self.get_hashed_psites(roi)
+            count_array = numpy.bincount(key_nums*len(roi) + p_sites - roi.start, weights=weights,
+                                         minlength=len(self.read_keys)*len(roi)).reshape((len(self.read_keys), len(roi)))
+            count_dict = dict(zip(self.read_keys, count_array))
+            if roi_order and roi.strand == "-":
+                count_dict = {k: v[::-1] for (k, v) in count_dict.iteritems()}
+            return [], count_dict
+
+        reads = self._fetch_reads(roi)
 
         # retrieve selected parts of regions
         count_dict = self.map_fn(reads, roi)
 
         # normalize to reads per million of normalization flag is set
         if self._normalize:
-            count_dict = {k: v*1.0e6/self.sum() for (k, v) in count_dict.iteritems()}
+            norm_factors = dict(zip(self.read_keys, self._norm_factors()))
+            count_dict = {k: v*norm_factors[k] for (k, v) in count_dict.iteritems()}
 
         if roi_order and roi.strand == "-":
             count_dict = {k: v[::-1] for (k, v) in count_dict.iteritems()}
@@ -201,9 +804,56 @@ class HashedReadBAMGenomeArray(BAMGenomeArray):
         return reads, sum(count_dict.values(), numpy.zeros(len(roi)))
 
 
+def get_hashed_count_array(segchain, hashedgnd, stranded=True):
+    """Returns counts covering a SegmentChain as a single array, in transcript
+    coordinates, with one row per read key of hashedgnd. P-sites are fetched
+    once across the span of the whole chain (rather than once per segment), and
+    placed into the array by their offset from the start of their segment.
+
+    Parameters
+    ----------
+    segchain : plastid.roitools.SegmentChain
+        Segment chain indicating positions from which to fetch counts
+
+    hashedgnd : HashedReadBAMGenomeArray, HashedCountCacheGenomeArray, or HashedEventIndexGenomeArray
+        GenomeArray from which to fetch hashed counts
+
+    stranded : bool, optional
+        If `True` and the SegmentChain is on the minus strand,
+        count order will be reversed relative to genome so that the
+        array positions march from the 5' to 3' end of the chain.
+        (Default: `True`)
+
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (len(hashedgnd.read_keys), segchain.get_length())
+
+    dict
+        Row of the array corresponding to each read key
+    """
+    read_keys = hashedgnd.read_keys
+    chain_len = segchain.get_length()
+    count_array = numpy.zeros(len(read_keys)*chain_len)
+    if chain_len > 0:
+        (key_nums, p_sites, weights) = hashedgnd.get_hashed_psites(segchain.spanning_segment)
+        seg_starts = numpy.array([seg.start for seg in segchain], dtype=numpy.int64)
+        seg_lens = numpy.array([len(seg) for seg in segchain], dtype=numpy.int64)
+        seg_idx = seg_starts.searchsorted(p_sites, side='right') - 1  # every P-site lies within the span, so never before the first segment
+        in_chain = (p_sites - seg_starts[seg_idx] < seg_lens[seg_idx])  # exclude P-sites in the gaps between segments
+        chain_pos = (numpy.cumsum(seg_lens) - seg_lens)[seg_idx[in_chain]] + p_sites[in_chain] - seg_starts[seg_idx[in_chain]]
+        count_array += numpy.bincount(key_nums[in_chain]*chain_len + chain_pos, weights=weights[in_chain], minlength=len(count_array))
+    count_array = count_array.reshape((len(read_keys), chain_len))
+    if stranded and segchain.strand == "-":
+        count_array = count_array[:, ::-1]
+    return count_array, {key: key_num for (key_num, key) in enumerate(read_keys)}
+
+
 def get_hashed_counts(segchain, hashedgnd, stranded=True):
     """Returns a dict of counts of IVCollection as a list of positions, in
-       transcript coordinates, keyed according to hashedgnd
+       transcript coordinates, keyed according to hashedgnd. See
+       get_hashed_count_array(), which returns the same counts as one array.
 
     Parameters
     ----------
@@ -222,15 +872,391 @@ def get_hashed_counts(segchain, hashedgnd, stranded=True):
 
     Returns
     -------
-    numpy.ndarray
-        Array of counts from `gnd` covering `self`
+    dict<numpy.ndarray>
+        Counts from `gnd` covering `self`, keyed by read key
     """
-    dcnt = {k: [] for k in hashedgnd.map_fn.read_keys}
-    for iv in segchain:
-        _, dtmp = hashedgnd.get_reads_and_hashed_counts(iv, roi_order=False)
-        for (k, v) in dcnt.iteritems():
-            v.extend(dtmp[k])
-    if stranded and segchain.strand == "-":
-        for v in dcnt.itervalues():
-            v.reverse()
-    return dcnt
+    (count_array, key_idx) = get_hashed_count_array(segchain, hashedgnd, stranded)
+    return {k: count_array[i] for (k, i) in key_idx.iteritems()}
+
+
+# File layout of a P-site count cache directory (see make_count_cache.py)
+CACHE_KEYFILE = 'keys.txt'
+CACHE_CHROMFILE = 'chroms.txt'
+CACHE_STRANDS = {'+': 'plus', '-': 'minus'}
+
+
+def count_cache_path(bamfile, subdir=os.path.curdir):
+    """Location of the P-site count cache for a BAM file, as written by make_count_cache.py
+
+    Parameters
+    ----------
+    bamfile : str
+        Path to the BAM file from which the cache is (or will be) built
+
+    subdir : str, optional
+        Directory holding the cache. Caches depend on the offsets in use, so they live alongside the offset file. (Default: current directory)
+
+    Returns
+    -------
+    str
+        Path to the cache directory, e.g. SUBDIR/myfile.psitecounts for /path/to/myfile.bam
+    """
+    return os.path.join(subdir, os.path.splitext(os.path.basename(bamfile))[0] + '.psitecounts')
+
+
+def count_cache_arrays(cachedir, chrom_idx, strand):
+    """Filenames of the position and count arrays for one chromosome and strand of a P-site count cache
+
+    Parameters
+    ----------
+    cachedir : str
+        Path to the cache directory
+
+    chrom_idx : int
+        Index of the chromosome in the cache's chromosome list
+
+    strand : str
+        '+' or '-'
+
+    Returns
+    -------
+    (str, str)
+        Filenames of the sorted position array and of the (n_positions, n_keys) count array
+    """
+    stem = os.path.join(cachedir, 'chrom%d_%s' % (chrom_idx, CACHE_STRANDS[strand]))
+    return stem + '_pos.npy', stem + '_counts.npy'
+
+
+class _PrecomputedHashedGenomeArray(object):
+    """Read-only replacement for a HashedReadBAMGenomeArray, backed by files precomputed from BAM files. Subclasses set self.read_keys,
+    self.map_fn, and self._chr_lengths, and implement get_hashed_psites() (see :meth:`HashedReadBAMGenomeArray.get_hashed_psites`).
+    """
+
+    def _read_chromfile(self, dirname):
+        """Read the chromosome manifest in dirname, recording chromosome lengths. Returns a dict mapping chromosome names to indices."""
+        chrom_idx = {}
+        with open(os.path.join(dirname, CACHE_CHROMFILE), 'rU') as infile:
+            for (i, line) in enumerate(infile):
+                (chrom, length) = line.strip().split()
+                chrom_idx[chrom] = i
+                self._chr_lengths[chrom] = max(self._chr_lengths.get(chrom, 0), int(length))
+        return chrom_idx
+
+    def chroms(self):
+        """Returns a sorted list of chromosomes present in any of the underlying files"""
+        return sorted(self._chr_lengths.keys())
+
+    def lengths(self):
+        """Returns a dictionary mapping chromosome names to lengths"""
+        return self._chr_lengths
+
+    def get_hashed_count_array(self, roi):
+        """Counts at each position of a region, as a single array
+
+        Parameters
+        ----------
+        roi : |GenomicSegment|
+            Region of interest
+
+        Returns
+        -------
+        numpy.ndarray
+            Array of shape (len(self.read_keys), len(roi)), in genomic (not stranded) order
+        """
+        (key_nums, p_sites, weights) = self.get_hashed_psites(roi)
+        return numpy.bincount(key_nums*len(roi) + p_sites - roi.start, weights=weights,
+                              minlength=len(self.read_keys)*len(roi)).reshape((len(self.read_keys), len(roi)))
+
+    def get_reads_and_hashed_counts(self, roi, roi_order=True):
+        """Drop-in replacement for :meth:`HashedReadBAMGenomeArray.get_reads_and_hashed_counts`. No reads are available from precomputed
+        files, so the list of reads is always empty.
+
+        Parameters
+        ----------
+        roi : |GenomicSegment|
+            Region of interest
+
+        roi_order : bool, optional
+            If `True` (default) and `roi` is on the minus strand, count vectors run 5' to 3' relative to `roi`
+
+        Returns
+        -------
+        list
+            Empty list
+
+        dict<numpy.ndarray>
+            Counts at each position of `roi`, keyed by read key
+        """
+        count_array = self.get_hashed_count_array(roi)
+        if roi_order and roi.strand == '-':
+            count_array = count_array[:, ::-1]
+        return [], dict(zip(self.read_keys, count_array))
+
+    def get_reads_and_counts(self, roi, roi_order=True):
+        """Drop-in replacement for :meth:`HashedReadBAMGenomeArray.get_reads_and_counts`, collapsing all read keys into one count vector"""
+        count_array = self.get_hashed_count_array(roi).sum(0)
+        if roi_order and roi.strand == '-':
+            count_array = count_array[::-1]
+        return [], count_array
+
+    def get(self, roi, roi_order=True):
+        """Count vector covering a |GenomicSegment|, as used by :meth:`SegmentChain.get_counts`"""
+        return self.get_reads_and_counts(roi, roi_order)[1]
+
+    def __getitem__(self, roi):
+        return self.get(roi, roi_order=True)
+
+    def close(self):
+        """Release loaded arrays"""
+        self._loaded = {}
+
+
+class HashedCountCacheGenomeArray(_PrecomputedHashedGenomeArray):
+    """Read-only replacement for a HashedReadBAMGenomeArray, backed by P-site count caches generated by make_count_cache.py. Counts are
+    stored sparsely (sorted positions with one row of counts per position), memory-mapped, and sliced by binary search, so no reads are
+    fetched or mapped. Multiple caches (e.g. from replicate BAM files) are summed, as are multiple BAM files in a BAMGenomeArray.
+    """
+
+    def __init__(self, cachedirs, offset_dict):
+        """Open HashedCountCacheGenomeArray
+
+        Parameters
+        ----------
+        cachedirs : list
+            Paths to cache directories generated by make_count_cache.py
+
+        offset_dict : dict
+            Dictionary mapping read keys to P-site offsets, as would be passed to ReadKeyMapFactory(). Must match the offsets with which
+            every cache was built.
+        """
+        self.cachedirs = cachedirs
+        self._chr_lengths = {}
+        self._chrom_idx = []
+        read_keys = None
+        for cachedir in cachedirs:
+            with open(os.path.join(cachedir, CACHE_KEYFILE), 'rU') as infile:
+                cache_offsets = [((int(ls[0]), int(ls[1])), int(ls[2])) for ls in [line.strip().split() for line in infile]]
+            if dict(cache_offsets) != offset_dict:
+                raise ValueError('Count cache %s was built with different offsets; rebuild it with make_count_cache.py' % cachedir)
+            curr_keys = [key for (key, offset) in cache_offsets]
+            if read_keys is None:
+                read_keys = curr_keys
+            elif curr_keys != read_keys:
+                raise ValueError('Count caches %s and %s list read keys in different orders' % (cachedirs[0], cachedir))
+            self._chrom_idx.append(self._read_chromfile(cachedir))
+        self.read_keys = read_keys
+        self.map_fn = ReadKeyMapFactory(offset_dict, read_length_nmis)  # the mapping rule with which the caches were built
+        self._loaded = {}  # lazily memory-map arrays as each (cache, chrom, strand) is first requested
+
+    def _get_arrays(self, cache_num, chrom, strand):
+        """Memory-mapped (positions, counts) arrays for one cache, chromosome, and strand, or None if that cache has no such chromosome"""
+        if (cache_num, chrom, strand) not in self._loaded:
+            if chrom in self._chrom_idx[cache_num]:
+                (posfile, countfile) = count_cache_arrays(self.cachedirs[cache_num], self._chrom_idx[cache_num][chrom], strand)
+                self._loaded[(cache_num, chrom, strand)] = (numpy.load(posfile, mmap_mode='r'), numpy.load(countfile, mmap_mode='r'))
+            else:
+                self._loaded[(cache_num, chrom, strand)] = None
+        return self._loaded[(cache_num, chrom, strand)]
+
+    def get_hashed_psites(self, roi):
+        """P-sites within a region as flat arrays of key indices, positions, and counts. See
+        :meth:`HashedReadBAMGenomeArray.get_hashed_psites`"""
+        res = []
+        for strand in (['+', '-'] if roi.strand == '.' else [roi.strand]):
+            for cache_num in xrange(len(self.cachedirs)):
+                arrays = self._get_arrays(cache_num, roi.chrom, strand)
+                if arrays is not None:
+                    (pos, counts) = arrays
+                    (lo, hi) = pos.searchsorted([roi.start, roi.end])
+                    counts = numpy.asarray(counts[lo:hi, :])
+                    (rows, key_nums) = counts.nonzero()
+                    res.append((key_nums, pos[lo:hi][rows], counts[rows, key_nums].astype(numpy.float64)))
+        return _concat_psites(res)
+
+
+def psite_index_path(bamfile):
+    """Location of the P-site event index for a BAM file, as written by make_psite_index.py. The index does not depend on offsets, so it is
+    kept next to the BAM file itself.
+
+    Parameters
+    ----------
+    bamfile : str
+        Path to the BAM file from which the index is (or will be) built
+
+    Returns
+    -------
+    str
+        Path to the index directory, e.g. /path/to/myfile.psiteindex for /path/to/myfile.bam
+    """
+    return os.path.splitext(bamfile)[0] + '.psiteindex'
+
+
+def psite_index_file(indexdir, chrom_idx, strand):
+    """Filename of the event table for one chromosome and strand of a P-site event index
+
+    Parameters
+    ----------
+    indexdir : str
+        Path to the index directory
+
+    chrom_idx : int
+        Index of the chromosome in the index's chromosome list
+
+    strand : str
+        '+' or '-'
+
+    Returns
+    -------
+    str
+        Filename of the compressed (.npz) event table
+    """
+    return os.path.join(indexdir, 'chrom%d_%s.npz' % (chrom_idx, CACHE_STRANDS[strand]))
+
+
+def _merge_blocks(nblocks, block_starts, block_lens):
+    """Merge the reference-contiguous blocks of each read (e.g. those separated only by an insertion), which does not change its aligned
+    positions. Returns new nblocks, block_starts, and block_lens."""
+    read_ids = numpy.repeat(numpy.arange(len(nblocks)), nblocks)
+    new_block = numpy.ones(len(block_starts), dtype=numpy.bool)
+    new_block[1:] = (read_ids[1:] != read_ids[:-1]) | (block_starts[1:] != block_starts[:-1] + block_lens[:-1])
+    merged_lens = numpy.bincount(numpy.cumsum(new_block) - 1, weights=block_lens, minlength=new_block.sum()).astype(numpy.int64)
+    return numpy.bincount(read_ids[new_block], minlength=len(nblocks)), block_starts[new_block], merged_lens
+
+
+def index_psite_events(reads):
+    """Collapse a collection of reads into P-site events: unique combinations of strand, alignment, and number of 5' mismatches, with the
+    number of reads sharing each. Events are independent of P-site offsets, which are applied only when the index is queried (see
+    HashedEventIndexGenomeArray).
+
+    Most reads align in a single block, and are fully described by their 5' end position (the first aligned position on the plus strand, or
+    the last on the minus strand), trimmed length, and number of 5' mismatches. Spliced reads additionally keep their aligned blocks.
+
+    Parameters
+    ----------
+    reads : iterable of :py:class:`pysam.AlignedSegment`
+        Reads to index
+
+    Returns
+    -------
+    dict<dict<numpy.ndarray>>
+        Event table for each strand ('+' and '-'), with columns 'pos5', 'rdlen', 'nmis', and 'count' for single-block reads (sorted by
+        'pos5') and the same columns prefixed by 'spliced_' for spliced reads, whose blocks are listed in the columns 'spliced_nblocks',
+        'spliced_block_starts', and 'spliced_block_lens'
+    """
+    reads = iter(reads)
+    unspliced = {'+': ([], []), '-': ([], [])}
+    spliced = {'+': {}, '-': {}}
+    while True:
+        (is_reverse, nblocks, block_starts, block_lens, nmis, _) = _extract_batch(reads, read_length_nmis)
+        if len(is_reverse) == 0:
+            break
+        (nblocks, block_starts, block_lens) = _merge_blocks(nblocks, block_starts, block_lens)
+        first_block = numpy.cumsum(nblocks) - nblocks
+        for (strand, on_strand) in [('+', ~is_reverse), ('-', is_reverse)]:
+            single = numpy.flatnonzero(on_strand & (nblocks == 1))
+            starts = block_starts[first_block[single]]
+            lens = block_lens[first_block[single]]
+            events = numpy.column_stack((starts + lens - 1 if strand == '-' else starts, lens - nmis[single], nmis[single]))
+            (events, counts) = numpy.unique(events, axis=0, return_counts=True)
+            unspliced[strand][0].append(events)
+            unspliced[strand][1].append(counts)
+            curr_spliced = spliced[strand]
+            for i in numpy.flatnonzero(on_strand & (nblocks > 1)):
+                blocks = slice(first_block[i], first_block[i]+nblocks[i])
+                event = (tuple(block_starts[blocks]), tuple(block_lens[blocks]), nmis[i])
+                curr_spliced[event] = curr_spliced.get(event, 0) + 1
+
+    res = {}
+    for strand in ('+', '-'):
+        if unspliced[strand][0]:
+            (events, event_idx) = numpy.unique(numpy.concatenate(unspliced[strand][0]), axis=0, return_inverse=True)
+            counts = numpy.bincount(event_idx, weights=numpy.concatenate(unspliced[strand][1]), minlength=len(events))
+        else:
+            (events, counts) = (numpy.zeros((0, 3), dtype=numpy.int64), numpy.zeros(0))
+        curr_spliced = sorted(((starts[-1] + lens[-1] - 1 if strand == '-' else starts[0]), starts, lens, curr_nmis, count)
+                              for ((starts, lens, curr_nmis), count) in spliced[strand].iteritems())
+        res[strand] = {'pos5': events[:, 0].astype(numpy.int64),
+                       'rdlen': events[:, 1].astype(numpy.int32),
+                       'nmis': events[:, 2].astype(numpy.int32),
+                       'count': counts.astype(numpy.uint32),
+                       'spliced_pos5': numpy.array([x[0] for x in curr_spliced], dtype=numpy.int64),
+                       'spliced_rdlen': numpy.array([sum(x[2]) - x[3] for x in curr_spliced], dtype=numpy.int32),
+                       'spliced_nmis': numpy.array([x[3] for x in curr_spliced], dtype=numpy.int32),
+                       'spliced_count': numpy.array([x[4] for x in curr_spliced], dtype=numpy.uint32),
+                       'spliced_nblocks': numpy.array([len(x[1]) for x in curr_spliced], dtype=numpy.int32),
+                       'spliced_block_starts': numpy.array([start for x in curr_spliced for start in x[1]], dtype=numpy.int64),
+                       'spliced_block_lens': numpy.array([blocklen for x in curr_spliced for blocklen in x[2]], dtype=numpy.int64)}
+    return res
+
+
+class HashedEventIndexGenomeArray(_PrecomputedHashedGenomeArray):
+    """Read-only replacement for a HashedReadBAMGenomeArray, backed by P-site event indexes generated by make_psite_index.py. Unlike count
+    caches, event indexes do not depend on P-site offsets: events near a region are found by binary search on their 5' end positions, and
+    mapped using the offsets supplied here, exactly as reads fetched from the BAM file would be. Multiple indexes (e.g. from replicate BAM
+    files) are summed, as are multiple BAM files in a BAMGenomeArray.
+    """
+
+    def __init__(self, indexdirs, offset_dict):
+        """Open HashedEventIndexGenomeArray
+
+        Parameters
+        ----------
+        indexdirs : list
+            Paths to index directories generated by make_psite_index.py
+
+        offset_dict : dict
+            Dictionary mapping read keys (trimmed read length, number of 5' mismatches) to P-site offsets, as would be passed to
+            ReadKeyMapFactory() with read_length_nmis()
+        """
+        self.indexdirs = indexdirs
+        self._chr_lengths = {}
+        self._chrom_idx = [self._read_chromfile(indexdir) for indexdir in indexdirs]
+        self.map_fn = ReadKeyMapFactory(offset_dict, read_length_nmis)
+        self.read_keys = self.map_fn.read_keys
+        (self._offsets, self._key_table) = _offset_table(offset_dict, self.read_keys, read_length_nmis)
+        self._loaded = {}  # lazily load event tables as each (index, chrom, strand) is first requested
+
+    def _get_events(self, index_num, chrom, strand):
+        """Event tables for one index, chromosome, and strand, as a list of (pos5, maxspan, nblocks, block_starts, block_offsets, block_lens,
+        nmis, count) for single-block and spliced events. Empty if that index has no such chromosome."""
+        if (index_num, chrom, strand) not in self._loaded:
+            groups = []
+            if chrom in self._chrom_idx[index_num]:
+                with numpy.load(psite_index_file(self.indexdirs[index_num], self._chrom_idx[index_num][chrom], strand)) as infile:
+                    events = {name: infile[name] for name in infile.files}
+                lens = events['rdlen'].astype(numpy.int64) + events['nmis']
+                groups.append((events['pos5'], lens.max() if len(lens) else 0, numpy.ones(len(lens), dtype=numpy.int64),
+                               events['pos5'] - lens + 1 if strand == '-' else events['pos5'], numpy.arange(len(lens)+1), lens,
+                               events['nmis'].astype(numpy.int64), events['count']))
+                block_offsets = numpy.concatenate(([0], numpy.cumsum(events['spliced_nblocks'])))
+                starts = events['spliced_block_starts']
+                ends = starts + events['spliced_block_lens']
+                spans = ends[block_offsets[1:]-1] - starts[block_offsets[:-1]]
+                groups.append((events['spliced_pos5'], spans.max() if len(spans) else 0, events['spliced_nblocks'].astype(numpy.int64), starts,
+                               block_offsets, events['spliced_block_lens'], events['spliced_nmis'].astype(numpy.int64),
+                               events['spliced_count']))
+            self._loaded[(index_num, chrom, strand)] = groups
+        return self._loaded[(index_num, chrom, strand)]
+
+    def get_hashed_psites(self, roi):
+        """P-sites within a region as flat arrays of key indices, positions, and counts. See
+        :meth:`HashedReadBAMGenomeArray.get_hashed_psites`"""
+        res = []
+        for strand in (['+', '-'] if roi.strand == '.' else [roi.strand]):
+            for index_num in xrange(len(self.indexdirs)):
+                for (pos5, maxspan, nblocks, block_starts, block_offsets, block_lens, nmis, counts) in \
+                        self._get_events(index_num, roi.chrom, strand):
+                    # P-sites lie within the alignment, which extends downstream from the 5' end by at most maxspan
+                    if strand == '+':
+                        (lo, hi) = pos5.searchsorted([roi.start - maxspan + 1, roi.end])
+                    else:
+                        (lo, hi) = pos5.searchsorted([roi.start, roi.end + maxspan - 1])
+                    if lo == hi:
+                        continue
+                    (blo, bhi) = (block_offsets[lo], block_offsets[hi])
+                    batch = (numpy.full(hi-lo, strand == '-', dtype=numpy.bool), nblocks[lo:hi], block_starts[blo:bhi], block_lens[blo:bhi],
+                             nmis[lo:hi], None)
+                    (key_nums, p_sites, _, mapped) = _map_batch(batch, self.read_keys, self._offsets, read_length_nmis, self._key_table)
+                    in_roi = (p_sites >= roi.start) & (p_sites < roi.end)
+                    res.append((key_nums[in_roi], p_sites[in_roi], counts[lo:hi][mapped[in_roi]].astype(numpy.float64)))
+        return _concat_psites(res)
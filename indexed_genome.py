@@ -0,0 +1,100 @@
+import os
+import pysam
+
+
+class _ChromSequence(object):
+    """Sequence of one chromosome in an IndexedGenome, fetched from disk only when sliced"""
+
+    def __init__(self, genome, chrom, length):
+        self._genome = genome
+        self._chrom = chrom
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, key):
+        """Fetch a slice of the chromosome sequence as a string (steps other than 1 are not supported)
+
+        Parameters
+        ----------
+        key : slice
+            0-based, half-open range of positions to fetch
+
+        Returns
+        -------
+        str
+            Sequence of the requested positions, in the case used in the FASTA file
+        """
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError('Chromosome sequences can only be sliced contiguously')
+        (start, end, _) = key.indices(self._length)
+        if start >= end:
+            return ''
+        return self._genome.fasta.fetch(self._chrom, start, end)
+
+
+class IndexedGenome(object):
+    """Random access to the chromosome sequences of a genome FASTA file through its faidx index (FILE.fai, created alongside the FASTA file if
+    absent). Nothing is loaded into memory up front: each slice is read directly from the file. Can be passed in place of a dictionary of
+    SeqRecords to :py:meth:`plastid.genomics.roitools.SegmentChain.get_sequence`, which splices and reverse-complements transcript sequences.
+
+    File handles are not shared across processes: each process (including workers forked from the one that created the IndexedGenome) opens
+    the FASTA file itself on first access.
+    """
+
+    def __init__(self, fastafile):
+        """Create IndexedGenome
+
+        Parameters
+        ----------
+        fastafile : str
+            Path to a FASTA file, either uncompressed or bgzip-compressed
+        """
+        self.filename = fastafile
+        self._fasta = None
+        self._pid = None
+        self._lengths = dict(zip(self.fasta.references, self.fasta.lengths))
+
+    @property
+    def fasta(self):
+        """:py:class:`pysam.FastaFile` opened by the current process"""
+        if self._pid != os.getpid():
+            self._fasta = pysam.FastaFile(self.filename)
+            self._pid = os.getpid()
+        return self._fasta
+
+    def chroms(self):
+        """Names of the chromosomes in the genome"""
+        return self._lengths.keys()
+
+    def lengths(self):
+        """Dictionary of chromosome lengths"""
+        return dict(self._lengths)
+
+    def __contains__(self, chrom):
+        return chrom in self._lengths
+
+    def __getitem__(self, chrom):
+        """Sequence of a chromosome, to be sliced
+
+        Parameters
+        ----------
+        chrom : str
+            Chromosome name
+
+        Returns
+        -------
+        _ChromSequence
+            Object that fetches the sequence of each slice taken from it
+        """
+        if chrom not in self._lengths:
+            raise KeyError(chrom)
+        return _ChromSequence(self, chrom, self._lengths[chrom])
+
+    def close(self):
+        """Close the FASTA file, if this process opened it"""
+        if self._fasta is not None and self._pid == os.getpid():
+            self._fasta.close()
+        self._fasta = None
+        self._pid = None
@@ -0,0 +1,110 @@
+#! /usr/bin/env python
+
+import argparse
+import os
+import sys
+import shutil
+from time import strftime
+import pysam
+import numpy as np
+import multiprocessing as mp
+from hashed_read_genome_array import read_length_nmis, map_psites, count_cache_path, count_cache_arrays, CACHE_KEYFILE, CACHE_CHROMFILE
+
+parser = argparse.ArgumentParser(description='Sweep each BAM file once, mapping every read to its P-site, and save the resulting counts (by '
+                                             'chromosome, strand, read length, and number of 5\' mismatches) as a memory-mapped count cache. If '
+                                             'regress_orfs.py and quantify_orfs.py are then run with --countcache, counts are sliced from the cache '
+                                             'rather than fetched and mapped from the BAM files. A separate cache is generated for each BAM file, and '
+                                             'placed in SUBDIR because the cache depends on the offsets in OFFSETFILE.')
+parser.add_argument('bamfiles', nargs='+', help='Path to transcriptome-aligned BAM file(s) for read data')
+parser.add_argument('--subdir', default=os.path.curdir,
+                    help='Convenience argument when dealing with multiple datasets. In such a case, set SUBDIR to an appropriate name (e.g. HARR, '
+                         'CHX) to avoid file conflicts. (Default: current directory)')
+parser.add_argument('--offsetfile', default='offsets.txt',
+                    help='Path to 2-column tab-delimited file with 5\' offsets for variable P-site mappings. First column indicates read length, '
+                         'second column indicates offset to apply. Read lengths are calculated after trimming up to MAX5MIS 5\' mismatches. Accepted '
+                         'read lengths are defined by those present in the first column of this file. If SUBDIR is set, this file is assumed to be '
+                         'in that directory. (Default: offsets.txt)')
+parser.add_argument('--max5mis', type=int, default=1, help='Maximum 5\' mismatches to trim. Reads with more than this number will be excluded. '
+                                                           '(Default: 1)')
+parser.add_argument('-v', '--verbose', action='count', help='Output a log of progress and timing (to stdout). Repeat for higher verbosity level.')
+parser.add_argument('-p', '--numproc', type=int, default=1, help='Number of processes to run. Defaults to 1 but more recommended if available.')
+parser.add_argument('-f', '--force', action='store_true', help='Force file overwrite')
+opts = parser.parse_args()
+
+offsetfilename = os.path.join(opts.subdir, opts.offsetfile)
+cachedirs = [count_cache_path(bamfile, opts.subdir) for bamfile in opts.bamfiles]
+
+for cachedir in cachedirs:
+    if os.path.exists(cachedir):
+        if not opts.force:
+            raise IOError('%s exists; use --force to overwrite' % cachedir)
+        shutil.rmtree(cachedir)
+    os.mkdir(cachedir)
+
+if opts.verbose:
+    sys.stdout.write(' '.join(sys.argv) + '\n')
+
+    def logprint(nextstr):
+        sys.stdout.write('[%s] %s\n' % (strftime('%Y-%m-%d %H:%M:%S'), nextstr))
+        sys.stdout.flush()
+
+    log_lock = mp.Lock()
+
+Pdict = {}
+with open(offsetfilename, 'rU') as infile:
+    for line in infile:
+        ls = line.strip().split()
+        rdlen = int(ls[0])
+        for nmis in range(opts.max5mis+1):
+            Pdict[(rdlen, nmis)] = int(ls[1])+nmis  # e.g. if nmis == 1, offset as though the read were missing that base entirely
+read_keys = sorted(Pdict.keys())
+
+chrom_lengths = []
+for bamfile in opts.bamfiles:
+    with pysam.Samfile(bamfile, 'rb') as inbam:
+        chrom_lengths.append(zip(inbam.references, inbam.lengths))
+
+
+def _cache_chrom((bam_idx, chrom_idx)):
+    """Map every read on one chromosome of one BAM file to its P-site, and save the nonzero counts for each strand as a sorted array of
+    positions alongside an array of counts (one column per read key)"""
+    (chrom, chromlen) = chrom_lengths[bam_idx][chrom_idx]
+    with pysam.Samfile(opts.bamfiles[bam_idx], 'rb') as inbam:
+        (key_nums, p_sites, is_reverse) = map_psites(inbam.fetch(reference=chrom), Pdict, read_length_nmis, read_keys)
+    nreads = len(p_sites)
+    for (strand, on_strand) in [('+', ~is_reverse), ('-', is_reverse)]:
+        (pos, key_counts) = np.unique(p_sites[on_strand]*len(read_keys) + key_nums[on_strand], return_counts=True)
+        (uniq_pos, pos_idx) = np.unique(pos // len(read_keys), return_inverse=True)
+        counts = np.zeros((len(uniq_pos), len(read_keys)), dtype=np.uint32)
+        counts[pos_idx, pos % len(read_keys)] = key_counts
+        (posfile, countfile) = count_cache_arrays(cachedirs[bam_idx], chrom_idx, strand)
+        np.save(posfile, uniq_pos)
+        np.save(countfile, counts)
+    if opts.verbose > 1:
+        with log_lock:
+            logprint('%s: %s complete (%d reads)' % (opts.bamfiles[bam_idx], chrom, nreads))
+    return nreads
+
+
+if opts.verbose:
+    logprint('Mapping reads by chromosome')
+
+workers = mp.Pool(opts.numproc)
+nreads = workers.map(_cache_chrom, [(bam_idx, chrom_idx) for bam_idx in xrange(len(opts.bamfiles))
+                                    for chrom_idx in xrange(len(chrom_lengths[bam_idx]))])
+workers.close()
+
+if opts.verbose:
+    logprint('Saving cache manifests (%d reads mapped)' % sum(nreads))
+
+# Manifests are written last, so an interrupted run never leaves behind a cache that appears complete
+for (cachedir, curr_chrom_lengths) in zip(cachedirs, chrom_lengths):
+    with open(os.path.join(cachedir, CACHE_CHROMFILE), 'w') as outfile:
+        for (chrom, chromlen) in curr_chrom_lengths:
+            outfile.write('%s\t%d\n' % (chrom, chromlen))
+    with open(os.path.join(cachedir, CACHE_KEYFILE), 'w') as outfile:
+        for (rdlen, nmis) in read_keys:
+            outfile.write('%d\t%d\t%d\n' % (rdlen, nmis, Pdict[(rdlen, nmis)]))
+
+if opts.verbose:
+    logprint('Tasks complete')
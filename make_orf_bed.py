@@ -3,6 +3,7 @@
 import argparse
 import os
 import pandas as pd
+from orf_store import read_table
 
 parser = argparse.ArgumentParser(description='Output a BED file of the final ORF ratings generated by rate_regression_output.py')
 parser.add_argument('--inbed', default='transcripts.bed', help='Transcriptome BED-file (Default: transcripts.bed)')
@@ -30,8 +31,8 @@ if opts.color:
 with open(opts.inbed, 'rU') as inbed:
     bedlinedict = {line.split()[3]: line for line in inbed}
 
-ratedorfs = pd.read_hdf(opts.ratingsfile, 'orfratings', mode='r', columns=['orfname', 'tid', 'gcoord', 'gstop', 'strand', 'orfrating'],
-                        where="orfrating >= %f and AAlen >= %d" % (opts.minrating, opts.minlen))
+ratedorfs = read_table(opts.ratingsfile, 'orfratings', columns=['orfname', 'tid', 'gcoord', 'gstop', 'strand', 'orfrating'],
+                       where="orfrating >= %f and AAlen >= %d" % (opts.minrating, opts.minlen))
 if ratedorfs.empty:
     raise IOError('No ORFs of minimum rating %f and length %d identified!' % (opts.minrating, opts.minlen))
 
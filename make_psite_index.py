@@ -0,0 +1,84 @@
+#! /usr/bin/env python
+
+import argparse
+import os
+import sys
+import shutil
+from time import strftime
+import pysam
+import numpy as np
+import multiprocessing as mp
+from hashed_read_genome_array import index_psite_events, psite_index_path, psite_index_file, CACHE_CHROMFILE
+
+parser = argparse.ArgumentParser(description='Sweep each BAM file once, and save every read as a P-site event (5\' end position, trimmed read '
+                                             'length, number of 5\' mismatches, and multiplicity) in a compressed index alongside the BAM file. '
+                                             'If regress_orfs.py and quantify_orfs.py are then run with --psiteindex, P-site offsets are applied '
+                                             'to the indexed events rather than to reads fetched from the BAM files. Unlike the caches from '
+                                             'make_count_cache.py, the index does not depend on the offsets or on MAX5MIS, so it need only be '
+                                             'built once per BAM file.')
+parser.add_argument('bamfiles', nargs='+', help='Path to transcriptome-aligned BAM file(s) for read data')
+parser.add_argument('-v', '--verbose', action='count', help='Output a log of progress and timing (to stdout). Repeat for higher verbosity level.')
+parser.add_argument('-p', '--numproc', type=int, default=1, help='Number of processes to run. Defaults to 1 but more recommended if available.')
+parser.add_argument('-f', '--force', action='store_true', help='Force file overwrite')
+opts = parser.parse_args()
+
+indexdirs = [psite_index_path(bamfile) for bamfile in opts.bamfiles]
+
+for indexdir in indexdirs:
+    if os.path.exists(indexdir):
+        if not opts.force:
+            raise IOError('%s exists; use --force to overwrite' % indexdir)
+        shutil.rmtree(indexdir)
+    os.mkdir(indexdir)
+
+if opts.verbose:
+    sys.stdout.write(' '.join(sys.argv) + '\n')
+
+    def logprint(nextstr):
+        sys.stdout.write('[%s] %s\n' % (strftime('%Y-%m-%d %H:%M:%S'), nextstr))
+        sys.stdout.flush()
+
+    log_lock = mp.Lock()
+
+chrom_lengths = []
+for bamfile in opts.bamfiles:
+    with pysam.Samfile(bamfile, 'rb') as inbam:
+        chrom_lengths.append(zip(inbam.references, inbam.lengths))
+
+
+def _index_chrom((bam_idx, chrom_idx)):
+    """Collapse every read on one chromosome of one BAM file into P-site events, and save the events for each strand"""
+    (chrom, chromlen) = chrom_lengths[bam_idx][chrom_idx]
+    with pysam.Samfile(opts.bamfiles[bam_idx], 'rb') as inbam:
+        events = index_psite_events(inbam.fetch(reference=chrom))
+    nreads = 0
+    nevents = 0
+    for (strand, strand_events) in events.iteritems():
+        np.savez_compressed(psite_index_file(indexdirs[bam_idx], chrom_idx, strand), **strand_events)
+        nreads += strand_events['count'].sum() + strand_events['spliced_count'].sum()
+        nevents += len(strand_events['count']) + len(strand_events['spliced_count'])
+    if opts.verbose > 1:
+        with log_lock:
+            logprint('%s: %s complete (%d reads in %d events)' % (opts.bamfiles[bam_idx], chrom, nreads, nevents))
+    return nreads
+
+
+if opts.verbose:
+    logprint('Indexing reads by chromosome')
+
+workers = mp.Pool(opts.numproc)
+nreads = workers.map(_index_chrom, [(bam_idx, chrom_idx) for bam_idx in xrange(len(opts.bamfiles))
+                                    for chrom_idx in xrange(len(chrom_lengths[bam_idx]))])
+workers.close()
+
+if opts.verbose:
+    logprint('Saving index manifests (%d reads indexed)' % sum(nreads))
+
+# Manifests are written last, so an interrupted run never leaves behind an index that appears complete
+for (indexdir, curr_chrom_lengths) in zip(indexdirs, chrom_lengths):
+    with open(os.path.join(indexdir, CACHE_CHROMFILE), 'w') as outfile:
+        for (chrom, chromlen) in curr_chrom_lengths:
+            outfile.write('%s\t%d\n' % (chrom, chromlen))
+
+if opts.verbose:
+    logprint('Tasks complete')
@@ -2,9 +2,11 @@
 
 import argparse
 from plastid.readers.bed import BED_Reader
-from plastid.genomics.roitools import SegmentChain, positionlist_to_segments
+from plastid.genomics.roitools import SegmentChain, GenomicSegment
+from tfam_index import cluster_exons
 from collections import defaultdict
 import os
+import multiprocessing as mp
 import sys
 from time import strftime
 
@@ -18,12 +20,16 @@ parser.add_argument('-g', '--genenames', help='Path to file with gene name looku
                                               'one transcript ID followed by the corresponding gene name on each line. Gene names may be repeated, '
                                               'though assigning the same name to non-overlapping transcripts will trigger a warning. Not every '
                                               'transcript must be assigned a gene name. If no file is provided, or if no gene names are available '
-                                              'for any of the transcripts in a family, transcript IDs will be used as names.')
+                                              'for any of the transcripts in a family, transcript IDs will be used as names. When the same name is '
+                                              'chosen for more than one family, the first keeps it and the others are suffixed _2, _3, etc., in '
+                                              'order of chromosome and strand (sorted by name), then of the earliest transcript of each family in '
+                                              'INBED.')
 parser.add_argument('--inbed', default='transcripts.bed', help='Transcriptome BED-file (Default: transcripts.bed)')
 parser.add_argument('--tfamstem', default='tfams', help='Output filestem. OUTSTEM.txt will be a tab-delimited file indicating which transcripts are '
                                                         'in which tfam. OUTSTEM.bed will be a bed file showing the genomic positions of each tfam. '
                                                         '(Default: tfams)')
 parser.add_argument('-v', '--verbose', action='store_true', help='Output a log of progress and timing (to stdout)')
+parser.add_argument('-p', '--numproc', type=int, default=1, help='Number of processes to run. Defaults to 1 but more recommended if available.')
 parser.add_argument('-f', '--force', action='store_true', help='Force file overwrite')
 opts = parser.parse_args()
 
@@ -42,33 +48,22 @@ if opts.verbose:
         sys.stdout.write('[%s] %s\n' % (strftime('%Y-%m-%d %H:%M:%S'), nextstr))
         sys.stdout.flush()
 
-    logprint('Identifying transcript overlaps')
+    logprint('Reading transcriptome')
 
-tfams = {}  # will contain integer keys to a tuple: ([list of tid],(chrom,strand),{set of gcoord})
-genlookup = defaultdict(dict)  # indexed by (chrom,strand) keys to an integer key to tfam
-next_tfam = 0
-processed = 0
+exons = defaultdict(list)  # indexed by (chrom,strand) keys to a list of (start, end, transcript index) of every exon
+tids = []
 with open(opts.inbed, 'rU') as inbed:
-    for trans in BED_Reader(inbed):
-        pos_set = trans.get_position_set()
-        currfams = {genlookup[(trans.chrom, trans.strand)][pos] for pos in pos_set if pos in genlookup[(trans.chrom, trans.strand)]}
-        if currfams:
-            newfam = min(currfams)
-            currfams.discard(newfam)
-            for fam in currfams:
-                oldfam_item = tfams.pop(fam)
-                tfams[newfam][0].extend(oldfam_item[0])  # extend the list of tids
-                assert (tfams[newfam][1] == oldfam_item[1])  # chrom,strand should match
-                tfams[newfam][2].update(oldfam_item[2])  # union the gcoords
-            tfams[newfam][0].append(trans.attr['ID'])
-            tfams[newfam][2].update(pos_set)
-        else:
-            newfam = next_tfam
-            next_tfam += 1
-            tfams[newfam] = ([trans.attr['ID']], (trans.chrom, trans.strand), pos_set)
-        for pos in tfams[newfam][2]:
-            genlookup[(trans.chrom, trans.strand)][pos] = newfam  # override old families and expand as needed
-        processed += 1
+    for (trans_idx, trans) in enumerate(BED_Reader(inbed)):
+        tids.append(trans.attr['ID'])
+        for seg in trans:
+            exons[(seg.chrom, seg.strand)].append((seg.start, seg.end, trans_idx))
+
+if opts.genenames:
+    with open(opts.genenames, 'rU') as infile:
+        gene_name_lookup = {x[0]: x[1] for x in [line.strip().split() for line in infile]}
+# gene_name_lookup = pd.read_csv(opts.genenames,sep='\t',header=None,names=['tid','tfam']).set_index('tid')['tfam'].to_dict()
+else:
+    gene_name_lookup = {}
 
 
 def _choose_name(names):
@@ -108,39 +103,42 @@ def _choose_name(names):
         chosen = chosen.replace('/', '_')  # avoid sub-keying in h5py! Yes, this has happened!
     return chosen
 
-if opts.verbose:
-    logprint('Assigning names to transcript families')
 
-if opts.genenames:
-    with open(opts.genenames, 'rU') as infile:
-        gene_name_lookup = {x[0]: x[1] for x in [line.strip().split() for line in infile]}
-# gene_name_lookup = pd.read_csv(opts.genenames,sep='\t',header=None,names=['tid','tfam']).set_index('tid')['tfam'].to_dict()
-else:
-    gene_name_lookup = {}
+def _find_tfams(chrom_strand):
+    """Identify the transcript families on one chromosome and strand with cluster_exons(). Returns the chosen (not yet unique) name, transcript
+    IDs, and merged (start, end) segments of each family, ordered by each family's earliest transcript in the input."""
+    cs_tfams = []
+    for (fam_trans, segs) in cluster_exons(exons[chrom_strand]):
+        fam_tids = [tids[trans_idx] for trans_idx in fam_trans]
+        geneset = {gene_name_lookup[tid] for tid in fam_tids if tid in gene_name_lookup}
+        if not geneset:
+            geneset = set(fam_tids)  # if no gene names available, just use the tids themselves
+        cs_tfams.append((_choose_name(geneset), fam_tids, segs))
+    return cs_tfams
 
-new_tfams = {}
-multi_names = defaultdict(lambda: int(1))
-for tfam_val in tfams.itervalues():
-    geneset = {gene_name_lookup[tid] for tid in tfam_val[0] if tid in gene_name_lookup}
-    if not geneset:
-        geneset = set(tfam_val[0])  # if no gene names available, just use the tids themselves
-    genename = _choose_name(geneset)
-    if genename in new_tfams:
-        multi_names[genename] += 1
-        genename = '%s_%d' % (genename, multi_names[genename])
-    new_tfams[genename] = tfam_val
-for (genename, num_appearances) in multi_names.iteritems():
-    sys.stderr.write('WARNING: Gene name %s appears %d independent times\n' % (genename, num_appearances))
 
 if opts.verbose:
-    logprint('Saving results')
+    logprint('Identifying and saving transcript families')
 
+# Families are written as each chromosome and strand is completed; only names are kept, to make them unique across chromosomes and strands
+used_names = set()
+multi_names = defaultdict(lambda: int(1))
+workers = mp.Pool(opts.numproc)
 with open(outbedname, 'w') as outbed:
     with open(outtxtname, 'w') as outtxt:
-        for tfam, (tids, (chrom, strand), genpos) in new_tfams.iteritems():
-            outbed.write(SegmentChain(*positionlist_to_segments(chrom, strand, list(genpos)), ID=tfam).as_bed())
-            for tid in tids:
-                outtxt.write('%s\t%s\n' % (tid, tfam))
+        chrom_strands = sorted(exons.keys())
+        for ((chrom, strand), cs_tfams) in zip(chrom_strands, workers.imap(_find_tfams, chrom_strands)):
+            for (genename, fam_tids, segs) in cs_tfams:
+                if genename in used_names:
+                    multi_names[genename] += 1
+                    genename = '%s_%d' % (genename, multi_names[genename])
+                used_names.add(genename)
+                outbed.write(SegmentChain(*[GenomicSegment(chrom, start, end, strand) for (start, end) in segs], ID=genename).as_bed())
+                for tid in fam_tids:
+                    outtxt.write('%s\t%s\n' % (tid, genename))
+workers.close()
+for (genename, num_appearances) in multi_names.iteritems():
+    sys.stderr.write('WARNING: Gene name %s appears %d independent times\n' % (genename, num_appearances))
 
 if opts.verbose:
     logprint('Tasks complete')
@@ -0,0 +1,73 @@
+import numpy as np
+
+
+def group_starts(seq_info, seqcols):
+    """For records sorted by sequence and then position, flag the first record of each sequence and of each distinct genomic position (differing
+    in chromosome, strand, and/or position) within a sequence
+
+    Parameters
+    ----------
+    seq_info : numpy.ndarray
+        Records with the sequence field(s) in seqcols, and 'cs' and 'genpos' fields for the chromosome/strand and position
+    seqcols : list
+        Names of the fields that together encode each sequence
+
+    Returns
+    -------
+    tuple
+        Boolean arrays flagging the first record of each sequence, and of each position
+    """
+    new_seq = np.zeros(len(seq_info), dtype=np.bool)
+    new_seq[:1] = True
+    for seqcol in seqcols:
+        new_seq[1:] |= (seq_info[seqcol][1:] != seq_info[seqcol][:-1])
+    new_pos = new_seq.copy()
+    for poscol in ('cs', 'genpos'):
+        new_pos[1:] |= (seq_info[poscol][1:] != seq_info[poscol][:-1])
+    return (new_seq, new_pos)
+
+
+def find_mm(seq_info, seqcols):
+    """Identify multimapping positions: returns the records in seq_info whose sequence appears at more than one distinct genomic position, sorted
+    by sequence and then position. Found by sorting, so that duplicates are adjacent."""
+    seq_info = seq_info[np.lexsort([seq_info['genpos'], seq_info['cs']] + [seq_info[seqcol] for seqcol in seqcols[::-1]])]
+    (new_seq, new_pos) = group_starts(seq_info, seqcols)
+    seq_group = np.cumsum(new_seq) - 1
+    return seq_info[np.bincount(seq_group, weights=new_pos)[seq_group] > 1] if len(seq_info) else seq_info
+
+
+def sum_mm_by_tid(mm_seq_info, ntids):
+    """Number of multimapping positions and reads on each of ntids transcripts, from records whose 'tid' field is the index of their transcript"""
+    return (np.bincount(mm_seq_info['tid'], minlength=ntids).astype(np.float64),
+            np.bincount(mm_seq_info['tid'], weights=mm_seq_info['reads'], minlength=ntids).astype(np.float64))
+
+
+def find_lost_mm(mm_seq_info, kept_tids, seqcols):
+    """Identify the records, among multimapping records sorted as returned by find_mm(), that no longer count as multimapping once only the
+    transcripts flagged in kept_tids are kept: records from dropped transcripts, plus records whose sequence no longer appears at more than one
+    position occupied by a kept transcript. Summing these by transcript and subtracting them from the sums over mm_seq_info gives the sums that
+    find_mm() would find among the records of the kept transcripts alone.
+
+    Parameters
+    ----------
+    mm_seq_info : numpy.ndarray
+        Multimapping records from find_mm()
+    kept_tids : numpy.ndarray
+        Boolean array, True at the index of each kept transcript
+    seqcols : list
+        Names of the fields that together encode each sequence
+
+    Returns
+    -------
+    numpy.ndarray
+        The records no longer counted as multimapping
+    """
+    dropped = ~kept_tids[mm_seq_info['tid']]
+    if not dropped.any():
+        return mm_seq_info[:0]  # no regrouping needed
+    mm_seq_info = np.array(mm_seq_info)
+    (new_seq, new_pos) = group_starts(mm_seq_info, seqcols)
+    seq_group = np.cumsum(new_seq) - 1
+    still_occupied = np.bincount(np.cumsum(new_pos) - 1, weights=~dropped) > 0  # each position is still covered by a kept transcript
+    kept_npos = np.bincount(seq_group[new_pos], weights=still_occupied)
+    return mm_seq_info[dropped | (kept_npos[seq_group] <= 1)]
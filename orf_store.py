@@ -0,0 +1,490 @@
+import os
+import re
+import ast
+import shutil
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+# Columns of the ORF table written by find_orfs_and_types.py, in order: one entry per ORF and transcript on which it appears
+ORF_COLUMNS = ['tfam', 'tid', 'tcoord', 'tstop', 'chrom', 'gcoord', 'gstop', 'strand', 'codon', 'AAlen', 'orfname', 'annot_start', 'annot_stop',
+               'orftype']
+# In the normalized layout, columns describing the ORF itself are stored once per ORF, in the "orfs" table; those depending on the transcript
+# are stored in the "orf_tids" link table (along with chrom, so that both tables can be queried by chromosome)
+ORF_FIELDS = ['chrom', 'gcoord', 'gstop', 'strand', 'codon', 'AAlen', 'annot_start', 'annot_stop', 'orftype']
+LINK_FIELDS = ['tcoord', 'tstop']
+
+
+COLUMNAR_EXTENSIONS = ('.parquet', '.pq')  # stores with these extensions use the columnar backend; all others are pandas HDF stores
+ROW_GROUP_SIZE = 131072  # rows per row group in tables written whole to a columnar store; appended chunks form row groups of their own
+MAX_OPEN_WRITERS = 64  # tables appended to at once by a columnar store; beyond this, the least recently appended is closed (see ColumnarStore)
+_WHERE_CLAUSE = re.compile(r'^\s*([A-Za-z_]\w*)\s*(==|!=|<=|>=|<|>)\s*(.+?)\s*$')
+
+
+def _where_filters(where):
+    """Translate the clauses of a condition that compare a column to a literal value into filters for :py:func:`pyarrow.parquet.read_table`,
+    which are checked against the statistics of each row group to skip those that cannot match. Other clauses are left out (the full condition
+    is applied after reading anyway); nothing is translated unless the clauses are all required to hold."""
+    if re.search(r'\bor\b|\||~|\bnot\b', where):
+        return []
+    filters = []
+    for clause in re.split(r'\s+and\s+|\s*&\s*', where):
+        match = _WHERE_CLAUSE.match(clause.strip().lstrip('(').rstrip(')'))
+        if match:
+            try:
+                filters.append((match.group(1), match.group(2), ast.literal_eval(match.group(3))))
+            except (ValueError, SyntaxError):
+                pass
+    return filters
+
+
+class ColumnarStore(object):
+    """Tables stored as Parquet files in a directory, one subdirectory of part files per table (KEY.parquet, with any slashes in KEY making
+    further subdirectories). Supports the subset of the :py:class:`pandas.HDFStore` interface used by the functions in this module, so either
+    can be passed to them. Each chunk appended to a table becomes a row group, and reads use the column statistics of each row group to skip
+    those that cannot satisfy the condition given. Requires pyarrow.
+
+    At most MAX_OPEN_WRITERS tables are kept open for appending (e.g. the partitions of a table partitioned by chromosome, which may number in
+    the thousands for a scaffold-level assembly). If a table whose file was closed is appended to again, the rows go to a new part file, with
+    the same schema as the first.
+
+    Only the columns requested (plus any needed to evaluate the condition) are read from disk.
+    """
+
+    def __init__(self, path, mode='r'):
+        """Open a ColumnarStore
+
+        Parameters
+        ----------
+        path : str
+            Directory holding the tables
+
+        mode : str, optional
+            'r' to read an existing store, 'w' to create a new store (deleting any existing one), or 'a' to add to a store (Default: 'r')
+        """
+        import pyarrow
+        import pyarrow.parquet
+        (self._pa, self._pq) = (pyarrow, pyarrow.parquet)
+        self.path = path
+        self._writers = OrderedDict()  # key -> open ParquetWriter, from least to most recently appended to
+        if mode == 'r':
+            if not os.path.isdir(path):
+                raise IOError('%s does not exist' % path)
+        else:
+            if mode == 'w' and os.path.isdir(path):
+                shutil.rmtree(path)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Finish writing all tables being appended to"""
+        for writer in self._writers.itervalues():
+            writer.close()
+        self._writers = OrderedDict()
+
+    def _dirname(self, key):
+        return os.path.join(self.path, *key.strip('/').split('/')) + '.parquet'
+
+    def _part_files(self, key):
+        dirname = self._dirname(key)
+        return [os.path.join(dirname, name) for name in sorted(os.listdir(dirname))] if os.path.isdir(dirname) else []
+
+    def __contains__(self, key):
+        return os.path.isdir(self._dirname(key))
+
+    def _arrow_table(self, df, schema=None):
+        return self._pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+    def append(self, key, df, **kwargs):
+        """Append rows to a table as a new row group. Keyword arguments specific to HDF stores (e.g. format, data_columns) are ignored."""
+        key = key.strip('/')
+        writer = self._writers.pop(key, None)
+        if writer is not None:
+            writer.write_table(self._arrow_table(df, writer.schema))
+        else:
+            parts = self._part_files(key)
+            table = self._arrow_table(df, self._pq.read_schema(parts[0]) if parts else None)
+            if not parts:
+                os.makedirs(self._dirname(key))
+            if len(self._writers) >= MAX_OPEN_WRITERS:
+                self._writers.popitem(last=False)[1].close()
+            writer = self._pq.ParquetWriter(os.path.join(self._dirname(key), 'part-%05d.parquet' % len(parts)), table.schema)
+            writer.write_table(table)
+        self._writers[key] = writer  # now the most recently appended to
+
+    def put(self, key, df, **kwargs):
+        """Write a table, replacing any existing table of the same name. Keyword arguments specific to HDF stores are ignored."""
+        key = key.strip('/')
+        if key in self._writers:
+            self._writers.pop(key).close()
+        dirname = self._dirname(key)
+        if os.path.isdir(dirname):
+            shutil.rmtree(dirname)
+        os.makedirs(dirname)
+        self._pq.write_table(self._arrow_table(df), os.path.join(dirname, 'part-00000.parquet'), row_group_size=ROW_GROUP_SIZE)
+
+    def nrows(self, key):
+        """Number of rows in a table, from the metadata of its part files"""
+        return sum(self._pq.ParquetFile(part).metadata.num_rows for part in self._part_files(key))
+
+    def _read_rows(self, parts, columns, start, stop):
+        """Rows start to stop (None for the end) of a table, reading only the row groups that hold them"""
+        tables = []
+        pos = 0
+        for part in parts:
+            part_file = self._pq.ParquetFile(part)
+            for i in xrange(part_file.num_row_groups):
+                nrows = part_file.metadata.row_group(i).num_rows
+                if pos + nrows > start and (stop is None or pos < stop):
+                    (lo, hi) = (max(start - pos, 0), nrows if stop is None else min(stop - pos, nrows))
+                    tables.append(part_file.read_row_group(i, columns=columns).slice(lo, hi - lo))
+                pos += nrows
+        if not tables:
+            res = self._pq.read_schema(parts[0]).empty_table().to_pandas()
+            return res[columns] if columns is not None else res
+        return self._pa.concat_tables(tables).to_pandas()
+
+    def create_table_index(self, key, **kwargs):
+        """Nothing to do: row group statistics are written along with the data"""
+        pass
+
+    def select(self, key, where=None, columns=None, start=None, stop=None):
+        """Read a table, or the rows satisfying a condition and the columns requested (Default: all). As with HDF stores, start and stop number
+        the rows of the table before the condition is applied, and only the row groups holding those rows are read."""
+        parts = self._part_files(key)
+        if not parts:
+            raise KeyError('No table named %s in %s' % (key, self.path))
+        read_columns = None
+        if columns is not None:
+            read_columns = list(columns)
+            if where:
+                names = self._pq.read_schema(parts[0]).names
+                read_columns += [name for name in set(re.findall(r'[A-Za-z_]\w*', where)) if name in names and name not in read_columns]
+        if start is not None or stop is not None:
+            res = self._read_rows(parts, read_columns, start or 0, stop)
+        else:
+            res = self._pq.read_table(self._dirname(key), columns=read_columns, filters=(where and _where_filters(where)) or None).to_pandas()
+        if where:
+            res = res.query(where)
+        return res[list(columns)] if columns is not None else res
+
+
+def is_columnar(path):
+    """Whether a store path refers to a ColumnarStore (by its extension) rather than a pandas HDF store"""
+    return path.rstrip(os.path.sep).endswith(COLUMNAR_EXTENSIONS)
+
+
+def open_store(path, mode='r', **kwargs):
+    """Open a store of tables for use with the functions in this module: a ColumnarStore if path has one of COLUMNAR_EXTENSIONS, or otherwise a
+    :py:class:`pandas.HDFStore` (passing along any additional keyword arguments, e.g. complib)"""
+    if is_columnar(path):
+        return ColumnarStore(path, mode)
+    return pd.HDFStore(path, mode=mode, **kwargs)
+
+
+def store_exists(path):
+    """Whether a store (of either backend) exists at path"""
+    return os.path.isdir(path) if is_columnar(path) else os.path.isfile(path)
+
+
+def orf_basename(tfam, gcoord, AAlen):
+    """Assign a usually unique identifier for each ORF. If not unique, a number should be appended to the end."""
+    return '%s_%d_%daa' % (tfam, gcoord, AAlen)
+
+
+def normalize_orfs(orfs, tfam_ids, tid_ids, first_orf_id):
+    """Split a table of ORFs in the ORF_COLUMNS format into the tables of the normalized layout. All entries for each ORF must be included.
+
+    Parameters
+    ----------
+    orfs : :py:class:`pandas.DataFrame`
+        ORF entries, one per ORF and transcript
+
+    tfam_ids, tid_ids : dict
+        Integer ID of each transcript family and transcript, as listed in the "tfam_names" and "tid_names" tables
+
+    first_orf_id : int
+        ID to assign to the first ORF in `orfs`; the others are numbered consecutively from it
+
+    Returns
+    -------
+    tuple
+        :py:class:`pandas.DataFrame` of ORFs (one row per ORF, keyed by orf_id) and of ORF-transcript links (one row per entry of `orfs`)
+    """
+    (orf_nums, orfnames) = pd.factorize(orfs['orfname'])
+    first_rows = np.unique(orf_nums, return_index=True)[1]
+    orf_table = orfs.iloc[first_rows][ORF_FIELDS].reset_index(drop=True)
+    orf_table.insert(0, 'orf_id', np.arange(first_orf_id, first_orf_id + len(orfnames), dtype=np.int64))
+    orf_table.insert(1, 'tfam_id', orfs['tfam'].iloc[first_rows].map(tfam_ids).values.astype(np.int64))
+    basenames = [orf_basename(tfam, gcoord, AAlen) for (tfam, gcoord, AAlen) in orfs[['tfam', 'gcoord', 'AAlen']].iloc[first_rows].itertuples(False)]
+    orf_table['name_suffix'] = np.array([-1 if orfname == basename else int(orfname[len(basename)+1:])
+                                         for (orfname, basename) in zip(orfnames, basenames)], dtype=np.int32)
+    # orfnames are not stored as strings: each is rebuilt from its tfam, gcoord, and AAlen, plus the suffix (-1 if none) distinguishing ORFs
+    # that share those
+    link_table = pd.DataFrame({'orf_id': orf_nums.astype(np.int64) + first_orf_id,
+                               'tid_id': orfs['tid'].map(tid_ids).values.astype(np.int64),
+                               'chrom': orfs['chrom'].values,
+                               'tcoord': orfs['tcoord'].values,
+                               'tstop': orfs['tstop'].values},
+                              columns=['orf_id', 'tid_id', 'chrom', 'tcoord', 'tstop'])
+    return (orf_table, link_table)
+
+
+def write_names(store, tfams, tids):
+    """Save the dictionary tables of transcript family and transcript names to a normalized ORF store; the ID of each is its position in the
+    corresponding list"""
+    store.put('tfam_names', pd.DataFrame({'tfam': list(tfams)}), format='t')
+    store.put('tid_names', pd.DataFrame({'tid': list(tids)}), format='t')
+
+
+def partition_key(table, chrom_idx):
+    """Node holding the partition of a chromosome-partitioned table for the chromosome numbered chrom_idx"""
+    return '%s_by_chrom/c%d' % (table, chrom_idx)
+
+
+def manifest_key(table):
+    """Node listing the chromosome and node of each partition of a chromosome-partitioned table"""
+    return '%s_manifest' % table
+
+
+def has_table(store, table):
+    """Whether an open store contains a table, either as a single node or partitioned by chromosome"""
+    return table in store or manifest_key(table) in store
+
+
+def is_normalized(store):
+    """Whether an open ORF store uses the normalized layout (rather than a single "all_orfs" table)"""
+    return has_table(store, 'orfs') and has_table(store, 'orf_tids')
+
+
+def append_table(store, table, df, chrom_ids=None, **kwargs):
+    """Append rows to a table in an open store. If chrom_ids is provided, the table is partitioned by chromosome: the rows for each chromosome are
+    appended to the node of its partition, numbered as in chrom_ids (a dictionary of the number of each chromosome). Additional keyword
+    arguments are passed to :py:meth:`pandas.HDFStore.append`."""
+    if chrom_ids is None:
+        store.append(table, df, format='t', data_columns=True, **kwargs)
+    else:
+        for (chrom, chrom_df) in df.groupby('chrom'):
+            if not chrom_df.empty:
+                store.append(partition_key(table, chrom_ids[chrom]), chrom_df, format='t', data_columns=True, **kwargs)
+
+
+def finish_table(store, table, chrom_ids=None):
+    """Complete a table written by append_table(): index a single node for queries, or list the partitions of a partitioned table in its
+    manifest (partitions are read whole, so need no index)"""
+    if chrom_ids is None:
+        if table in store:
+            store.create_table_index(table, columns=True)
+    else:
+        store.put(manifest_key(table), pd.DataFrame([(chrom, partition_key(table, chrom_idx))
+                                                     for (chrom, chrom_idx) in sorted(chrom_ids.items(), key=lambda x: x[1])
+                                                     if partition_key(table, chrom_idx) in store], columns=['chrom', 'key']), format='t')
+
+
+def select_table(store, table, chrom=None, where=None, columns=None):
+    """Read rows of a table from an open store, whether it is a single node or partitioned by chromosome
+
+    Parameters
+    ----------
+    store : :py:class:`pandas.HDFStore` or ColumnarStore
+        Store containing the table
+
+    table : str
+        Name of the table
+
+    chrom : str, optional
+        Chromosome to which to restrict the rows. From a partitioned table, only the node of that chromosome is read, sequentially and in full.
+
+    where : str, optional
+        Condition on the rows, in the syntax shared by PyTables queries and :py:meth:`pandas.DataFrame.query`. Applied by PyTables to a single
+        HDF node, in memory to the partitions read, or (after skipping row groups by their statistics) to the rows read from a ColumnarStore.
+
+    columns : list, optional
+        Columns to return (Default: all)
+
+    Returns
+    -------
+    :py:class:`pandas.DataFrame`
+        The selected rows
+    """
+    if manifest_key(table) in store:
+        manifest = store.select(manifest_key(table))
+        parts = [store.select(key) for key in (manifest['key'] if chrom is None else manifest.loc[manifest['chrom'] == chrom, 'key'])]
+        if not parts:
+            if manifest.empty:
+                return pd.DataFrame(columns=columns)
+            parts = [store.select(manifest['key'].iat[0], start=0, stop=0)]  # no rows, but the columns and types of the table
+        res = pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0]
+        if where:
+            res = res.query(where)
+        return res[columns] if columns else res
+    conditions = ['(%s)' % cond for cond in ('chrom == %r' % chrom if chrom is not None else None, where) if cond]
+    return store.select(table, where=' & '.join(conditions) or None, columns=columns)
+
+
+def read_table(storefile, table, chrom=None, where=None, columns=None):
+    """Read rows of a table from a store file with select_table()"""
+    with open_store(storefile) as store:
+        return select_table(store, table, chrom, where, columns)
+
+
+def table_chroms(storefile, table):
+    """All of the chromosomes in a table: those listed in its manifest if partitioned, or else the dictionary of its categorical chrom column"""
+    with open_store(storefile) as store:
+        if manifest_key(table) in store:
+            return store.select(manifest_key(table))['chrom'].values
+        if isinstance(store, ColumnarStore):
+            chroms = store.select(table, columns=['chrom'])['chrom']
+            return chroms.cat.categories.values if hasattr(chroms, 'cat') else np.sort(chroms.unique())
+        return store.select('%s/meta/chrom/meta' % table).values
+
+
+def store_chroms(storefile):
+    """All of the chromosomes in an ORF store (of either layout)"""
+    with open_store(storefile) as store:
+        table = 'orfs' if is_normalized(store) else 'all_orfs'
+    return table_chroms(storefile, table)
+
+
+def read_orfs(storefile, chrom=None, where=None, link_where=None, columns=None):
+    """Read ORF entries (one per ORF and transcript) from an ORF store of any layout, as a table in the ORF_COLUMNS format
+
+    Parameters
+    ----------
+    storefile : str
+        Path to the ORF store, as generated by find_orfs_and_types.py
+
+    chrom : str, optional
+        Chromosome to which to restrict the entries
+
+    where : str, optional
+        Condition on the columns describing each ORF (ORF_FIELDS)
+
+    link_where : str, optional
+        Condition on the columns describing each ORF's position on a transcript (LINK_FIELDS). Both conditions are required to hold.
+
+    columns : list, optional
+        Columns to return (Default: all of ORF_COLUMNS)
+
+    Returns
+    -------
+    :py:class:`pandas.DataFrame`
+        The selected ORF entries
+    """
+    columns = columns or ORF_COLUMNS
+    with open_store(storefile) as store:
+        if not is_normalized(store):
+            return select_table(store, 'all_orfs', chrom, ' & '.join('(%s)' % cond for cond in (where, link_where) if cond) or None, columns)
+        orfs = select_table(store, 'orfs', chrom, where)
+        res = select_table(store, 'orf_tids', chrom, link_where, ['orf_id', 'tid_id'] + LINK_FIELDS).merge(orfs, on='orf_id')  # integer join
+        tfam_names = store.select('tfam_names')['tfam'].values if 'tfam' in columns or 'orfname' in columns else None
+        tid_names = store.select('tid_names')['tid'].values if 'tid' in columns else None
+    return _add_names(res, tfam_names, tid_names, columns)
+
+
+def _add_names(res, tfam_names, tid_names, columns):
+    """Convert ORF entries joined from the tables of the normalized layout to the ORF_COLUMNS format, looking up the tfam and tid names (from
+    the "tfam_names" and "tid_names" tables) and rebuilding the orfname, as needed for columns"""
+    if 'tfam' in columns or 'orfname' in columns:
+        res['tfam'] = tfam_names[res['tfam_id'].values.astype(np.int64)]
+    if 'tid' in columns:
+        res['tid'] = tid_names[res['tid_id'].values.astype(np.int64)]
+    if 'orfname' in columns:
+        res['orfname'] = [orf_basename(tfam, gcoord, AAlen) if suffix < 0 else '%s_%d' % (orf_basename(tfam, gcoord, AAlen), suffix)
+                          for (tfam, gcoord, AAlen, suffix) in res[['tfam', 'gcoord', 'AAlen', 'name_suffix']].itertuples(False)]
+    return res[columns]
+
+
+def _node_slices(store, key, chunkrows, columns=None):
+    """Read a single node of a table in consecutive slices of chunkrows rows"""
+    nrows = store.nrows(key) if isinstance(store, ColumnarStore) else store.get_storer(key).nrows
+    for start in xrange(0, nrows, chunkrows):
+        yield store.select(key, columns=columns, start=start, stop=start + chunkrows)
+
+
+def _table_nodes(store, table, chroms):
+    """The nodes holding a table, as a dict keyed by chromosome: the partitions of those chromosomes in chroms (all if None), or else the single
+    node, keyed by None"""
+    if manifest_key(table) not in store:
+        return {None: table}
+    return {chrom: key for (chrom, key) in store.select(manifest_key(table))[['chrom', 'key']].itertuples(False)
+            if chroms is None or chrom in chroms}
+
+
+def _join_slices(store, link_key, orfs_key, chunkrows):
+    """Join the "orf_tids" and "orfs" nodes of a normalized ORF store in slices, reading both in order. Link entries are grouped by tfam, and
+    the ORFs of each tfam are numbered consecutively and after those of the preceding tfams (as _write_orf_chunk() in find_orfs_and_types.py
+    writes them), so only the ORFs of the current slice's last tfam need to be kept for the next."""
+    orf_slices = _node_slices(store, orfs_key, chunkrows)
+    orfs = next(orf_slices, None)
+    for links in _node_slices(store, link_key, chunkrows, ['orf_id', 'tid_id'] + LINK_FIELDS):
+        while orfs['orf_id'].iat[-1] < links['orf_id'].max():
+            orfs = pd.concat((orfs, next(orf_slices)), ignore_index=True)
+        res = links.merge(orfs, on='orf_id')  # keeps the order of links
+        yield res
+        orfs = orfs[(orfs['tfam_id'] == res['tfam_id'].iat[-1]).values | (orfs['orf_id'] > links['orf_id'].max()).values]
+        if orfs.empty:
+            orfs = next(orf_slices, None)
+            if orfs is None:
+                break
+
+
+def _whole_tfams(slices, tfam_col):
+    """Regroup consecutive slices of ORF entries, in which the entries of each tfam are contiguous, so that no tfam is split between them"""
+    held = None
+    for curr in slices:
+        if held is not None:
+            curr = pd.concat((held, curr), ignore_index=True)
+        in_last = (curr[tfam_col] == curr[tfam_col].iat[-1]).values
+        if not in_last.all():
+            yield curr[~in_last]
+        held = curr[in_last]
+    if held is not None:
+        yield held
+
+
+def iter_orfs(storefile, chroms=None, chunkrows=1000000):
+    """Read the ORF entries from an ORF store of any layout in bounded pieces, as tables in the ORF_COLUMNS format. Each node is read in slices
+    of chunkrows rows, and each piece holds every entry of the transcript families in it (as written by find_orfs_and_types.py, with the
+    entries of each tfam together), so a piece exceeds chunkrows only by the entries of one tfam.
+
+    Parameters
+    ----------
+    storefile : str
+        Path to the ORF store, as generated by find_orfs_and_types.py
+
+    chroms : collection, optional
+        Chromosomes to which to restrict the entries. From a partitioned store, only the partitions of these chromosomes are read.
+
+    chunkrows : int, optional
+        Number of rows to read at a time (Default: 1000000)
+
+    Returns
+    -------
+    iterator of :py:class:`pandas.DataFrame`
+        The ORF entries, in the order in which they are stored
+    """
+    with open_store(storefile) as store:
+        if is_normalized(store):
+            (tfam_names, tid_names) = (store.select('tfam_names')['tfam'].values, store.select('tid_names')['tid'].values)
+            (link_nodes, orf_nodes) = (_table_nodes(store, 'orf_tids', chroms), _table_nodes(store, 'orfs', chroms))
+            for chrom in sorted(link_nodes):
+                for res in _whole_tfams(_join_slices(store, link_nodes[chrom], orf_nodes[chrom], chunkrows), 'tfam_id'):
+                    if chroms is not None and chrom is None:
+                        res = res[res['chrom'].isin(chroms)]
+                    if not res.empty:
+                        yield _add_names(res, tfam_names, tid_names, ORF_COLUMNS)
+        else:
+            nodes = _table_nodes(store, 'all_orfs', chroms)
+            for chrom in sorted(nodes):
+                for res in _whole_tfams(_node_slices(store, nodes[chrom], chunkrows, ORF_COLUMNS), 'tfam'):
+                    if chroms is not None and chrom is None:
+                        res = res[res['chrom'].isin(chroms)]
+                    if not res.empty:
+                        yield res
@@ -0,0 +1,345 @@
+import numpy as np
+import pandas as pd
+from plastid.genomics.roitools import Transcript, SegmentChain
+from sequence_codes import find_all_orfs
+from orf_store import orf_basename
+
+
+def _exon_table(trans):
+    """Tabulate the exons of a transcript in stranded (5' to 3') order, as arrays of genomic starts and ends and of the transcript coordinate at
+    which each exon begins, for use by _tcoords_to_gcoords()"""
+    segs = sorted((seg.start, seg.end) for seg in trans)
+    if trans.strand == '-':
+        segs = segs[::-1]
+    (starts, ends) = np.array(segs, dtype=np.int64).reshape((-1, 2)).T
+    return (starts, ends, np.concatenate(([0], np.cumsum(ends - starts)[:-1])), trans.strand)
+
+
+def _tcoords_to_gcoords(exon_table, tcoords):
+    """Map an array of transcript coordinates to genomic coordinates (as get_genomic_coordinate() would), by binary search for the exon
+    containing each coordinate in an exon table from _exon_table()"""
+    (starts, ends, tstarts, strand) = exon_table
+    tcoords = np.asarray(tcoords, dtype=np.int64)
+    exon = tstarts.searchsorted(tcoords, side='right') - 1
+    if strand == '-':
+        return ends[exon] - 1 - (tcoords - tstarts[exon])
+    else:
+        return starts[exon] + (tcoords - tstarts[exon])
+
+
+def _matching_rows(left, right):
+    """Find every pair of equal rows between two 2-D integer arrays, as arrays of row indices into left and into right (grouped by left row)"""
+    if len(left) == 0 or len(right) == 0:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    inverse = np.unique(np.vstack((left, right)), axis=0, return_inverse=True)[1]
+    (left_codes, right_codes) = (inverse[:len(left)], inverse[len(left):])
+    order = np.argsort(right_codes, kind='mergesort')
+    lo = right_codes[order].searchsorted(left_codes, 'left')
+    counts = right_codes[order].searchsorted(left_codes, 'right') - lo
+    left_idx = np.repeat(np.arange(len(left)), counts)
+    return (left_idx, order[np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - lo, counts)])
+
+
+def identify_tfam_orfs(tfam, tfam_bedline, tfam_trans, annot_bedlines, start_codons, stop_codons):
+    """Identify all of the possible ORFs within a family of transcripts, given as a list of (tid, Transcript, sequence). Relevant information such
+    as genomic start and stop positions, amino acid length, and initiation codon will be collected for each ORF. Additionally, each ORF will be
+    assigned a unique 'orfname', such that if it occurs on multiple transcripts, it can be recognized as the same ORF, and an 'orftype' relative to
+    the annotated CDSs assigned to the family.
+
+    Parameters
+    ----------
+    tfam : str
+        Name of the transcript family
+    tfam_bedline : str
+        BED line of the transcript family, as written by make_tfams.py
+    tfam_trans : list
+        (tid, Transcript, sequence) of each transcript in the family
+    annot_bedlines : list
+        (annotation file index, tid, BED line) of each annotated CDS assigned to the family. ORFs in a family without any are typed 'new'.
+    start_codons, stop_codons : numpy.ndarray
+        Codon lookup tables from codon_table()
+
+    Returns
+    -------
+    pandas.DataFrame or None
+        One row per ORF per transcript on which it occurs, or None if there are no ORFs
+    """
+    currtfam = SegmentChain.from_bed(tfam_bedline)
+    chrom = currtfam.chrom
+    strand = currtfam.strand
+    tfam_pos_set = currtfam.get_position_set()
+    tfam_orfs = []
+    exon_tables = {}
+    for (tid, curr_trans, tseq) in tfam_trans:
+        exon_tables[tid] = _exon_table(curr_trans)
+        trans_orfs = find_all_orfs(tseq, start_codons, stop_codons)
+        if trans_orfs:
+            (startpos, stoppos, codons) = zip(*trans_orfs)
+            startpos = np.array(startpos, dtype='i4')
+            stoppos = np.array(stoppos, dtype='i4')
+
+            gcoords = _tcoords_to_gcoords(exon_tables[tid], startpos).astype('i4')
+
+            stop_present = (stoppos > 0)
+            gstops = np.zeros(len(trans_orfs), dtype='i4')
+            gstops[stop_present] = _tcoords_to_gcoords(exon_tables[tid], stoppos[stop_present] - 1) + (1 if strand == '+' else -1)
+            # the decrementing/incrementing stuff preserves half-openness regardless of strand
+
+            AAlens = np.zeros(len(trans_orfs), dtype='i4')
+            AAlens[stop_present] = (stoppos[stop_present] - startpos[stop_present])/3 - 1
+            tfam_orfs.append(pd.DataFrame.from_items([('tfam', tfam),
+                                                      ('tid', tid),
+                                                      ('tcoord', startpos),
+                                                      ('tstop', stoppos),
+                                                      ('chrom', chrom),
+                                                      ('gcoord', gcoords),
+                                                      ('gstop', gstops),
+                                                      ('strand', strand),
+                                                      ('codon', codons),
+                                                      ('AAlen', AAlens),
+                                                      ('orfname', '')]))
+    if any(x is not None for x in tfam_orfs):
+        tfam_orfs = pd.concat(tfam_orfs, ignore_index=True)
+        for ((gcoord, AAlen), gcoord_grp) in tfam_orfs.groupby(['gcoord', 'AAlen']):  # group by genomic start position and length
+            if len(gcoord_grp) == 1:
+                tfam_orfs.loc[gcoord_grp.index, 'orfname'] = orf_basename(tfam, gcoord, AAlen)
+            else:
+                orf_gcoords = np.vstack(_tcoords_to_gcoords(exon_tables[tid], np.arange(tcoord, tstop))
+                                        for (tid, tcoord, tstop) in gcoord_grp[['tid', 'tcoord', 'tstop']].itertuples(False))
+                if (orf_gcoords == orf_gcoords[0, :]).all():  # all of the grouped ORFs are identical, so should receive the same name
+                    orfname = orf_basename(tfam, gcoord, AAlen)
+                    tfam_orfs.loc[gcoord_grp.index, 'orfname'] = orfname
+                else:
+                    named_so_far = 0
+                    unnamed = np.ones(len(gcoord_grp), dtype=np.bool)
+                    basename = orf_basename(tfam, gcoord, AAlen)
+                    while unnamed.any():
+                        next_gcoords = orf_gcoords[unnamed, :][0, :]
+                        identicals = (orf_gcoords == next_gcoords).all(1)
+                        orfname = '%s_%d' % (basename, named_so_far)
+                        tfam_orfs.loc[gcoord_grp.index[identicals], 'orfname'] = orfname
+                        unnamed[identicals] = False
+                        named_so_far += 1
+
+        # Now that the ORFs have been found and named, figure out their orftype. Each ORF is handled by an integer ID (its index in orfnames),
+        # and represented by the first row in which it appears. Every category is assigned at once to all of the still-untyped ORFs that satisfy it
+        (orf_ids, orfnames) = pd.factorize(tfam_orfs['orfname'])
+        (row_tids, tid_names) = pd.factorize(tfam_orfs['tid'])
+        (row_tcoords, row_tstops) = (tfam_orfs['tcoord'].values.astype(np.int64), tfam_orfs['tstop'].values.astype(np.int64))
+        first_rows = np.unique(orf_ids, return_index=True)[1]
+        norfs = len(orfnames)
+        (orf_tids, orf_tcoords, orf_tstops) = (row_tids[first_rows], row_tcoords[first_rows], row_tstops[first_rows])
+        (orf_gcoords, orf_gstops, orf_AAlens) = [tfam_orfs[col].values[first_rows].astype(np.int64) for col in ('gcoord', 'gstop', 'AAlen')]
+        annot_start = np.zeros(norfs, dtype=np.bool)
+        annot_stop = np.zeros(norfs, dtype=np.bool)  # start out assuming all are False; replace with True as needed
+        orftype = np.full(norfs, 'new', dtype=object)
+        untyped = orf_tstops > 0
+        orftype[~untyped] = 'nonstop'  # no stop codon
+
+        def _set_type(is_type, typename):
+            """Assign typename to every untyped ORF flagged in is_type"""
+            is_type = is_type & untyped
+            orftype[is_type] = typename
+            untyped[is_type] = False
+
+        def _orf_positions(ids):
+            """Genomic coordinates of the ORFs in ids (each in stranded order), concatenated, along with the index into ids of the ORF to which
+            each belongs"""
+            lens = np.maximum(orf_tstops[ids] - orf_tcoords[ids], 0)  # ORFs without stop codons have no positions
+            owner = np.repeat(np.arange(len(ids)), lens)
+            tcoords = np.arange(lens.sum()) - np.repeat(np.cumsum(lens) - lens - orf_tcoords[ids], lens)
+            gpos = np.empty(len(tcoords), dtype=np.int64)
+            pos_tids = orf_tids[ids][owner]
+            for tid_num in np.unique(pos_tids):
+                on_tid = (pos_tids == tid_num)
+                gpos[on_tid] = _tcoords_to_gcoords(exon_tables[tid_names[tid_num]], tcoords[on_tid])
+            return (gpos, owner)
+
+        if annot_bedlines:
+            cds_info = []
+            for (annot_fidx, annot_tid, annot_bedline) in annot_bedlines:
+                curr_trans = Transcript.from_bed(annot_bedline)
+                if curr_trans.cds_start is not None and curr_trans.cds_end is not None:
+                    curr_cds_pos_set = curr_trans.get_cds().get_position_set()
+                    curr_len = len(curr_cds_pos_set)
+                    if curr_len % 3 == 0:
+                        curr_gcoord = curr_trans.get_genomic_coordinate(curr_trans.cds_start)[1]
+                        curr_gstop = curr_trans.get_genomic_coordinate(curr_trans.cds_end - 1)[1] + (1 if strand == '+' else -1)
+                        in_tfam = curr_cds_pos_set.issubset(tfam_pos_set)
+                        cds_info.append((curr_gcoord, curr_gstop, (curr_len-3)/3, in_tfam, annot_fidx, annot_tid, curr_cds_pos_set))
+            if cds_info:  # False means no annotated CDSs or none are multiples of 3 in length
+                cds_info = pd.DataFrame(cds_info, columns=['gcoord', 'gstop', 'AAlen', 'in_tfam', 'annot_fidx', 'annot_tid', 'pos']) \
+                    .groupby(['gcoord', 'gstop', 'AAlen', 'in_tfam'], as_index=False) \
+                    .apply(lambda x: x if len(x) == 1 else x[[not any(pos == x['pos'].iat[j] for j in xrange(i))
+                                                              for (i, pos) in enumerate(x['pos'])]])
+                # this operation organizes cds_info into a dataframe and effectively drops duplicates
+                # pandas drop_duplicates() is incompatible with sets so have to do it this manual way
+                (cds_gcoords, cds_gstops, cds_AAlens) = [cds_info[col].values.astype(np.int64) for col in ('gcoord', 'gstop', 'AAlen')]
+                cds_in_tfam = cds_info['in_tfam'].values.astype(np.bool)
+                cds_found = np.zeros(len(cds_info), dtype=np.bool)
+                # Index of annotated CDS positions: each (CDS, position) pair is encoded as one integer key, so that the keys of each CDS are
+                # contiguous and sorted, and containment and range counts are binary searches
+                cds_pos = [np.array(sorted(cds_pos_set, reverse=(strand == '-')), dtype=np.int64) for cds_pos_set in cds_info['pos']]
+                cds_lens = np.array([len(curr_cds_pos) for curr_cds_pos in cds_pos])
+                all_annot_pos = np.unique(np.concatenate(cds_pos))
+                (pos_base, pos_span) = (all_annot_pos[0], all_annot_pos[-1] - all_annot_pos[0] + 1)
+                cds_keys = np.repeat(np.arange(len(cds_pos)) * pos_span - pos_base, cds_lens) + \
+                    np.concatenate([np.sort(curr_cds_pos) for curr_cds_pos in cds_pos])
+
+                def _in_cds(cds_idx, gpos):
+                    """Whether each position in gpos is in the corresponding annotated CDS in cds_idx"""
+                    keys = cds_idx * pos_span + (gpos - pos_base)
+                    found_idx = np.minimum(cds_keys.searchsorted(keys), len(cds_keys) - 1)
+                    return (gpos >= pos_base) & (gpos < pos_base + pos_span) & (cds_keys[found_idx] == keys)
+
+                def _count_cds_in_range(cds_idx, lo, hi):
+                    """Number of positions of each annotated CDS in cds_idx within [lo, hi)"""
+                    (lo, hi) = (np.clip(lo, pos_base, pos_base + pos_span), np.clip(hi, pos_base, pos_base + pos_span))
+                    return np.maximum(cds_keys.searchsorted(cds_idx * pos_span + (hi - pos_base)) -
+                                      cds_keys.searchsorted(cds_idx * pos_span + (lo - pos_base)), 0)
+
+                def _n_in_cds(pair_orfs, pair_cds):
+                    """Number of positions of each ORF in pair_orfs that are in the corresponding annotated CDS in pair_cds"""
+                    (gpos, owner) = _orf_positions(pair_orfs)
+                    return np.bincount(owner, weights=_in_cds(pair_cds[owner], gpos), minlength=len(pair_orfs)).astype(np.int64)
+
+                annot_start = np.in1d(orf_gcoords, cds_gcoords)
+                annot_stop = np.in1d(orf_gstops, cds_gstops)
+
+                # ANNOTATED and XISO
+                (pair_orfs, pair_cds) = _matching_rows(np.column_stack((orf_gcoords, orf_gstops, orf_AAlens)),
+                                                       np.column_stack((cds_gcoords, cds_gstops, cds_AAlens))[cds_in_tfam])
+                pair_cds = np.flatnonzero(cds_in_tfam)[pair_cds]
+                cds_within = (_n_in_cds(pair_orfs, pair_cds) == cds_lens[pair_cds])
+                # ORFs and CDSs paired here have the same length, so a CDS contained in an ORF is identical to it
+                cds_found[pair_cds[cds_within]] = True
+                is_annotated = np.bincount(pair_orfs[cds_within], minlength=norfs) > 0
+                is_xiso = (np.bincount(pair_orfs, minlength=norfs) > 0) & ~is_annotated
+                # matching start and stop but differing in between
+                (orftype[is_annotated], orftype[is_xiso]) = ('annotated', 'Xiso')
+                untyped[is_annotated | is_xiso] = False
+                _set_type(np.bincount(_matching_rows(np.column_stack((orf_gcoords, orf_gstops)),
+                                                     np.column_stack((cds_gcoords, cds_gstops)))[0], minlength=norfs) > 0, 'Xiso')
+                # matching start and stop, but must differ somewhere, otherwise would have been identified as annotated (Xiso => "exact isoform")
+
+                # Pair every row with every row of an annotated ORF on the same transcript, for the categories defined relative to those
+                annot_rows = np.flatnonzero(is_annotated[orf_ids])
+                (same_tid_rows, same_tid_annot) = _matching_rows(row_tids[:, None], row_tids[annot_rows, None])
+                same_tid_annot = annot_rows[same_tid_annot]
+                same_tid_orfs = orf_ids[same_tid_rows]
+                (tcoord, tstop) = (row_tcoords[same_tid_rows], row_tstops[same_tid_rows])
+                (tcoord_annot, tstop_annot) = (row_tcoords[same_tid_annot], row_tstops[same_tid_annot])
+
+                def _set_type_same_tid(is_type, typename):
+                    """Assign typename to every untyped ORF in a pair (with an annotated ORF on the same transcript) flagged in is_type"""
+                    _set_type(np.bincount(same_tid_orfs[is_type], minlength=norfs) > 0, typename)
+
+                # SISO
+                _set_type(annot_start & annot_stop, 'Siso')
+                # start and stop each match at least one CDS, but not the same one (Siso => "spliced isoform")
+
+                # CISO
+                _set_type(annot_start, 'Ciso')
+                # start is annotated, but stop is not - so must be on a new transcript (Ciso => "C-terminal isoform")
+
+                # TRUNCATION
+                _set_type_same_tid((tstop == tstop_annot) & (tcoord > tcoord_annot), 'truncation')
+                # on the same transcript with an annotated CDS, with matching stop codon, initiating downstream - must be a truncation
+                # still some missing truncations, if the original CDS was not on a transcript in the present transcriptome
+                if untyped.any() and not cds_found.all():
+                    (pair_orfs, pair_cds) = _matching_rows(orf_gstops[untyped, None], cds_gstops[~cds_found, None])
+                    (pair_orfs, pair_cds) = (np.flatnonzero(untyped)[pair_orfs], np.flatnonzero(~cds_found)[pair_cds])
+                    keep = orf_AAlens[pair_orfs] < cds_AAlens[pair_cds]
+                    (pair_orfs, pair_cds) = (pair_orfs[keep], pair_cds[keep])
+                    # all positions in the annotation past the orf start codon must be included in the orf
+                    (lo, hi) = ((pos_base, orf_gcoords[pair_orfs] + 1) if strand == '-' else (orf_gcoords[pair_orfs], pos_base + pos_span))
+                    orf_lens = orf_tstops[pair_orfs] - orf_tcoords[pair_orfs]
+                    is_trunc = (_n_in_cds(pair_orfs, pair_cds) == orf_lens) & (_count_cds_in_range(pair_cds, lo, hi) == orf_lens)
+                    _set_type(np.bincount(pair_orfs[is_trunc], minlength=norfs) > 0, 'truncation')
+                    # matching stop codon, contained within, and all positions in the annotation past the orf start codon are included in the orf
+
+                # EXTENSION
+                matched_stop = (tstop == tstop_annot) & untyped[same_tid_orfs]
+                assert (tcoord[matched_stop] < tcoord_annot[matched_stop]).all()  # other possibilities should be done by now
+                _set_type_same_tid(matched_stop, 'extension')
+                # on the same transcript with an annotated CDS, with matching stop codon, initiating upstream - must be an extension
+                # no possibility for an "unfound" extension - if the extension is in the transcriptome, the CDS it comes from must be as well
+                # (except for a few edge cases e.g. annotated CDS is a CUG initiator, but not considering CUG ORFs)
+
+                # NISO
+                _set_type(annot_stop, 'Niso')
+                # stop is annotated, but start is not, and it's not a truncation or extension - so must be an isoform (Niso => "N-terminal isoform")
+
+                # NCISO
+                if untyped.any():
+                    untyped_ids = np.flatnonzero(untyped)
+                    (gpos, owner) = _orf_positions(untyped_ids)
+                    codon_idx = _matching_rows(gpos.reshape((-1, 3)), np.concatenate(cds_pos).reshape((-1, 3)))[0]
+                    _set_type(np.bincount(untyped_ids[owner[::3][codon_idx]], minlength=norfs) > 0, 'NCiso')
+                    # ORFs that have at least one full codon overlapping (in-frame) with a CDS are isoforms (NCiso => "N- and C-terminal isoform")
+                    # Note that these must already differ at N- and C- termini, otherwise they would already have been classified
+
+                # INTERNAL
+                _set_type_same_tid((tcoord > tcoord_annot) & (tstop < tstop_annot), 'internal')
+                # ORFs completely contained within a CDS on the same transcript, and not containing any full codon overlaps, must be internal
+                # Still could be other ORFs internal to a CDS on a transcript not in the current transcriptome - need to check manually
+                if untyped.any() and not cds_found.all():
+                    (untyped_ids, unfound_cds) = (np.flatnonzero(untyped), np.flatnonzero(~cds_found))
+                    if strand == '-':
+                        surrounds = (cds_gcoords[unfound_cds] > orf_gcoords[untyped_ids, None]) & \
+                                    (cds_gstops[unfound_cds] < orf_gstops[untyped_ids, None])
+                    else:
+                        surrounds = (cds_gcoords[unfound_cds] < orf_gcoords[untyped_ids, None]) & \
+                                    (cds_gstops[unfound_cds] > orf_gstops[untyped_ids, None])
+                    (pair_orfs, pair_cds) = np.nonzero(surrounds)
+                    (pair_orfs, pair_cds) = (untyped_ids[pair_orfs], unfound_cds[pair_cds])
+                    # all positions in the annotation between the orf start and stop codons must be included in the orf
+                    (lo, hi) = ((orf_gstops[pair_orfs] + 1, orf_gcoords[pair_orfs] + 1) if strand == '-' else
+                                (orf_gcoords[pair_orfs], orf_gstops[pair_orfs]))
+                    orf_lens = orf_tstops[pair_orfs] - orf_tcoords[pair_orfs]
+                    is_internal = (_n_in_cds(pair_orfs, pair_cds) == orf_lens) & (_count_cds_in_range(pair_cds, lo, hi) == orf_lens)
+                    _set_type(np.bincount(pair_orfs[is_internal], minlength=norfs) > 0, 'internal')
+                    # contained within, and all positions in the annotation between the orf start and stop codons are included in the orf
+
+                # STOP_OVERLAP
+                _set_type_same_tid((tcoord > tcoord_annot) & (tcoord < tstop_annot), 'stop_overlap')
+                # starts within a CDS and not an internal - must be a stop_overlap
+                # do not need to check for unfounds - requiring that stop_overlap must be on same transcript as cds
+
+                # START_OVERLAP
+                _set_type_same_tid((tstop > tcoord_annot) & (tstop < tstop_annot), 'start_overlap')
+                # ends within a CDS and not an internal - must be a start_overlap
+                # do not need to check for unfounds - requiring that start_overlap must be on same transcript as cds
+
+                # LOOF
+                _set_type_same_tid((tcoord < tcoord_annot) & (tstop > tstop_annot), 'LOOF')
+                # starts upstream of a CDS and ends downstream of it - must be a LOOF ("long out-of-frame")
+                # don't need to check for unfounds because the CDS must be on the same transcript as the ORF if the ORF completely contains it
+
+                # UPSTREAM
+                _set_type_same_tid(tstop <= tcoord_annot, 'upstream')
+                # ends upstream of a CDS - must be an upstream (uORF)
+                # cannot check manually for unfounds because those are not on well-defined transcripts
+
+                # DOWNSTREAM
+                _set_type_same_tid(tstop_annot <= tcoord, 'downstream')
+                # starts downstream of a CDS - must be a downstream ORF
+                # cannot check manually for unfounds because those are not on well-defined transcripts
+
+                # NEW_ISO and GISO
+                untyped_ids = np.flatnonzero(untyped)
+                (gpos, owner) = _orf_positions(untyped_ids)
+                overlaps_annot = np.zeros(norfs, dtype=np.bool)
+                overlaps_annot[untyped_ids] = np.bincount(owner, weights=np.in1d(gpos, all_annot_pos), minlength=len(untyped_ids)) > 0
+                _set_type(overlaps_annot, 'Giso')
+                # overlaps out-of-frame with a CDS, and not on the same transcript with a CDS: Giso => "genomic isoform"
+                _set_type(~overlaps_annot, 'new_iso')
+                # no overlaps whatsoever with any annotated CDS, but in a tfam that has annotations: new_iso
+
+                assert not untyped.any()
+        tfam_orfs['annot_start'] = annot_start[orf_ids]
+        tfam_orfs['annot_stop'] = annot_stop[orf_ids]
+        tfam_orfs['orftype'] = orftype[orf_ids]
+        return tfam_orfs
+    else:
+        return None
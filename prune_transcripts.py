@@ -4,11 +4,12 @@ import argparse
 import os
 import sys
 from plastid.genomics.genome_array import BAMGenomeArray, FivePrimeMapFactory, SizeFilterFactory
-from plastid.genomics.roitools import SegmentChain
+from plastid.genomics.roitools import SegmentChain, GenomicSegment
+from indexed_genome import IndexedGenome
+from sequence_codes import encode_kmers
+from multimappers import find_mm, sum_mm_by_tid, find_lost_mm
 import pysam
 from collections import defaultdict
-from Bio import SeqIO
-from string import maketrans
 import pandas as pd
 import numpy as np
 import multiprocessing as mp
@@ -21,19 +22,22 @@ parser = argparse.ArgumentParser(description='Use ribosome profiling data to rem
                                              'on the number of multimapping positions. It is recommended that this file be run in an empty directory '
                                              'and that OUTBED remain at the default value ("transcripts.bed") for consistency with later scripts.')
 parser.add_argument('--inbed', type=argparse.FileType('rU'), default=sys.stdin, help='Transcriptome BED-file (Default: stdin)')
-parser.add_argument('genomefasta', help='Path to genome FASTA-file')
+parser.add_argument('genomefasta', help='Path to genome FASTA-file (uncompressed or bgzip-compressed). Indexed with faidx (creating '
+                                         'GENOMEFASTA.fai) if no index exists.')
 parser.add_argument('bamfiles', nargs='+', help='Path to transcriptome-aligned BAM file(s) to use for transcript filtering purposes. Alignment '
                                                 'should report all possible multimapping positions for each read. Ideally, should be ribosome '
                                                 'profiling data sets collected in the absence of initiation inhibitors (e.g. CHX or no drug).')
 parser.add_argument('--summarytable',
                     help='Filename to use for (optional) tab-delimited text output (including column titles). First column is transcript IDs, '
                          'followed by summary information such as number of mappable positions and reads, maximum reads from any one position, '
-                         'and why the transcript was dropped (if it was dropped).')
+                         'and why the transcript was dropped (if it was dropped). Transcripts in regions with fewer than MINREADS reads in total '
+                         'are dropped without mapping reads, so their read counts (n_reads and peak_reads) are left blank, as are those of '
+                         'transcripts too short to contain any P-site.')
 parser.add_argument('--outbed', default='transcripts.bed',
                     help='File to which to output BED-formatted transcripts that passed all filters (Default: transcripts.bed)')
 parser.add_argument('--minlen', type=int, default=29,
                     help='Minimum length of read to be considered when evaluating transcripts. '
-                         'Also serves as the size of the segment when identifying multimapping positions. Must be <= 31 (Default: 29)')
+                         'Also serves as the size of the segment when identifying multimapping positions. Must be <= 62 (Default: 29)')
 parser.add_argument('--maxlen', type=int, default=30,
                     help='Maximum length (inclusive) of read to be considered when evaluating transcripts. Must be >= MINLEN (Default: 30)')
 parser.add_argument('--minreads', type=int, default=64, help='Minimum number of reads demanded for each transcript (Default: 64)')
@@ -45,17 +49,24 @@ parser.add_argument('--pseudofrac', type=float, default=1./3, help='Maximum allo
                                                                    'Ignored if list of pseudogenes is not provided. (Default: 0.333)')
 parser.add_argument('--multiexcess', type=float, default=1./3,
                     help='Maximum disparity in multimapping reads versus multimapping positions for any transcript (Default: 0.333)')
+parser.add_argument('--sketchmb', type=float, default=0,
+                    help='Memory (in MB) to devote to a count-min sketch of all sub-sequences, filled by a first pass over the transcript '
+                         'sequences. If set, sub-sequences that the sketch shows to occur at only one genomic position are discarded as each '
+                         'transcript is processed, so they are never held in memory or written to temporary files, greatly reducing both for large '
+                         'transcriptomes. Larger sketches discard more. (Default: 0, no sketch)')
 parser.add_argument('--keeptempfiles', action='store_true', help='Keep the generated intermediate files (useful for debugging)')
 parser.add_argument('-v', '--verbose', action='count', help='Output a log of progress and timing (to stdout). Repeat for higher verbosity level.')
 parser.add_argument('-p', '--numproc', type=int, default=1, help='Number of processes to run. Defaults to 1 but more recommended if available.')
 parser.add_argument('-f', '--force', action='store_true', help='Force file overwrite')
 opts = parser.parse_args()
 
+MAX_KMER_WORD = 31  # longest sequence that can be encoded in one int64 (2 bits per base); longer footprints are split across two words
+
 if not opts.force and os.path.exists(opts.outbed):
     raise IOError('%s exists; use --force to overwrite' % opts.outbed)
 
-if opts.minlen > 31:
-    raise ValueError('MINLEN must be <= 31 (currently %d)' % opts.minlen)
+if opts.minlen > 2*MAX_KMER_WORD:
+    raise ValueError('MINLEN must be <= %d (currently %d)' % (2*MAX_KMER_WORD, opts.minlen))
 
 if opts.minlen > opts.maxlen:
     raise ValueError('MINLEN must be <= MAXLEN (currently %d and %d, respectively)' % (opts.minlen, opts.maxlen))
@@ -90,8 +101,14 @@ for line in opts.inbed:
 if ntids == 0:
     raise EOFError('Insufficient input or empty file provided')
 
-genome = SeqIO.to_dict(SeqIO.parse(opts.genomefasta, 'fasta'))
-str_dict = maketrans('ACGTacgt', '01230123')
+chrom_strands = bedlinedict.keys()
+tid_list = sorted({tid for tid_lines in bedlinedict.itervalues() for tid in tid_lines})
+tid_index = {tid: i for (i, tid) in enumerate(tid_list)}  # k-mers record their transcript by its index into tid_list
+
+genome = IndexedGenome(opts.genomefasta)
+seqcols = ['seq'] if fpsize <= MAX_KMER_WORD else ['seq', 'seq2']
+# Every k-mer is saved as a record of its sequence, chromosome and strand (as an index into chrom_strands), position, transcript, and reads
+seq_info_dtype = [(seqcol, np.int64) for seqcol in seqcols] + [('cs', np.int32), ('genpos', np.int64), ('tid', np.int32), ('reads', np.float64)]
 
 temp_folder = 'tid_seq_info_temp'
 if os.path.exists(temp_folder):
@@ -101,13 +118,121 @@ if os.path.exists(temp_folder):
     temp_folder = 'tid_seq_info_temp_%d' % num
 os.mkdir(temp_folder)
 
-# seq_info_hdf_orig = os.path.join(temp_folder, 'tid_seq_%s%s_orig.h5')
-seq_info_hdf = os.path.join(temp_folder, 'tid_seq_%s%s.h5')
+seq_info_file = os.path.join(temp_folder, 'tid_seq_%s%s.npy')
+
+SKETCH_DEPTH = 4  # number of rows (independent hash functions) in the count-min sketch
+SKETCH_CHUNK = 1 << 22  # number of records to accumulate before adding them to the sketch
+if opts.sketchmb > 0:
+    # The sketch lives in a memory-mapped file so that every worker process adds to (and later queries) the same counts
+    sketch_file = os.path.join(temp_folder, 'kmer_sketch.npy')
+    sketch_width = max(int(opts.sketchmb * 1024 * 1024) // SKETCH_DEPTH, 1)
+    np.lib.format.open_memmap(sketch_file, mode='w+', dtype=np.uint8, shape=(SKETCH_DEPTH, sketch_width)).flush()
+    sketch_salts = [np.uint64((0x9e3779b97f4a7c15 * (row + 1)) % (1 << 64)) for row in xrange(SKETCH_DEPTH)]
+    sketch_lock = mp.Lock()
+
+
+def _mix64(x):
+    """Scramble an array of uint64 values (the splitmix64 finalizer), so that similar sequences hash to unrelated sketch buckets"""
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def _sketch_buckets(seq_info):
+    """Bucket of each record's sequence in each row of the count-min sketch, as a (SKETCH_DEPTH, len(seq_info)) array"""
+    key = seq_info['seq'].astype(np.uint64)
+    if 'seq2' in seqcols:
+        key = _mix64(key) ^ seq_info['seq2'].astype(np.uint64)
+    return np.array([_mix64(key ^ salt) % np.uint64(sketch_width) for salt in sketch_salts], dtype=np.int64)
+
+
+def _add_to_sketch(seq_info):
+    """Count each distinct sequence/position pair from one chromosome and strand in the shared count-min sketch. Positions shared by several
+    transcripts are only counted once, so a sequence whose count reaches 2 in every row may be multimapping; otherwise it certainly is not.
+    Counters saturate at 255."""
+    if len(seq_info) == 0:
+        return
+    sortkeys = [seq_info['genpos']] + [seq_info[seqcol] for seqcol in seqcols[::-1]]
+    order = np.lexsort(sortkeys)
+    new_pos = np.zeros(len(seq_info), dtype=np.bool)
+    new_pos[0] = True
+    for sortkey in sortkeys:
+        sortkey = sortkey[order]
+        new_pos[1:] |= (sortkey[1:] != sortkey[:-1])
+    bucket_counts = [np.unique(row_buckets, return_counts=True) for row_buckets in _sketch_buckets(seq_info[order[new_pos]])]
+    with sketch_lock:
+        sketch = np.load(sketch_file, mmap_mode='r+')
+        for (row, (buckets, counts)) in enumerate(bucket_counts):
+            sketch[row, buckets] = np.minimum(sketch[row, buckets] + counts, 255)
+        sketch.flush()
+        del sketch
+
+
+def _sketch_candidates(seq_info, sketch):
+    """Records whose sequences may be multimapping according to the completed sketch, i.e. whose count is at least 2 in every row"""
+    sketch_counts = np.min([sketch[row][row_buckets] for (row, row_buckets) in enumerate(_sketch_buckets(seq_info))], axis=0)
+    return seq_info[sketch_counts > 1]
+
+
+def _encode_transcript_kmers(seq_info, currtrans):
+    """Fill in the sequence field(s) of the records for a transcript's sub-sequences of length fpsize, one record per P-site. Sequences
+    containing N's (or any base other than ACGT) are encoded as -1."""
+    curr_seq = currtrans.get_sequence(genome).upper()
+    seq_info['seq'] = encode_kmers(curr_seq, min(fpsize, MAX_KMER_WORD))[:len(seq_info)]
+    if fpsize > MAX_KMER_WORD:
+        # leading bases stay in 'seq', so that partitioning by 'seq' still groups sequences by their starts
+        seq_info['seq2'] = encode_kmers(curr_seq[MAX_KMER_WORD:], fpsize - MAX_KMER_WORD)
+        seq_info['seq'][seq_info['seq2'] == -1] = -1
+
+
+def _overlap_clusters(transcripts):
+    """Group (tid, SegmentChain) pairs into clusters of overlapping transcripts, yielding the start and end of each cluster along with its
+    members. Transcripts are clustered by their spans, so that any read overlapping a transcript lies within the span of its cluster."""
+    cluster = []
+    for (tid, currtrans) in sorted(transcripts, key=lambda x: x[1].spanning_segment.start):
+        span = currtrans.spanning_segment
+        if cluster and span.start >= cluster_end:
+            yield (cluster_start, cluster_end, cluster)
+            cluster = []
+        if not cluster:
+            (cluster_start, cluster_end) = (span.start, span.end)
+        cluster.append((tid, currtrans))
+        cluster_end = max(cluster_end, span.end)
+    if cluster:
+        yield (cluster_start, cluster_end, cluster)
+
+
+def _sketch_chrom(tup):
+    """First pass of the sketch prefilter: count the sub-sequences of every transcript on this chromosome/strand in the shared count-min sketch.
+    Reads are not considered, so the sketch counts a superset of the sequences that _get_tid_info() will keep, and no sequence multimapping among
+    those can be discarded. Records are accumulated only up to SKETCH_CHUNK at a time, and nothing but the sketch is saved."""
+    (chrom, strand) = tup
+    transcripts = [(tid, SegmentChain.from_bed(line)) for (tid, line) in bedlinedict[(chrom, strand)].iteritems()]
+    (pending, npending) = ([], 0)
+    for (_, _, cluster) in _overlap_clusters(transcripts):
+        for (tid, currtrans) in cluster:
+            curr_pos_list = currtrans.get_position_list()  # not in stranded order!
+            if strand == '-':
+                curr_pos_list = curr_pos_list[::-1]
+            n_psite = len(curr_pos_list) + 1 - fpsize
+            if n_psite > 0:
+                curr_seq_info = np.empty(n_psite, dtype=seq_info_dtype)
+                _encode_transcript_kmers(curr_seq_info, currtrans)
+                curr_seq_info['genpos'] = curr_pos_list[psite:n_psite + psite]
+                pending.append(curr_seq_info[curr_seq_info['seq'] >= 0])
+                npending += len(pending[-1])
+        # clusters never share positions, so a cluster's records can be added apart from those of other clusters
+        if npending >= SKETCH_CHUNK:
+            _add_to_sketch(np.concatenate(pending))
+            (pending, npending) = ([], 0)
+    if pending:
+        _add_to_sketch(np.concatenate(pending))
 
 
 def _get_tid_info(tup):
     """For each transcript on this chromosome/strand, identifies every sub-sequence of the appropriate length (fpsize), converts it to an integer,
-    identifies the number of reads mapping to that position, and outputs all of that information to a pandas HDF store."""
+    identifies the number of reads mapping to that position, and saves all of that information as an array of records sorted by sequence. If the
+    sketch prefilter is in use, only records that the sketch shows might be multimapping are kept."""
     (chrom, strand) = tup
     inbams = [pysam.Samfile(infile, 'rb') for infile in opts.bamfiles]
     gnd = BAMGenomeArray(inbams, mapping=FivePrimeMapFactory(psite))
@@ -115,45 +240,61 @@ def _get_tid_info(tup):
     # (on different transcripts) still end up mapping to the same place
     gnd.add_filter('size', SizeFilterFactory(opts.minlen, opts.maxlen))
 
-    tid_seq_info = []
+    sketch = np.load(sketch_file, mmap_mode='r') if opts.sketchmb > 0 else None
+    (nrecords, nkept, tid_seq_info) = (0, 0, [])
     tid_summary = pd.DataFrame(
-        {'chrom': chrom, 'strand': strand, 'n_psite': -1, 'n_reads': -1, 'peak_reads': -1, 'dropped': ''},
+        {'chrom': chrom, 'strand': strand, 'n_psite': -1, 'n_reads': np.nan, 'peak_reads': np.nan, 'dropped': ''},
         index=pd.Index(bedlinedict[(chrom, strand)].keys(), name='tid'))
-    for (tid, line) in bedlinedict[(chrom, strand)].iteritems():
-        currtrans = SegmentChain.from_bed(line)
-        curr_pos_list = currtrans.get_position_list()  # not in stranded order!
-        if strand == '-':
-            curr_pos_list = curr_pos_list[::-1]
-        n_psite = len(curr_pos_list) + 1 - fpsize
-        tid_summary.at[tid, 'n_psite'] = n_psite
-        if n_psite > 0:
-            curr_counts = np.array(currtrans.get_counts(gnd))[psite:n_psite + psite]
-            #                if((curr_counts>0).any()):
-            sumcounts = curr_counts.sum()
-            maxcounts = curr_counts.max()
-            tid_summary.at[tid, 'n_reads'] = sumcounts
-            tid_summary.at[tid, 'peak_reads'] = maxcounts
-            if sumcounts >= opts.minreads:
-                if maxcounts < sumcounts * opts.peakfrac:
-                    numseq = np.array(list(currtrans.get_sequence(genome).upper().translate(str_dict)))
-                    curr_seq = ''.join(numseq)
-                    tid_seq_info.append(pd.DataFrame({'tid': tid,
-                                                      'genpos': curr_pos_list[psite:n_psite + psite],
-                                                      'seq': np.array([(int(curr_seq[i:i + fpsize], 4) if 'N' not in curr_seq[i:i + fpsize] else -1)
-                                                                       for i in xrange(n_psite)], dtype=np.int64),
-                                                      'reads': curr_counts}))
+    transcripts = [(tid, SegmentChain.from_bed(line)) for (tid, line) in bedlinedict[(chrom, strand)].iteritems()]
+    for (cluster_start, cluster_end, cluster) in _overlap_clusters(transcripts):
+        # reads overlapping the cluster (of any length or strand) bound the reads on each of its transcripts, and are counted from the BAM index
+        # without mapping; in most annotations, many transcripts can be dropped for too few reads on this basis alone
+        if sum(inbam.count(chrom, cluster_start, cluster_end) for inbam in inbams if chrom in inbam.references) < opts.minreads:
+            cluster_counts = None
+        else:
+            # fetch and map the reads for all overlapping isoforms at once, as a dense array of counts across the cluster
+            cluster_counts = np.array(gnd.get(GenomicSegment(chrom, cluster_start, cluster_end, strand), roi_order=False))
+            if len(cluster_counts) != cluster_end - cluster_start:  # chromosome absent from the BAM files
+                cluster_counts = np.zeros(cluster_end - cluster_start)
+        for (tid, currtrans) in cluster:
+            curr_pos_list = currtrans.get_position_list()  # not in stranded order!
+            if strand == '-':
+                curr_pos_list = curr_pos_list[::-1]
+            n_psite = len(curr_pos_list) + 1 - fpsize
+            tid_summary.at[tid, 'n_psite'] = n_psite
+            if n_psite > 0 and cluster_counts is None:
+                tid_summary.at[tid, 'dropped'] = 'lowreads'  # n_reads and peak_reads are left at NaN, as they were never counted
+            elif n_psite > 0:
+                curr_counts = cluster_counts[np.array(curr_pos_list[psite:n_psite + psite]) - cluster_start]
+                #                if((curr_counts>0).any()):
+                sumcounts = curr_counts.sum()
+                maxcounts = curr_counts.max()
+                tid_summary.at[tid, 'n_reads'] = sumcounts
+                tid_summary.at[tid, 'peak_reads'] = maxcounts
+                if sumcounts >= opts.minreads:
+                    if maxcounts < sumcounts * opts.peakfrac:
+                        curr_seq_info = np.empty(n_psite, dtype=seq_info_dtype)
+                        _encode_transcript_kmers(curr_seq_info, currtrans)
+                        curr_seq_info['cs'] = chrom_strands.index((chrom, strand))
+                        curr_seq_info['genpos'] = curr_pos_list[psite:n_psite + psite]
+                        curr_seq_info['tid'] = tid_index[tid]
+                        curr_seq_info['reads'] = curr_counts
+                        curr_seq_info = curr_seq_info[curr_seq_info['seq'] >= 0]  # sequences with N's can't be compared
+                        nrecords += len(curr_seq_info)
+                        tid_seq_info.append(curr_seq_info if sketch is None else _sketch_candidates(curr_seq_info, sketch))
+                        nkept += len(tid_seq_info[-1])
+                    else:
+                        tid_summary.at[tid, 'dropped'] = 'peakfrac'
                 else:
-                    tid_summary.at[tid, 'dropped'] = 'peakfrac'
-            else:
-                tid_summary.at[tid, 'dropped'] = 'lowreads'
+                    tid_summary.at[tid, 'dropped'] = 'lowreads'
     if tid_seq_info:  # don't bother saving anything if there's nothing to save
-        pd.concat(tid_seq_info, ignore_index=True).to_hdf(seq_info_hdf % (chrom, strand), 'tid_seq_info', format='t',
-                                                          data_columns=True, complevel=1, complib='blosc')
-    #    sp.call(['ptrepack', orig_store_name, seq_info_hdf%(chrom,strand)])  # repack for efficiency
-    #    os.remove(orig_store_name)
+        tid_seq_info = np.concatenate(tid_seq_info)
+        np.save(seq_info_file % (chrom, strand), tid_seq_info[np.lexsort([tid_seq_info[seqcol] for seqcol in seqcols[::-1]])])
     if opts.verbose > 1:
         with log_lock:
-            logprint('%s (%s strand) complete' % (chrom, strand))
+            logprint('%s (%s strand) complete' % (chrom, strand) if sketch is None else
+                     '%s (%s strand) complete (%d of %d sequence positions retained as possible multimappers)'
+                     % (chrom, strand, nkept, nrecords))
 
     for inbam in inbams:
         inbam.close()
@@ -161,12 +302,21 @@ def _get_tid_info(tup):
     return tid_summary
 
 
+if opts.sketchmb > 0:
+    if opts.verbose:
+        logprint('Counting sub-sequences in count-min sketch')
+    workers = mp.Pool(opts.numproc)
+    workers.map(_sketch_chrom, chrom_strands)
+    workers.close()
+
 if opts.verbose:
     logprint('Parsing sequence and count information')
 
 workers = mp.Pool(opts.numproc)
-tid_summary = pd.concat(workers.map(_get_tid_info, bedlinedict.keys()))
+tid_summary = pd.concat(workers.map(_get_tid_info, chrom_strands))
 workers.close()
+if opts.sketchmb > 0 and not opts.keeptempfiles:
+    os.remove(sketch_file)
 
 if not (tid_summary['dropped'] == '').any():  # all transcripts dropped
     if not opts.keeptempfiles:
@@ -179,108 +329,97 @@ if not (tid_summary['dropped'] == '').any():  # all transcripts dropped
                      'MINREADS (currently %d) or increasing PEAKFRAC (currently %f), or check validity of input BAM file.'
                      % (len(tid_summary), lowreads_dropped, len(tid_summary)-lowreads_dropped, opts.minreads, opts.peakfrac))
 
+
 min_numseq = 0
-max_numseq = 4 ** fpsize
+max_numseq = 4 ** min(fpsize, MAX_KMER_WORD)
 
-npart = 64  # Divide sequences into this many separate dataframes based on sequence
-# E.g. if npart == 4, then one dataframe will handle 'A'-initiated sequences, one 'C', etc
+npart = 64  # Divide sequences into this many separate partitions based on sequence
+# E.g. if npart == 4, then one partition will handle 'A'-initiated sequences, one 'C', etc
 # This divides up the job naturally - because a sequence beginning with 'A' cannot multimap
 # with one beginning with 'T' etc
 
 partitions = np.ceil(np.linspace(min_numseq, max_numseq, npart + 1)).astype(np.int64)
 
-# outname_orig = os.path.join(temp_folder,'tid_seq_mm_part_%d_orig.h5')
-outname = os.path.join(temp_folder, 'tid_seq_mm_part_%d.h5')
+outname = os.path.join(temp_folder, 'tid_seq_mm_part_%d.npy')
 
 
 def _find_mm_in_range(partnum):
-    """Using the pandas HDF stores saved by _get_tid_info(), this function partitions reads based on their starting sequence, to divide up the
-    problem of identifying multimapping positions. Each set of partitioned reads is saved to its own pandas HDF store."""
-    seq_df = []
-    for (chrom, strand) in bedlinedict.keys():
-        fname = seq_info_hdf % (chrom, strand)
+    """Using the sorted arrays saved by _get_tid_info(), this function partitions k-mers based on their starting sequence, to divide up the
+    problem of identifying multimapping positions. Each partition is sliced by binary search from the memory-mapped arrays, and its multimapping
+    records are saved to their own file."""
+    seq_info = []
+    for (chrom, strand) in chrom_strands:
+        fname = seq_info_file % (chrom, strand)
         if os.path.isfile(fname):
-            seq_df.append(pd.read_hdf(fname, 'tid_seq_info', mode='r',
-                                      where="seq >= %d & seq < %d" % (partitions[partnum], partitions[partnum + 1])))
-            seq_df[-1]['chrom'] = chrom
-            seq_df[-1]['strand'] = strand
-    seq_df = pd.concat(seq_df, ignore_index=True)
-    # Only care if the multimap is to a different genomic position
-    uniqpos = seq_df.drop_duplicates(['chrom', 'strand', 'genpos', 'seq'])
-    # Now, if a sequence appears multiple times, it means it's a multimapper (differing in chrom, strand, or position)
-    seq_df = seq_df[seq_df['seq'].isin(uniqpos.loc[uniqpos['seq'].duplicated(), 'seq'].unique())]
-    seq_df.to_hdf(outname % partnum, 'tid_seq_mm', format='t',
-                  data_columns=True)  # save the result to avoid having to recalculate (after dropping pseudogenes)
-    # seq_df.to_hdf(outname_orig%partnum,'tid_seq_mm',format='t',data_columns=True)
-    # #  save the result to avoid having to recalculate (after dropping pseudogenes)
-    # sp.call(['ptrepack', outname_orig%partnum, outname%partnum])  # repack for efficiency
-    # os.remove(outname_orig%partnum)
-    mm_df = seq_df.groupby('tid').agg({'genpos': len, 'reads': np.sum})
+            curr_seq_info = np.load(fname, mmap_mode='r')
+            (lo, hi) = curr_seq_info['seq'].searchsorted(partitions[partnum:partnum + 2])
+            seq_info.append(np.array(curr_seq_info[lo:hi]))
+    seq_info = np.concatenate(seq_info) if seq_info else np.zeros(0, dtype=seq_info_dtype)
+    seq_info = find_mm(seq_info, seqcols)
+    np.save(outname % partnum, seq_info)  # save the sorted result, so that dropping pseudogenes only requires an incremental update
     if opts.verbose > 1:
         with log_lock:
             logprint('Partition %d of %d complete' % (partnum + 1, npart))
-    return mm_df
+    return sum_mm_by_tid(seq_info, len(tid_list))
+
+
+def _mm_df(mm_res):
+    """Combine the per-partition results of _find_mm_in_range() into a dataframe of multimapping positions and reads by transcript"""
+    (mm_psite, mm_reads) = [sum(x) for x in zip(*mm_res)]
+    return pd.DataFrame({'genpos': mm_psite, 'reads': mm_reads}, index=pd.Index(tid_list, name='tid'))
 
 
 if opts.verbose:
     logprint('Partitioning sequences to identify multimappers')
 
 workers = mp.Pool(opts.numproc)
-mm_df = workers.map(_find_mm_in_range, range(npart))
+mm_df_res = _mm_df(workers.map(_find_mm_in_range, range(npart)))
 workers.close()
-# Each dataframe in mm_df now contains the number of multimapping positions and reads, for sequences within that partition only
-# Need to add them together to get the results for all sequences
-mm_df_res = mm_df[0]
-for df in mm_df[1:]:
-    mm_df_res = mm_df_res.add(df, fill_value=0)  # this can handle empty dataframes (treated as all 0s), even if mm_df[0] is empty
+# Each partition contributes the number of multimapping positions and reads, for sequences within that partition only
+# These are added together to get the results for all sequences
 
 if not opts.keeptempfiles:
-    for (chrom, strand) in bedlinedict.keys():
+    for (chrom, strand) in chrom_strands:
         try:
-            os.remove(seq_info_hdf % (chrom, strand))  # no longer needed
+            os.remove(seq_info_file % (chrom, strand))  # no longer needed
         except OSError:
             pass  # some files may not exist, in which case...no problem
 
+
+def _add_mm_fracs(tid_info):
+    """Add the fractions of each transcript's reads and P-sites that are multimapping. Transcripts whose reads were never counted (n_reads is
+    NaN) or that have none are given a multimapping read fraction of 0, so that they are never dropped as pseudogenes or multimappers."""
+    tid_info['reads_mm_frac'] = (tid_info['mm_reads'] / tid_info['n_reads']).where(tid_info['n_reads'] > 0, 0.)
+    tid_info['psite_mm_frac'] = tid_info['mm_psite'] / tid_info['n_psite']
+
+
 tid_info = tid_summary[['chrom', 'strand', 'n_psite', 'n_reads']] \
     .join(mm_df_res.rename(columns={'genpos': 'mm_psite', 'reads': 'mm_reads'})) \
     .fillna({'mm_psite': 0,
              'mm_reads': 0})  # if a transcript isn't listed in mm_df_res, it doesn't have any multimapping positions
-tid_info['reads_mm_frac'] = tid_info['mm_reads'] / tid_info['n_reads']
-tid_info['psite_mm_frac'] = tid_info['mm_psite'] / tid_info['n_psite']
+_add_mm_fracs(tid_info)
 pseudos = tid_info.index[tid_info['reads_mm_frac'] > opts.pseudofrac].intersection(pd.Index(pseudotids))
 if pseudos.size > 0:
     tid_summary.loc[pseudos, 'dropped'] = 'pseudo'
-    kept_tids = tid_summary.index[tid_summary['dropped'] == '']
+    kept_tids = (tid_summary['dropped'] == '').reindex(tid_list).values
 
 
-    def _find_kept_mm_in_range(partnum):
-        """Load the multimapping positions on kept_tids from each partitioned dataframe"""
-        try:
-            seq_df = pd.read_hdf(outname % partnum, 'tid_seq_mm', mode='r')
-        except IOError:
-            return pd.DataFrame()
-        seq_df = seq_df[seq_df['tid'].isin(kept_tids)]
-        # Only care if the multimap is to a different genomic position
-        uniqpos = seq_df.drop_duplicates(['chrom', 'strand', 'genpos', 'seq'])
-        # Now, if a sequence appears multiple times, it means it's a multimapper (differing in chromosome, strand, and/or position)
-        seq_df = seq_df[seq_df['seq'].isin(uniqpos.loc[uniqpos['seq'].duplicated(), 'seq'].unique())]
-        return seq_df.groupby('tid').agg({'genpos': len, 'reads': np.sum})
+    def _find_lost_mm_in_range(partnum):
+        """Load the sorted multimapping records of each partition, and sum by transcript those that no longer count as multimapping among
+        kept_tids, as identified by find_lost_mm(). Partitions without dropped transcripts are unaffected and are not regrouped."""
+        return sum_mm_by_tid(find_lost_mm(np.load(outname % partnum, mmap_mode='r'), kept_tids, seqcols), len(tid_list))
 
 
     if opts.verbose:
-        logprint('Recalculating multimappers after eliminating pseudogenes')
+        logprint('Updating multimappers after eliminating pseudogenes')
     workers = mp.Pool(opts.numproc)
-    mm_df = workers.map(_find_kept_mm_in_range, range(npart))
+    mm_df_res -= _mm_df(workers.map(_find_lost_mm_in_range, range(npart)))
     workers.close()
-    mm_df_res = mm_df[0]
-    for df in mm_df[1:]:
-        mm_df_res = mm_df_res.add(df, fill_value=0)
     tid_info = tid_summary[['chrom', 'strand', 'n_psite', 'n_reads']] \
         .join(mm_df_res.rename(columns={'genpos': 'mm_psite', 'reads': 'mm_reads'})) \
         .fillna({'mm_psite': 0,
                  'mm_reads': 0})  # if a transcript isn't listed in mm_df_res, it doesn't have any multimapping positions, or it has been dropped
-    tid_info['reads_mm_frac'] = tid_info['mm_reads'] / tid_info['n_reads']
-    tid_info['psite_mm_frac'] = tid_info['mm_psite'] / tid_info['n_psite']
+    _add_mm_fracs(tid_info)
 
 if not opts.keeptempfiles:
     for partnum in xrange(npart):
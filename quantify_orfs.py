@@ -5,8 +5,10 @@ import os
 import sys
 from time import strftime
 import pysam
-from hashed_read_genome_array import HashedReadBAMGenomeArray, ReadKeyMapFactory, read_length_nmis  #, get_hashed_counts
+from hashed_read_genome_array import HashedReadBAMGenomeArray, HashedCountCacheGenomeArray, HashedEventIndexGenomeArray, ReadKeyMapFactory, \
+    read_length_nmis, count_cache_path, psite_index_path, get_hashed_count_array
 from plastid.genomics.roitools import SegmentChain, positionlist_to_segments
+from orf_store import read_table, table_chroms, open_store
 import multiprocessing as mp
 from scipy.optimize import nnls
 import numpy as np
@@ -32,6 +34,13 @@ parser.add_argument('--offsetfile', default='offsets.txt',
                          'in that directory. (Default: offsets.txt)')
 parser.add_argument('--max5mis', type=int, default=1, help='Maximum 5\' mismatches to trim. Reads with more than this number will be excluded. '
                                                            '(Default: 1)')
+parser.add_argument('--countcache', action='store_true',
+                    help='Read P-site counts from the caches generated by make_count_cache.py (one per BAMFILE, in SUBDIR) rather than fetching and '
+                         'mapping reads from BAMFILES. Caches must have been built using the same OFFSETFILE and MAX5MIS.')
+parser.add_argument('--psiteindex', action='store_true',
+                    help='Apply the offsets in OFFSETFILE to the P-site event indexes generated by make_psite_index.py (one alongside each '
+                         'BAMFILE) rather than fetching and mapping reads from BAMFILES. Unlike --countcache, indexes need not be rebuilt when '
+                         'OFFSETFILE or MAX5MIS change.')
 parser.add_argument('--startmask', type=int, nargs=2, default=[1, 2],
                     help='Region around start codons (in codons) to exclude from quantification. (Default: 1 2, meaning one full codon before the '
                          'start is excluded, as are the start codon and the codon following it).')
@@ -46,14 +55,21 @@ parser.add_argument('--ratingsfile', default='orfratings.h5',
 parser.add_argument('--minrating', type=float, default=0.8, help='Minimum ORF rating to require for an ORF to be quantified (Default: 0.8)')
 parser.add_argument('--minlen', type=int, default=0, help='Minimum ORF length (in amino acids) to be included in the BED file (Default: 0)')
 parser.add_argument('--quantfile', default='quant.h5',
-                    help='Filename to which to output the table of quantified translation values for each ORF. Formatted as pandas HDF; table name '
-                         'is "quant". If SUBDIR is set, this file will be placed in that directory. (Default: quant.h5)')
+                    help='Filename to which to output the table of quantified translation values for each ORF. Formatted as pandas HDF, or as a '
+                         'directory of Parquet files if the name ends in .parquet or .pq; table name is "quant". If SUBDIR is set, this file will be '
+                         'placed in that directory. (Default: quant.h5)')
 parser.add_argument('--CSV', help='If included, also write output in CSV format to the provided filename.')
 parser.add_argument('-v', '--verbose', action='count', help='Output a log of progress and timing (to stdout). Repeat for higher verbosity level.')
+parser.add_argument('--bamthreads', type=int, default=1,
+                    help='Number of threads used by each process to decompress each BAM file. Ignored with --countcache or --psiteindex. '
+                         '(Default: 1)')
 parser.add_argument('-p', '--numproc', type=int, default=1, help='Number of processes to run. Defaults to 1 but more recommended if available.')
 parser.add_argument('-f', '--force', action='store_true', help='Force file overwrite')
 opts = parser.parse_args()
 
+if opts.countcache and opts.psiteindex:
+    raise ValueError('--countcache and --psiteindex are mutually exclusive')
+
 offsetfilename = os.path.join(opts.subdir, opts.offsetfile)
 metafilename = os.path.join(opts.subdir, opts.metagenefile)
 quantfilename = os.path.join(opts.subdir, opts.quantfile)
@@ -95,8 +111,7 @@ rdlens.sort()
 with open(opts.inbed, 'rU') as inbed:
     bedlinedict = {line.split()[3]: line for line in inbed}
 
-with pd.HDFStore(opts.ratingsfile, mode='r') as ratingstore:
-    chroms = ratingstore.select('orfratings/meta/chrom/meta').values  # because saved as categorical, this is the list of all chromosomes
+chroms = table_chroms(opts.ratingsfile, 'orfratings')  # because saved as categorical (or partitioned), this is the list of all chromosomes
 
 if opts.verbose:
     logprint('Loading metagene')
@@ -153,8 +168,8 @@ def _quantify_tfam(orf_set, gnds):
         valid_nt_segs = SegmentChain(*positionlist_to_segments(chrom, strand, list(all_tfam_genpos[valid_nts])))
         orf_res['nts_quantified'] = (orf_matrix > 0).sum(0)  # the number of nucleotides included in the quantification
         for colname, gnd in zip(colnames, gnds):
-            orf_res[colname] = nnls(orf_matrix, valid_nt_segs.get_counts(gnd))[0]
-            # gnd is a HashedReadBAMGenomeArray, but it still works with get_counts(), which will collapse all read lengths to a single array
+            orf_res[colname] = nnls(orf_matrix, get_hashed_count_array(valid_nt_segs, gnd)[0].sum(0))[0]
+            # all read lengths are collapsed to a single array
         return orf_res
     else:
         orf_res['nts_quantified'] = 0
@@ -165,17 +180,23 @@ def _quantify_tfam(orf_set, gnds):
 
 def _quantify_chrom(chrom_to_do):
     """Applies _quantify_tfam() to all of the transcript families on a chromosome"""
-    chrom_orfs = pd.read_hdf(opts.ratingsfile, 'orfratings', mode='r',
-                             where="chrom == %r and orfrating >= %f and AAlen >= %d" % (chrom_to_do, opts.minrating, opts.minlen),
-                             columns=['orfname', 'tfam', 'tid', 'tcoord', 'tstop', 'AAlen', 'chrom', 'gcoord', 'gstop', 'strand',
-                                      'codon', 'orftype', 'annot_start', 'annot_stop', 'orfrating'])
+    chrom_orfs = read_table(opts.ratingsfile, 'orfratings', chrom_to_do, where="orfrating >= %f and AAlen >= %d" % (opts.minrating, opts.minlen),
+                            columns=['orfname', 'tfam', 'tid', 'tcoord', 'tstop', 'AAlen', 'chrom', 'gcoord', 'gstop', 'strand',
+                                     'codon', 'orftype', 'annot_start', 'annot_stop', 'orfrating'])
     if chrom_orfs.empty:
         if opts.verbose > 1:
             logprint('No ORFs found on %s' % chrom_to_do)
         return pd.DataFrame()
 
-    inbams = [pysam.Samfile(infile, 'rb') for infile in opts.bamfiles]
-    gnds = [HashedReadBAMGenomeArray([inbam], ReadKeyMapFactory(Pdict, read_length_nmis)) for inbam in inbams]
+    if opts.countcache:
+        inbams = []
+        gnds = [HashedCountCacheGenomeArray([count_cache_path(bamfile, opts.subdir)], Pdict) for bamfile in opts.bamfiles]
+    elif opts.psiteindex:
+        inbams = []
+        gnds = [HashedEventIndexGenomeArray([psite_index_path(bamfile)], Pdict) for bamfile in opts.bamfiles]
+    else:
+        inbams = [pysam.Samfile(infile, 'rb', threads=opts.bamthreads) for infile in opts.bamfiles]
+        gnds = [HashedReadBAMGenomeArray([inbam], ReadKeyMapFactory(Pdict, read_length_nmis)) for inbam in inbams]
 
     res = pd.concat([_quantify_tfam(tfam_set, gnds) for (tfam, tfam_set) in chrom_orfs.groupby('tfam')])
 
@@ -199,7 +220,8 @@ if opts.verbose:
 for catfield in ['chrom', 'strand', 'codon', 'orftype']:
     quant[catfield] = quant[catfield].astype('category')  # saves disk space and read/write time
 
-quant.to_hdf(quantfilename, 'quant', format='t', data_columns=True)
+with open_store(quantfilename, mode='w') as quantstore:
+    quantstore.put('quant', quant, format='t', data_columns=True)
 if opts.CSV:
     quant.to_csv(opts.CSV, index=False)
 
@@ -7,6 +7,7 @@ import numpy as np
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.model_selection import GridSearchCV, cross_val_score, StratifiedKFold
 from multiisotonic.multiisotonic import MultiIsotonicRegressor
+from orf_store import has_table, select_table, append_table, finish_table, open_store, store_exists
 import sys
 from time import strftime
 
@@ -33,9 +34,13 @@ parser.add_argument('--goldallcodons', action='store_true',
                          'performed on all ORFs, which may unfairly penalize non-ATG-initiated ORFs.')
 parser.add_argument('--goldminlen', type=int, default=100, help='Minimum length (in codons) for ORFs included in the training set (Default: 100)')
 parser.add_argument('--ratingsfile', default='orfratings.h5',
-                    help='Filename to which to output the final rating for each ORF. Formatted as pandas HDF (table name is "orfratings"). Columns '
-                         'include basic information, raw score from random forest, and final monotonized orf rating. For ORFs appearing on multiple '
-                         'transcripts, only one transcript will be selected for the table. (Default: orfratings.h5)')
+                    help='Filename to which to output the final rating for each ORF. Formatted as pandas HDF (table name is "orfratings"), or as '
+                         'a directory of Parquet files if the name ends in .parquet or .pq. Columns include basic information, raw score from random '
+                         'forest, and final monotonized orf rating. For ORFs appearing on multiple transcripts, only one transcript will be selected '
+                         'for the table. (Default: orfratings.h5)')
+parser.add_argument('--partitioned', action='store_true',
+                    help='Partition the table in RATINGSFILE by chromosome, as separate nodes listed in a manifest, so that quantify_orfs.py can '
+                         'read each chromosome sequentially on its own.')
 parser.add_argument('--CSV', help='If included, also write output in CSV format to the provided filename.')
 parser.add_argument('-v', '--verbose', action='store_true', help='Output a log of progress and timing (to stdout)')
 parser.add_argument('-p', '--numproc', type=int, default=1, help='Number of processes to run. Defaults to 1 but more recommended if available.')
@@ -51,12 +56,13 @@ if not opts.force:
 regressfiles = []
 colnames = []
 for regressfile in opts.regressfile:
-    if os.path.isfile(regressfile):
+    if store_exists(regressfile):
         regressfiles.append(regressfile)
         if not opts.names:
-            colnames.append(os.path.basename(regressfile).rpartition(os.path.extsep)[0])  # '/path/to/myfile.h5' -> 'myfile'
-    elif os.path.isdir(regressfile) and os.path.isfile(os.path.join(regressfile, 'regression.h5')):
-        regressfiles.append(os.path.join(regressfile, 'regression.h5'))
+            colnames.append(os.path.basename(regressfile.rstrip(os.path.sep)).rpartition(os.path.extsep)[0])  # '/path/to/myfile.h5' -> 'myfile'
+    elif os.path.isdir(regressfile) and any(store_exists(os.path.join(regressfile, name)) for name in ('regression.h5', 'regression.parquet')):
+        regressfiles.append(os.path.join(regressfile, 'regression.h5' if store_exists(os.path.join(regressfile, 'regression.h5'))
+                                         else 'regression.parquet'))
         if not opts.names:
             colnames.append(os.path.basename(regressfile.strip(os.path.sep)))  # '/path/to/mydir/' -> 'mydir'
     else:
@@ -84,20 +90,20 @@ allstops = pd.DataFrame(columns=['tfam', 'chrom', 'gstop', 'strand'])
 feature_columns = []
 stopcols = []
 for (regressfile, colname) in zip(regressfiles, colnames):
-    with pd.HDFStore(regressfile, mode='r') as instore:
-        if 'stop_strengths' in instore:
+    with open_store(regressfile) as instore:
+        if has_table(instore, 'stop_strengths'):
             stopcols.append(colname)
-            currstarts = instore.select('start_strengths', columns=['tfam', 'chrom', 'gcoord', 'strand', 'start_strength', 'W_start']) \
+            currstarts = select_table(instore, 'start_strengths', columns=['tfam', 'chrom', 'gcoord', 'strand', 'start_strength', 'W_start']) \
                 .rename(columns={'start_strength': 'str_start_'+colname, 'W_start': 'W_start_'+colname})
             currstarts['chrom'] = currstarts['chrom'].astype(str)  # strange bug when merging on categorical columns, so revert to str temporarily
             currstarts['strand'] = currstarts['strand'].astype(str)
             allstarts = allstarts.merge(currstarts, how='outer').fillna(0.)
 
-            allorfs = allorfs.append(instore.select('orf_strengths', columns=orf_columns), ignore_index=True).drop_duplicates('orfname')
+            allorfs = allorfs.append(select_table(instore, 'orf_strengths', columns=orf_columns), ignore_index=True).drop_duplicates('orfname')
             # This line not actually used for regression output beyond just which ORFs actually got a positive score in at least one regression
             # Safer to use concatenation and drop_duplicates rather than outer merges, in case one ORF somehow was assigned to different transcripts
 
-            currstops = instore.select('stop_strengths', columns=['tfam', 'chrom', 'gstop', 'strand', 'stop_strength', 'W_stop']) \
+            currstops = select_table(instore, 'stop_strengths', columns=['tfam', 'chrom', 'gstop', 'strand', 'stop_strength', 'W_stop']) \
                 .rename(columns={'stop_strength': 'str_stop_'+colname, 'W_stop': 'W_stop_'+colname})
             currstops['chrom'] = currstops['chrom'].astype(str)  # strange bug when merging on categorical columns, so revert to str temporarily
             currstops['strand'] = currstops['strand'].astype(str)
@@ -105,7 +111,7 @@ for (regressfile, colname) in zip(regressfiles, colnames):
 
             feature_columns.extend(['W_start_'+colname, 'W_stop_'+colname, 'str_stop_'+colname])
         else:
-            currstarts = instore.select('start_strengths', columns=['tfam', 'chrom', 'gcoord', 'strand', 'W_start']) \
+            currstarts = select_table(instore, 'start_strengths', columns=['tfam', 'chrom', 'gcoord', 'strand', 'W_start']) \
                 .rename(columns={'W_start': 'W_start_'+colname})
             currstarts['chrom'] = currstarts['chrom'].astype(str)  # strange bug when merging on categorical columns, so revert to str temporarily
             currstarts['strand'] = currstarts['strand'].astype(str)
@@ -208,7 +214,14 @@ if opts.verbose:
 for catfield in ['chrom', 'strand', 'codon', 'orftype']:
     orfratings[catfield] = orfratings[catfield].astype('category')  # saves disk space and read/write time
 
-orfratings.to_hdf(opts.ratingsfile, 'orfratings', format='t', data_columns=True)
+if opts.partitioned:
+    with open_store(opts.ratingsfile, mode='w') as ratingstore:
+        chrom_ids = {chrom: i for (i, chrom) in enumerate(orfratings['chrom'].cat.categories)}
+        append_table(ratingstore, 'orfratings', orfratings, chrom_ids)
+        finish_table(ratingstore, 'orfratings', chrom_ids)
+else:
+    with open_store(opts.ratingsfile, mode='w') as ratingstore:
+        ratingstore.put('orfratings', orfratings, format='t', data_columns=True)
 if opts.CSV:
     orfratings.to_csv(opts.CSV, index=False)
 
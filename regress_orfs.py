@@ -8,8 +8,10 @@ import numpy as np
 from scipy.optimize import nnls
 import scipy.sparse
 import multiprocessing as mp
-from hashed_read_genome_array import HashedReadBAMGenomeArray, ReadKeyMapFactory, read_length_nmis, get_hashed_counts
+from hashed_read_genome_array import HashedReadBAMGenomeArray, RegionCountCache, HashedCountCacheGenomeArray, HashedEventIndexGenomeArray, \
+    ReadKeyMapFactory, read_length_nmis, get_hashed_count_array, count_cache_path, psite_index_path
 from plastid.genomics.roitools import SegmentChain, positionlist_to_segments
+from orf_store import read_orfs, store_chroms, read_table, append_table, finish_table, open_store, store_exists
 import sys
 from time import strftime
 
@@ -43,10 +45,20 @@ parser.add_argument('--offsetfile', default='offsets.txt',
                          'in that directory. (Default: offsets.txt)')
 parser.add_argument('--max5mis', type=int, default=1, help='Maximum 5\' mismatches to trim. Reads with more than this number will be excluded.'
                                                            '(Default: 1)')
+parser.add_argument('--countcache', action='store_true',
+                    help='Read P-site counts from the caches generated by make_count_cache.py (one per BAMFILE, in SUBDIR) rather than fetching and '
+                         'mapping reads from BAMFILES. Caches must have been built using the same OFFSETFILE and MAX5MIS.')
+parser.add_argument('--psiteindex', action='store_true',
+                    help='Apply the offsets in OFFSETFILE to the P-site event indexes generated by make_psite_index.py (one alongside each '
+                         'BAMFILE) rather than fetching and mapping reads from BAMFILES. Unlike --countcache, indexes need not be rebuilt when '
+                         'OFFSETFILE or MAX5MIS change.')
 parser.add_argument('--regressfile', default='regression.h5',
                     help='Filename to which to output the table of regression scores for each ORF. Formatted as pandas HDF (tables generated include '
-                         '"start_strengths", "orf_strengths", and "stop_strengths"). If SUBDIR is set, this file will be placed in that directory. '
-                         '(Default: regression.h5)')
+                         '"start_strengths", "orf_strengths", and "stop_strengths"), or as a directory of Parquet files if the name ends in .parquet '
+                         'or .pq. If SUBDIR is set, this file will be placed in that directory. (Default: regression.h5)')
+parser.add_argument('--partitioned', action='store_true',
+                    help='Partition the tables in REGRESSFILE by chromosome, as separate nodes listed in a manifest. Each chromosome\'s results are '
+                         'written as soon as they are complete.')
 parser.add_argument('--startonly', action='store_true', help='Toggle for datasets collected in the presence of initiation inhibitor (e.g. HARR, '
                                                              'LTM). If selected, "stop_strengths" will not be calculated or saved.')
 parser.add_argument('--startrange', type=int, nargs=2, default=[1, 50],
@@ -69,12 +81,22 @@ parser.add_argument('--noregress', action='store_true', help='Only generate a me
 parser.add_argument('--exclude', nargs='+', help='Names of transcript families (tfams) to exclude from analysis due to excessive computational time '
                                                  'or memory footprint (e.g. TTN can be so large that the regression never finishes).')
 parser.add_argument('-v', '--verbose', action='count', help='Output a log of progress and timing (to stdout). Repeat for higher verbosity level.')
+parser.add_argument('--bamthreads', type=int, default=1,
+                    help='Number of threads used by each process to read BAM files, both to decompress each file and to fetch reads from '
+                         'multiple BAMFILES concurrently. Ignored with --countcache or --psiteindex. (Default: 1)')
+parser.add_argument('--cachemb', type=float, default=0,
+                    help='Memory (in MB) for each process to cache mapped P-sites by region, so that reads fetched for the metagene are not fetched '
+                         'and mapped again for the regression, nor for overlapping transcripts. Each chromosome is then handled by the same '
+                         'process in both passes. Ignored with --countcache or --psiteindex. (Default: 0, no cache)')
 parser.add_argument('-p', '--numproc', type=int, default=1, help='Number of processes to run. Defaults to 1 but more recommended if available.')
 parser.add_argument('-f', '--force', action='store_true',
                     help='Force file overwrite. This will overwrite both METAGENEFILE and REGRESSFILE, if they exist. To overwrite only REGRESSFILE '
                          '(and not the METAGENEFILE), do not invoke this option but simply delete REGRESSFILE.')
 opts = parser.parse_args()
 
+if opts.countcache and opts.psiteindex:
+    raise ValueError('--countcache and --psiteindex are mutually exclusive')
+
 offsetfilename = os.path.join(opts.subdir, opts.offsetfile)
 metafilename = os.path.join(opts.subdir, opts.metagenefile)
 regressfilename = os.path.join(opts.subdir, opts.regressfile)
@@ -92,9 +114,9 @@ if opts.restrictbystarts:
     if len(opts.minwstart) != len(opts.restrictbystarts):
         raise ValueError('--minwstart must be given same number of values as --restrictbystarts, or one value for all')
     for restrictbystart in opts.restrictbystarts:
-        if os.path.isfile(restrictbystart):
+        if store_exists(restrictbystart):
             restrictbystartfilenames.append(restrictbystart)
-        elif os.path.isdir(restrictbystart) and os.path.isfile(os.path.join(restrictbystart, opts.regressfile)):
+        elif os.path.isdir(restrictbystart) and store_exists(os.path.join(restrictbystart, opts.regressfile)):
             restrictbystartfilenames.append(os.path.join(restrictbystart, opts.regressfile))
         else:
             raise IOError('Regression file/directory %s not found' % restrictbystart)
@@ -127,31 +149,44 @@ with open(opts.inbed, 'rU') as inbed:
     bedlinedict = {line.split()[3]: line for line in inbed}
 
 
+# Each worker process inherits its own copy of the cache, which persists across all of the tasks (from both passes) that it runs
+region_cache = RegionCountCache(int(opts.cachemb*1048576)) if opts.cachemb > 0 and not (opts.countcache or opts.psiteindex) else None
+
+
+def _open_gnd():
+    """Open the read data, either from the BAM files or from their count caches or P-site event indexes. Returns the genome array and a list of
+    files to close."""
+    if opts.countcache:
+        return HashedCountCacheGenomeArray([count_cache_path(bamfile, opts.subdir) for bamfile in opts.bamfiles], Pdict), []
+    if opts.psiteindex:
+        return HashedEventIndexGenomeArray([psite_index_path(bamfile) for bamfile in opts.bamfiles], Pdict), []
+    inbams = [pysam.Samfile(infile, 'rb', threads=opts.bamthreads) for infile in opts.bamfiles]
+    return HashedReadBAMGenomeArray(inbams, ReadKeyMapFactory(Pdict, read_length_nmis), opts.bamthreads, region_cache), inbams
+
+
 def _get_annotated_counts_by_chrom(chrom_to_do):
     """Accumulate counts from annotated CDSs into a metagene profile. Only the longest CDS in each transcript family will be included, and only if it
     meets the minimum number-of-reads requirement. Reads are normalized by gene, so every gene included contributes equally to the final metagene."""
-    found_cds = pd.read_hdf(opts.orfstore, 'all_orfs', mode='r',
-                            where="chrom == '%s' and orftype == 'annotated' and tstop > 0 and tcoord > %d and AAlen > %d"
-                                  % (chrom_to_do, -startnt[0], min_AAlen),
-                            columns=['orfname', 'tfam', 'tid', 'tcoord', 'tstop', 'AAlen']) \
+    found_cds = read_orfs(opts.orfstore, chrom_to_do, where="orftype == 'annotated' and AAlen > %d" % min_AAlen,
+                          link_where="tstop > 0 and tcoord > %d" % -startnt[0],
+                          columns=['orfname', 'tfam', 'tid', 'tcoord', 'tstop', 'AAlen']) \
         .sort_values('AAlen', ascending=False).drop_duplicates('tfam')  # use the longest annotated CDS in each transcript family
     num_cds_incl = 0  # number of CDSs included from this chromosome
     startprof = np.zeros((len(rdlens), startlen))
     cdsprof = np.zeros((len(rdlens), 3))
     stopprof = np.zeros((len(rdlens), stoplen))
-    inbams = [pysam.Samfile(infile, 'rb') for infile in opts.bamfiles]
-    gnd = HashedReadBAMGenomeArray(inbams, ReadKeyMapFactory(Pdict, read_length_nmis))
+    (gnd, inbams) = _open_gnd()
 
     for (tid, tcoord, tstop) in found_cds[['tid', 'tcoord', 'tstop']].itertuples(False):
         curr_trans = SegmentChain.from_bed(bedlinedict[tid])
         tlen = curr_trans.get_length()
         if tlen >= tstop + stopnt[1]:  # need to guarantee that the 3' UTR is sufficiently long
-            curr_hashed_counts = get_hashed_counts(curr_trans, gnd)
+            (curr_hashed_counts, key_idx) = get_hashed_count_array(curr_trans, gnd)
             cdslen = tstop+stopnt[1]-tcoord-startnt[0]  # cds length, plus the extra bases...
             curr_counts = np.zeros((len(rdlens), cdslen))
             for (i, rdlen) in enumerate(rdlens):
                 for nmis in range(opts.max5mis+1):
-                    curr_counts[i, :] += curr_hashed_counts[(rdlen, nmis)][tcoord+startnt[0]:tstop+stopnt[1]]
+                    curr_counts[i, :] += curr_hashed_counts[key_idx[(rdlen, nmis)], tcoord+startnt[0]:tstop+stopnt[1]]
                     # curr_counts is limited to the CDS plus any extra requested nucleotides on either side
             if curr_counts.sum() >= opts.mincdsreads:
                 curr_counts /= curr_counts.mean()  # normalize by mean of counts across all readlengths and positions within the CDS
@@ -221,11 +256,11 @@ def _regress_tfam(orf_set, gnd):
     nnt = len(all_tfam_genpos)
     tid_indices = {tid: np.flatnonzero(np.in1d(all_tfam_genpos, list(curr_tid_genpos), assume_unique=True))
                    for (tid, curr_tid_genpos) in tid_genpos.iteritems()}
-    hashed_counts = get_hashed_counts(tfam_segs, gnd)
+    (hashed_counts, key_idx) = get_hashed_count_array(tfam_segs, gnd)
     counts = np.zeros((len(rdlens), nnt), dtype=np.float64)  # even though they are integer-valued, will need to do float arithmetic
     for (i, rdlen) in enumerate(rdlens):
         for nmis in range(1+opts.max5mis):
-            counts[i, :] += hashed_counts[(rdlen, nmis)]
+            counts[i, :] += hashed_counts[key_idx[(rdlen, nmis)]]
     counts = counts.ravel()
 
     if opts.startcount:
@@ -353,9 +388,9 @@ def _regress_tfam(orf_set, gnd):
 
 def _regress_chrom(chrom_to_do):
     """Applies _regress_tfam() to all of the transcript families on a chromosome"""
-    chrom_orfs = pd.read_hdf(opts.orfstore, 'all_orfs', mode='r', where="chrom == %r and tstop > 0 and tcoord > 0" % chrom_to_do,
-                             columns=['orfname', 'tfam', 'tid', 'tcoord', 'tstop', 'AAlen', 'chrom', 'gcoord', 'gstop', 'strand',
-                                      'codon', 'orftype', 'annot_start', 'annot_stop'])
+    chrom_orfs = read_orfs(opts.orfstore, chrom_to_do, link_where="tstop > 0 and tcoord > 0",
+                           columns=['orfname', 'tfam', 'tid', 'tcoord', 'tstop', 'AAlen', 'chrom', 'gcoord', 'gstop', 'strand',
+                                    'codon', 'orftype', 'annot_start', 'annot_stop'])
     # tcoord > 0 removes ORFs where the first codon is an NTG, to avoid an indexing error
     # Those ORFs would never get called anyway since they couldn't possibly have any reads at their start codon
 
@@ -366,8 +401,8 @@ def _regress_chrom(chrom_to_do):
         restrictedstarts = pd.DataFrame()
         for (restrictbystart, minw) in zip(restrictbystartfilenames, opts.minwstart):
             restrictedstarts = restrictedstarts.append(
-                pd.read_hdf(restrictbystart, 'start_strengths', mode='r', where="(chrom == %r) & (W_start > minw)" % chrom_to_do,
-                            columns=['tfam', 'chrom', 'gcoord', 'strand']), ignore_index=True).drop_duplicates()
+                read_table(restrictbystart, 'start_strengths', chrom_to_do, where="W_start > %r" % minw,
+                           columns=['tfam', 'chrom', 'gcoord', 'strand']), ignore_index=True).drop_duplicates()
         chrom_orfs = chrom_orfs.merge(restrictedstarts)  # inner merge acts as a filter
 
     if chrom_orfs.empty:
@@ -376,8 +411,7 @@ def _regress_chrom(chrom_to_do):
                 logprint('No ORFs found on %s' % chrom_to_do)
         return failure_return
 
-    inbams = [pysam.Samfile(infile, 'rb') for infile in opts.bamfiles]
-    gnd = HashedReadBAMGenomeArray(inbams, ReadKeyMapFactory(Pdict, read_length_nmis))
+    (gnd, inbams) = _open_gnd()
 
     res = tuple([pd.concat(res_dfs) for res_dfs in zip(*[_regress_tfam(tfam_set, gnd) for (tfam, tfam_set) in chrom_orfs.groupby('tfam')])])
 
@@ -386,12 +420,56 @@ def _regress_chrom(chrom_to_do):
 
     if opts.verbose > 1:
         with log_lock:
-            logprint('%s complete' % chrom_to_do)
+            logprint('%s complete' % chrom_to_do if region_cache is None
+                     else '%s complete (region cache: %s)' % (chrom_to_do, region_cache.summary()))
 
     return res
 
-with pd.HDFStore(opts.orfstore, mode='r') as orfstore:
-    chroms = orfstore.select('all_orfs/meta/chrom/meta').values  # because saved as categorical, this is the list of all chromosomes
+
+def _with_globals((func, chrom_to_do, curr_globals)):
+    """Update the module globals of a worker process and apply func to chrom_to_do. Allows the same worker, with its own region cache, to run
+    both the metagene and regression passes for a chromosome, even though the metagene is only known after the worker is started."""
+    globals().update(curr_globals)
+    return func(chrom_to_do)
+
+
+def _assign_chroms(nworkers):
+    """Assign each chromosome to one of nworkers workers, balancing the number of transcripts each will handle"""
+    ntrans = dict.fromkeys(chroms, 0)
+    for line in bedlinedict.itervalues():
+        chrom = line.split(None, 1)[0]
+        if chrom in ntrans:
+            ntrans[chrom] += 1
+    loads = [0]*nworkers
+    assignment = {}
+    for chrom in sorted(chroms, key=lambda x: ntrans[x], reverse=True):  # largest first, each to the least-loaded worker
+        worker = loads.index(min(loads))
+        assignment[chrom] = worker
+        loads[worker] += ntrans[chrom]
+    return assignment
+
+
+def _map_chroms(func, curr_globals):
+    """Apply func to every chromosome in chroms on worker processes, yielding the results in order (as would Pool.imap()). Without a region
+    cache, each pass uses a new pool, which inherits the current module globals. With one, each chromosome always goes to the same worker
+    (see worker_pools), along with the globals in curr_globals that were set after that worker was started."""
+    if region_cache is None:
+        workers = mp.Pool(opts.numproc)
+        for res in workers.imap(func, chroms):
+            yield res
+        workers.close()
+    else:
+        if not worker_pools:
+            worker_pools.extend(mp.Pool(1) for _ in xrange(opts.numproc))
+            chrom_workers.update(_assign_chroms(opts.numproc))
+        async_res = [worker_pools[chrom_workers[chrom]].apply_async(_with_globals, ((func, chrom, curr_globals),)) for chrom in chroms]
+        for res in async_res:
+            yield res.get()
+
+
+chroms = store_chroms(opts.orfstore)  # because saved as categorical, this is the list of all chromosomes
+worker_pools = []  # with a region cache, single-process pools started on first use and kept for both passes
+chrom_workers = {}  # index into worker_pools of the worker handling each chromosome
 
 if os.path.isfile(metafilename) and not opts.force:
     if opts.verbose:
@@ -422,9 +500,8 @@ else:
     startlen = startnt[1]-startnt[0]
     stoplen = stopnt[1]-stopnt[0]
 
-    workers = mp.Pool(opts.numproc)
-    (startprof, cdsprof, stopprof, num_cds_incl) = [sum(x) for x in zip(*workers.map(_get_annotated_counts_by_chrom, chroms))]
-    workers.close()
+    metagene_globals = {'startnt': startnt, 'stopnt': stopnt, 'min_AAlen': min_AAlen, 'startlen': startlen, 'stoplen': stoplen}
+    (startprof, cdsprof, stopprof, num_cds_incl) = [sum(x) for x in zip(*_map_chroms(_get_annotated_counts_by_chrom, metagene_globals))]
 
     startprof /= num_cds_incl  # technically not necessary, but helps for consistency of units across samples
     cdsprof /= num_cds_incl
@@ -446,10 +523,26 @@ catfields = ['chrom', 'strand', 'codon', 'orftype']
 if not opts.noregress:
     if opts.verbose:
         logprint('Calculating regression results by chromosome')
-    workers = mp.Pool(opts.numproc)
-    if opts.startonly:
+    regress_globals = {'startnt': startnt, 'stopnt': stopnt, 'startprof': startprof, 'cdsprof': cdsprof, 'stopprof': stopprof}
+    if opts.partitioned:
+        tables = ['orf_strengths', 'start_strengths'] if opts.startonly else ['orf_strengths', 'start_strengths', 'stop_strengths']
+        chrom_ids = {chrom: i for (i, chrom) in enumerate(chroms)}
+        with open_store(regressfilename, mode='w') as outstore:
+            for chrom_res in _map_chroms(_regress_chrom, regress_globals):
+                for (table, res_df) in zip(tables, chrom_res):
+                    if not res_df.empty:
+                        res_df = res_df.reset_index()
+                        for catfield in catfields:
+                            if catfield in res_df.columns:
+                                res_df[catfield] = res_df[catfield].astype('category')  # saves disk space and read/write time
+                        append_table(outstore, table, res_df, chrom_ids)
+            if opts.verbose:
+                logprint('Saving partition manifests')
+            for table in tables:
+                finish_table(outstore, table, chrom_ids)
+    elif opts.startonly:
         (orf_strengths, start_strengths) = \
-            [pd.concat(res_dfs).reset_index() for res_dfs in zip(*workers.map(_regress_chrom, chroms))]
+            [pd.concat(res_dfs).reset_index() for res_dfs in zip(*_map_chroms(_regress_chrom, regress_globals))]
         if opts.verbose:
             logprint('Saving results')
         for catfield in catfields:
@@ -457,12 +550,12 @@ if not opts.noregress:
                 start_strengths[catfield] = start_strengths[catfield].astype('category')  # saves disk space and read/write time
             if catfield in orf_strengths.columns:
                 orf_strengths[catfield] = orf_strengths[catfield].astype('category')  # saves disk space and read/write time
-        with pd.HDFStore(regressfilename, mode='w') as outstore:
+        with open_store(regressfilename, mode='w') as outstore:
             outstore.put('orf_strengths', orf_strengths, format='t', data_columns=True)
             outstore.put('start_strengths', start_strengths, format='t', data_columns=True)
     else:
         (orf_strengths, start_strengths, stop_strengths) = \
-            [pd.concat(res_dfs).reset_index() for res_dfs in zip(*workers.map(_regress_chrom, chroms))]
+            [pd.concat(res_dfs).reset_index() for res_dfs in zip(*_map_chroms(_regress_chrom, regress_globals))]
         if opts.verbose:
             logprint('Saving results')
         for catfield in catfields:
@@ -472,11 +565,13 @@ if not opts.noregress:
                 orf_strengths[catfield] = orf_strengths[catfield].astype('category')  # saves disk space and read/write time
             if catfield in stop_strengths.columns:
                 stop_strengths[catfield] = stop_strengths[catfield].astype('category')  # saves disk space and read/write time
-        with pd.HDFStore(regressfilename, mode='w') as outstore:
+        with open_store(regressfilename, mode='w') as outstore:
             outstore.put('orf_strengths', orf_strengths, format='t', data_columns=True)
             outstore.put('start_strengths', start_strengths, format='t', data_columns=True)
             outstore.put('stop_strengths', stop_strengths, format='t', data_columns=True)
-    workers.close()
+
+for pool in worker_pools:
+    pool.close()
 
 if opts.verbose:
     logprint('Tasks complete')
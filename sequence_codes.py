@@ -0,0 +1,114 @@
+import itertools
+import numpy as np
+
+IUPAC_TABLE_DNA = {"A": "A",
+                   "C": "C",
+                   "T": "T",
+                   "U": "T",
+                   "G": "G",
+                   "N": ("A", "C", "T", "G"),
+                   "R": ("A", "G"),     # puRines
+                   "Y": ("C", "T"),     # pYrimidines
+                   "S": ("G", "C"),     # Strong binding
+                   "W": ("A", "T"),     # Weak binding
+                   "K": ("G", "T"),
+                   "M": ("A", "C"),
+                   "B": ("C", "G", "T"),
+                   "D": ("A", "G", "T"),
+                   "H": ("A", "C", "T"),
+                   "V": ("A", "C", "G")}
+
+BASE_CODES = np.full(256, 4, dtype=np.int64)  # code of each base in a codon, by ASCII value; 4 for anything other than ACGT
+for (code, base) in enumerate('ACGT'):
+    BASE_CODES[ord(base)] = code
+
+KMER_BASE_CODES = np.full(256, 4, dtype=np.int64)  # 2-bit code of each base (of either case), by ASCII value; 4 for anything other than ACGT
+for (code, base) in enumerate('ACGT'):
+    KMER_BASE_CODES[ord(base)] = code
+    KMER_BASE_CODES[ord(base.lower())] = code
+
+
+def encode_kmers(seq, k):
+    """Encode every k-mer (k <= 31) of a sequence as an integer, 2 bits per base, exactly as int(kmer, 4) would after converting ACGT to 0123.
+    K-mers containing any other base (e.g. N) are encoded as -1. Rather than looping over k-mers, codes for windows of doubling length are built
+    by shifting and combining arrays, and concatenated according to the binary representation of k.
+
+    Parameters
+    ----------
+    seq : str
+        Sequence to encode
+
+    k : int
+        Length of each k-mer
+
+    Returns
+    -------
+    :py:class:`numpy.ndarray`
+        Code of the k-mer starting at each position of `seq` (len(seq) + 1 - k of them)
+    """
+    codes = KMER_BASE_CODES[np.frombuffer(seq, dtype=np.uint8)]
+    nkmers = len(codes) + 1 - k
+    n_invalid = np.concatenate(([0], np.cumsum(codes > 3)))
+    block = np.where(codes > 3, 0, codes)  # block[i] encodes seq[i:i+block_len]
+    block_len = 1
+    keys = np.zeros(nkmers, dtype=np.int64)  # keys[i] encodes seq[i:i+width]
+    width = 0
+    remaining = k
+    while remaining:
+        if remaining & 1:
+            keys = (keys << 2*block_len) | block[width:width+nkmers]
+            width += block_len
+        remaining >>= 1
+        if remaining:
+            block = (block[:-block_len] << 2*block_len) | block[block_len:]
+            block_len *= 2
+    keys[n_invalid[k:] > n_invalid[:nkmers]] = -1
+    return keys
+
+
+def codon_table(codons, nucleotide_table=IUPAC_TABLE_DNA):
+    """Convert codons of IUPAC nucleotide characters to a lookup table of codon codes (as computed by codon_codes())
+    Ambiguous IUPAC characters match each of the corresponding bases, and T and U are considered equivalent.
+
+    Parameters
+    ----------
+    codons : list
+        Codons (3 nucleotides each) using IUPAC nucleotide codes
+
+    Returns
+    -------
+    :py:class:`numpy.ndarray`
+        Boolean array, True at the code of each codon matching any of `codons`
+    """
+    table = np.zeros(125, dtype=np.bool)
+    for codon in codons:
+        for bases in itertools.product(*[nucleotide_table[ch] for ch in codon.upper()]):
+            table[sum(BASE_CODES[ord(base)] * 5 ** (2 - i) for (i, base) in enumerate(bases))] = True
+    return table
+
+
+def codon_codes(myseq):
+    """Encode the codon beginning at each position of a sequence as an integer (base 5, so that codons containing anything other than ACGT
+    have codes of their own, which never match)"""
+    bases = BASE_CODES[np.frombuffer(myseq, dtype=np.uint8)]
+    return bases[:-2] * 25 + bases[1:-1] * 5 + bases[2:]
+
+
+def find_all_orfs(myseq, start_codons, stop_codons):
+    """Identify ORFs, or at least starts.
+    Returns list of (start, stop, codon), where stop == 0 if no valid stop codon is present and codon is e.g. 'ATG'.
+    Starts and stops are defined by start_codons and stop_codons, respectively, as tables from codon_table(). The sequence is encoded once,
+    and the next in-frame stop codon at or after every position is found with one backward pass over each frame, so that each start's stop
+    is a lookup.
+    """
+    if len(myseq) < 3:
+        return []
+    codes = codon_codes(myseq)
+    ncodons = len(codes)
+    # next_stop[i] is the end of the first stop codon in frame with i at or after i, or 0 if there is none
+    next_stop = np.where(stop_codons[codes], np.arange(3, ncodons + 3), ncodons + 3)
+    for frame in xrange(3):
+        next_stop[frame::3] = np.minimum.accumulate(next_stop[frame::3][::-1])[::-1]
+    next_stop[next_stop > ncodons + 2] = 0
+    return [(i, stop, myseq[i:i+3]) for (i, stop) in zip(np.flatnonzero(start_codons[codes]).tolist(),
+                                                         next_stop[start_codons[codes]].tolist())]
@@ -0,0 +1,268 @@
+import numpy as np
+import pytest
+import hashed_read_genome_array
+import os
+from hashed_read_genome_array import map_psites, ReadKeyMapFactory, read_length, read_length_nmis, HashedReadBAMGenomeArray, RegionCountCache, \
+    count_read_keys, key_totals_path
+from plastid.genomics.roitools import GenomicSegment
+
+
+class FakeRead(object):
+    """The parts of :py:class:`pysam.AlignedSegment` used to map reads"""
+
+    def __init__(self, blocks, is_reverse=False, md=None):
+        self._blocks = blocks
+        self.is_reverse = is_reverse
+        self._md = md if md is not None else str(sum(end - start for (start, end) in blocks))
+
+    @property
+    def positions(self):
+        return [pos for (start, end) in self._blocks for pos in xrange(start, end)]
+
+    def get_blocks(self):
+        return list(self._blocks)
+
+    def opt(self, tag):
+        assert tag == 'MD'
+        return self._md
+
+
+class FakeSegment(object):
+    def __init__(self, start, end):
+        (self.start, self.end) = (start, end)
+
+    def __len__(self):
+        return self.end - self.start
+
+
+def _map_psites_by_read(reads, offset_dict, read_key_fun):
+    """P-site of each read as mapped by the original ReadKeyMapFactory(), one read at a time"""
+    res = []
+    for read in reads:
+        read_key = read_key_fun(read)
+        if read_key in offset_dict:
+            offset = offset_dict[read_key]
+            if not read.is_reverse:
+                p_site = read.positions[offset]
+            else:
+                p_site = read.positions[-offset - 1]
+            res.append((read_key, p_site, read.is_reverse))
+    return res
+
+
+def _map_psites_in_batches(reads, offset_dict, read_key_fun, strand='.'):
+    read_keys = offset_dict.keys()
+    (key_nums, p_sites, is_reverse) = map_psites(reads, offset_dict, read_key_fun, read_keys, strand)
+    return [(read_keys[key_num], p_site, rev) for (key_num, p_site, rev) in zip(key_nums.tolist(), p_sites.tolist(), is_reverse.tolist())]
+
+
+READS = [FakeRead([(100, 128)]),
+         FakeRead([(100, 128)], is_reverse=True),
+         FakeRead([(200, 210), (300, 318)]),  # spliced
+         FakeRead([(200, 210), (300, 318)], is_reverse=True),
+         FakeRead([(50, 55), (60, 61), (70, 92)]),  # several blocks, one of a single base
+         FakeRead([(50, 55), (60, 61), (70, 92)], is_reverse=True),
+         FakeRead([(400, 430)]),  # length not in any offset_dict
+         FakeRead([(0, 28)]),
+         FakeRead([(500, 529)], is_reverse=True)]
+
+
+@pytest.mark.parametrize('offset_dict', [{28: 12, 29: 12}, {28: 0, 29: 27}, {28: -1, 29: -3}, {28: -28, 29: 14}, {28: 27, 29: -29}, {29: 5}])
+def test_map_psites_read_length(offset_dict):
+    assert _map_psites_in_batches(READS, offset_dict, read_length) == _map_psites_by_read(READS, offset_dict, read_length)
+
+
+NMIS_READS = [FakeRead([(100, 130)], md='0A0C28'),  # two 5' mismatches
+              FakeRead([(100, 130)], is_reverse=True, md='28A0C0'),
+              FakeRead([(100, 130)], md='5A24'),  # a mismatch, but not at the 5' end
+              FakeRead([(100, 130)], is_reverse=True, md='0A29'),  # 5' end of a reverse read is the 3' end of the MD tag
+              FakeRead([(200, 210), (300, 319)], md='0N28'),
+              FakeRead([(200, 210), (300, 319)], is_reverse=True, md='27G0T0'),
+              FakeRead([(0, 28)], md='28')]
+
+
+@pytest.mark.parametrize('offset_dict', [{(28, 0): 12, (28, 1): 13, (28, 2): 14}, {(28, 2): -1, (28, 1): -2, (28, 0): 0}, {(27, 2): 3}])
+def test_map_psites_read_length_nmis(offset_dict):
+    assert _map_psites_in_batches(NMIS_READS, offset_dict, read_length_nmis) == _map_psites_by_read(NMIS_READS, offset_dict, read_length_nmis)
+
+
+def test_map_psites_arbitrary_key():
+    def read_key_fun(read):
+        return 'long' if len(read.positions) > 28 else 'short'
+    offset_dict = {'long': -2, 'short': 4}
+    assert _map_psites_in_batches(READS, offset_dict, read_key_fun) == _map_psites_by_read(READS, offset_dict, read_key_fun)
+
+
+def test_map_psites_strand():
+    offset_dict = {28: 12, 29: 12}
+    for (strand, rev) in [('+', False), ('-', True)]:
+        assert _map_psites_in_batches(READS, offset_dict, read_length, strand) == \
+            [x for x in _map_psites_by_read(READS, offset_dict, read_length) if x[2] == rev]
+
+
+def test_map_psites_across_batches(monkeypatch):
+    monkeypatch.setattr(hashed_read_genome_array, 'MAP_BATCH_SIZE', 2)
+    offset_dict = {28: -5, 29: 7}
+    reads = READS * 3
+    assert _map_psites_in_batches(reads, offset_dict, read_length) == _map_psites_by_read(reads, offset_dict, read_length)
+    assert _map_psites_in_batches(reads[:4], offset_dict, read_length) == _map_psites_by_read(reads[:4], offset_dict, read_length)
+
+
+@pytest.mark.parametrize('offset', [28, -29])
+def test_map_psites_offset_beyond_read(offset):
+    reads = [FakeRead([(100, 128)])]
+    with pytest.raises(IndexError):
+        _map_psites_by_read(reads, {28: offset}, read_length)
+    with pytest.raises(IndexError):
+        _map_psites_in_batches(reads, {28: offset}, read_length)
+
+
+def test_read_key_map_counts():
+    offset_dict = {28: -3, 29: 12}
+    seg = FakeSegment(95, 320)
+    count_dict = ReadKeyMapFactory(offset_dict)(READS, seg)
+    expected = {key: np.zeros(len(seg)) for key in offset_dict}
+    for (key, p_site, _) in _map_psites_by_read(READS, offset_dict, read_length):
+        if seg.start <= p_site < seg.end:
+            expected[key][p_site - seg.start] += 1
+    assert sorted(count_dict) == sorted(expected)
+    for key in expected:
+        assert (count_dict[key] == expected[key]).all()
+
+
+class FakeBamFile(object):
+    """The parts of :py:class:`pysam.AlignmentFile` used to fetch reads"""
+
+    def __init__(self, filename, reads):
+        self.filename = filename
+        self._reads = reads
+
+    def fetch(self, reference=None, start=None, end=None):
+        if reference is None:
+            return list(self._reads)
+        assert reference == 'chr1'
+        return [read for read in self._reads if any(block_start < end and start < block_end for (block_start, block_end) in read.get_blocks())]
+
+    def close(self):
+        pass
+
+
+def _fake_gnd(bamfiles, offset_dict, region_cache=None, read_key_fun=read_length):
+    """HashedReadBAMGenomeArray over fake BAM files, skipping the BAMGenomeArray setup that needs real ones"""
+    gnd = HashedReadBAMGenomeArray.__new__(HashedReadBAMGenomeArray)
+    (gnd.bamfiles, gnd.map_fn, gnd.fetch_threads, gnd.region_cache, gnd._filters, gnd._chroms) = \
+        (bamfiles, ReadKeyMapFactory(offset_dict, read_key_fun), 1, region_cache, {}, ['chr1'])
+    (gnd._normalize, gnd._normalize_per_key, gnd._sum, gnd._hashed_sum) = (False, False, None, None)
+    return gnd
+
+
+def _sorted_psites(psites):
+    (key_nums, p_sites, weights) = psites
+    order = np.lexsort((key_nums, p_sites))
+    return key_nums[order].tolist(), p_sites[order].tolist(), weights[order].tolist()
+
+
+def test_region_cache_matches_mapping():
+    rng = np.random.RandomState(0)
+    bamfiles = []
+    for filename in ['rep1.bam', 'rep2.bam']:
+        reads = []
+        for _ in xrange(300):
+            start = rng.randint(0, 2000)
+            if rng.rand() < 0.2:  # spliced
+                reads.append(FakeRead([(start, start + 10), (start + 60, start + 78 + rng.randint(2))], is_reverse=rng.rand() < 0.5))
+            else:
+                reads.append(FakeRead([(start, start + 28 + rng.randint(2))], is_reverse=rng.rand() < 0.5))
+        bamfiles.append(FakeBamFile(filename, reads))
+    offset_dict = {28: 12, 29: 13}
+    region_cache = RegionCountCache(4000)  # small enough to evict
+    (uncached, cached) = (_fake_gnd(bamfiles, offset_dict), _fake_gnd(bamfiles, offset_dict, region_cache))
+    for _ in xrange(200):
+        start = rng.randint(0, 2100)
+        roi = GenomicSegment('chr1', start, start + rng.randint(1, 400), '+-'[rng.randint(2)])
+        assert _sorted_psites(cached._map_region_cached(roi)) == _sorted_psites(uncached._map_region(roi))
+    assert region_cache.hits > 0 and region_cache.partial_hits > 0 and region_cache.evictions > 0
+    assert region_cache.nbytes <= region_cache.max_bytes
+    # cached regions never overlap
+    for regions in region_cache._regions.itervalues():
+        assert all(end <= next_start for ((_, end), (next_start, _)) in zip(regions[:-1], regions[1:]))
+
+    # a different mapping is cached separately
+    other = _fake_gnd(bamfiles, {28: -3, 29: 5}, region_cache)
+    roi = GenomicSegment('chr1', 100, 900, '+')
+    assert _sorted_psites(other._map_region_cached(roi)) == _sorted_psites(_fake_gnd(bamfiles, {28: -3, 29: 5})._map_region(roi))
+
+
+def test_region_cache_lookup():
+    region_cache = RegionCountCache(1 << 20)
+    psites = (np.array([0, 1, 0]), np.array([105, 110, 119]), np.ones(3))
+    region_cache.put('chr1', '+', 100, 120, 'map', psites)
+    region_cache.put('chr1', '+', 150, 160, 'map', (np.array([1]), np.array([155]), np.ones(1)))
+    (cached, gaps) = region_cache.lookup('chr1', '+', 110, 170, 'map')
+    assert [x[1].tolist() for x in cached] == [[110, 119], [155]]
+    assert gaps == [(120, 150), (160, 170)]
+    (cached, gaps) = region_cache.lookup('chr1', '+', 105, 111, 'map')
+    assert [x[1].tolist() for x in cached] == [[105, 110]] and gaps == []
+    for (strand, mapping_id) in [('-', 'map'), ('+', 'other')]:
+        assert region_cache.lookup('chr1', strand, 100, 120, mapping_id) == ([], [(100, 120)])
+    assert (region_cache.hits, region_cache.partial_hits, region_cache.misses) == (1, 1, 2)
+
+
+@pytest.mark.parametrize('read_key_fun', [read_length, read_length_nmis, lambda read: read.is_reverse])
+def test_count_read_keys(read_key_fun):
+    reads = READS + NMIS_READS
+    expected = {}
+    for read in reads:
+        expected[read_key_fun(read)] = expected.get(read_key_fun(read), 0) + 1
+    assert count_read_keys(reads, read_key_fun) == expected
+    assert count_read_keys(reads, read_key_fun, [lambda read: not read.is_reverse]) == \
+        count_read_keys([read for read in reads if not read.is_reverse], read_key_fun)
+
+
+def test_hashed_sum_saved_next_to_bam(tmpdir):
+    bamfiles = []
+    for (i, reads) in enumerate([READS, NMIS_READS]):
+        bamfile = str(tmpdir.join('rep%d.bam' % i))
+        open(bamfile, 'w').close()
+        os.utime(bamfile, (0, 0))
+        bamfiles.append(FakeBamFile(bamfile, reads))
+    offset_dict = {(28, 0): 12, (28, 1): 13, (30, 0): 14, (30, 2): 15, (31, 0): 3}
+    expected = {key: sum(1 for read in READS + NMIS_READS if read_length_nmis(read) == key) for key in offset_dict}
+    assert _fake_gnd(bamfiles, offset_dict, read_key_fun=read_length_nmis).hashed_sum() == expected
+    for bamfile in bamfiles:
+        assert os.path.isfile(key_totals_path(bamfile.filename, read_length_nmis))
+
+    # saved totals are used rather than recounted, unless older than the BAM file
+    bamfiles[0]._reads = READS[:2]
+    assert _fake_gnd(bamfiles, offset_dict, read_key_fun=read_length_nmis).hashed_sum() == expected
+    os.utime(bamfiles[0].filename, None)
+    gnd = _fake_gnd(bamfiles, offset_dict, read_key_fun=read_length_nmis)
+    assert gnd.hashed_sum() == {key: sum(1 for read in READS[:2] + NMIS_READS if read_length_nmis(read) == key) for key in offset_dict}
+
+    # filtered totals are counted but not saved, and are recounted when filters change
+    gnd.add_filter('forward', lambda read: not read.is_reverse)
+    assert gnd.hashed_sum() == {key: sum(1 for read in READS[:2] + NMIS_READS if read_length_nmis(read) == key and not read.is_reverse)
+                                for key in offset_dict}
+    gnd.remove_filter('forward')
+    assert gnd.hashed_sum() == _fake_gnd(bamfiles, offset_dict, read_key_fun=read_length_nmis).hashed_sum()
+
+
+def test_normalize_per_key(tmpdir):
+    bamfile = str(tmpdir.join('rep1.bam'))
+    open(bamfile, 'w').close()
+    bamfiles = [FakeBamFile(bamfile, READS * 3)]
+    offset_dict = {28: 12, 29: 12, 31: 0}
+    roi = GenomicSegment('chr1', 0, 600, '.')
+    gnd = _fake_gnd(bamfiles, offset_dict)
+    (key_nums, p_sites, weights) = gnd.get_hashed_psites(roi)
+    totals = gnd.hashed_sum()
+    assert totals == {28: 21, 29: 3, 31: 0}
+    gnd.set_normalize(True, per_key=True)
+    (norm_key_nums, norm_p_sites, norm_weights) = gnd.get_hashed_psites(roi)
+    assert (norm_key_nums == key_nums).all() and (norm_p_sites == p_sites).all()
+    assert np.allclose(norm_weights, weights*1.0e6/np.array([totals[key] for key in gnd.read_keys])[key_nums])
+    for (key, counts) in gnd.get_reads_and_hashed_counts(roi)[1].iteritems():
+        assert counts.sum() == pytest.approx(1.0e6 if totals[key] else 0)
+    gnd.set_sum(1000)
+    gnd.set_normalize(True)
+    assert np.allclose(gnd.get_hashed_psites(roi)[2], weights*1000)
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+from multimappers import find_mm, sum_mm_by_tid, find_lost_mm
+
+
+def _dtype(seqcols):
+    return [(seqcol, np.int64) for seqcol in seqcols] + [('cs', np.int32), ('genpos', np.int64), ('tid', np.int32), ('reads', np.float64)]
+
+
+def _records(rows, seqcols):
+    """Records from (seq, cs, genpos, tid, reads) tuples, with the sequence repeated in every sequence field"""
+    res = np.zeros(len(rows), dtype=_dtype(seqcols))
+    for (i, (seq, cs, genpos, tid, reads)) in enumerate(rows):
+        for seqcol in seqcols:
+            res[seqcol][i] = seq
+        (res['cs'][i], res['genpos'][i], res['tid'][i], res['reads'][i]) = (cs, genpos, tid, reads)
+    return res
+
+
+def _random_partitions(rng, seqcols, ntids, nparts):
+    """Partitions of records as prune_transcripts.py saves them, each for its own sequences: every sequence occurs at one or more positions, and
+    each position is covered by one or more transcripts"""
+    (parts, genpos) = ([], 0)
+    for partnum in xrange(nparts):
+        rows = []
+        for seq in xrange(partnum * 100, partnum * 100 + rng.randint(1, 30)):
+            for _ in xrange(rng.randint(1, 4)):
+                genpos += rng.randint(1, 50)
+                cs = rng.randint(2)
+                for tid in rng.choice(ntids, size=rng.randint(1, 4), replace=False):
+                    rows.append((seq, cs, genpos, tid, rng.randint(0, 10)))
+        records = _records(rows, seqcols)
+        parts.append(records[rng.permutation(len(records))])
+    return parts
+
+
+def _summed(sums):
+    return [sum(x) for x in zip(*sums)]
+
+
+@pytest.mark.parametrize('seqcols', [['seq'], ['seq', 'seq2']])
+def test_find_lost_mm_random(seqcols):
+    rng = np.random.RandomState(0)
+    ntids = 12
+    for _ in xrange(20):
+        mm_parts = [find_mm(part, seqcols) for part in _random_partitions(rng, seqcols, ntids, 4)]
+        kept_tids = rng.rand(ntids) < 0.7
+        (mm_psite, mm_reads) = _summed(sum_mm_by_tid(mm_part, ntids) for mm_part in mm_parts)
+        (lost_psite, lost_reads) = _summed(sum_mm_by_tid(find_lost_mm(mm_part, kept_tids, seqcols), ntids) for mm_part in mm_parts)
+        (kept_psite, kept_reads) = _summed(sum_mm_by_tid(find_mm(mm_part[kept_tids[mm_part['tid']]], seqcols), ntids) for mm_part in mm_parts)
+        assert np.allclose(mm_psite - lost_psite, kept_psite)
+        assert np.allclose(mm_reads - lost_reads, kept_reads)
+        assert (kept_psite[~kept_tids] == 0).all()
+
+
+def test_find_lost_mm_no_longer_multimapping():
+    seqcols = ['seq']
+    records = _records([(1, 0, 10, 0, 5),  # seq 1 at two positions, one of them only on transcript 1, which is dropped
+                        (1, 0, 20, 1, 3),
+                        (2, 0, 30, 0, 1),  # seq 2 at two positions, one of them on transcript 1 and also on transcript 2, which is kept
+                        (2, 0, 40, 1, 2),
+                        (2, 0, 40, 2, 4),
+                        (3, 0, 50, 0, 1),  # seq 3 at three positions, one of them only on transcript 1
+                        (3, 1, 50, 1, 1),
+                        (3, 1, 60, 2, 1),
+                        (4, 0, 70, 0, 1),  # seq 4 at one position only, so never multimapping
+                        (4, 0, 70, 1, 1)], seqcols)
+    mm_seq_info = find_mm(records, seqcols)
+    assert set(mm_seq_info['seq']) == {1, 2, 3}
+    kept_tids = np.array([True, False, True])
+    lost = find_lost_mm(mm_seq_info, kept_tids, seqcols)
+    assert sorted(zip(lost['seq'], lost['genpos'], lost['tid'])) == [(1, 10, 0), (1, 20, 1), (2, 40, 1), (3, 50, 1)]
+    (lost_psite, lost_reads) = sum_mm_by_tid(lost, 3)
+    assert (lost_psite == [1, 3, 0]).all() and (lost_reads == [5, 6, 0]).all()
+    assert len(find_lost_mm(mm_seq_info, np.ones(3, dtype=np.bool), seqcols)) == 0
@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+import pytest
+from orf_store import ORF_COLUMNS, orf_basename, normalize_orfs, write_names, append_table, finish_table, open_store, read_orfs, iter_orfs
+
+pytest.importorskip('pyarrow')  # the stores are written with the columnar backend, which needs no HDF5 libraries
+
+
+def _tfam_orfs(rng, tfam, chrom, ntids, norfs):
+    """ORF entries for a made-up transcript family, with every ORF on a random subset of its transcripts"""
+    rows = []
+    for orf_num in xrange(norfs):
+        (gcoord, AAlen) = (rng.randint(0, 100000), rng.randint(1, 500))
+        orfname = orf_basename(tfam, gcoord, AAlen) + ('_%d' % orf_num if orf_num % 5 == 4 else '')  # some with name suffixes
+        for tid_num in sorted(rng.choice(ntids, size=rng.randint(1, ntids+1), replace=False)):
+            tcoord = rng.randint(0, 1000)
+            rows.append((tfam, '%s_t%d' % (tfam, tid_num), tcoord, tcoord + 3*AAlen + 3, chrom, gcoord, gcoord + 3*AAlen + 3, '+', 'ATG', AAlen,
+                         orfname, False, False, 'new'))
+    return pd.DataFrame(rows, columns=ORF_COLUMNS)
+
+
+def _write_store(path, tfam_dfs, partitioned, normalized, chunksize):
+    """Write ORF entries the way find_orfs_and_types.py does, appending a few tfams at a time"""
+    chroms = sorted({df['chrom'].iat[0] for df in tfam_dfs})
+    chrom_ids = {chrom: i for (i, chrom) in enumerate(chroms)} if partitioned else None
+    tfam_names = sorted(df['tfam'].iat[0] for df in tfam_dfs)
+    tid_names = sorted({tid for df in tfam_dfs for tid in df['tid']})
+    (tfam_ids, tid_ids) = ({tfam: i for (i, tfam) in enumerate(tfam_names)}, {tid: i for (i, tid) in enumerate(tid_names)})
+    (nwritten, norfs) = (0, 0)
+    with open_store(path, mode='w') as store:
+        for i in xrange(0, len(tfam_dfs), chunksize):
+            chunk = pd.concat(tfam_dfs[i:i+chunksize], ignore_index=True)
+            chunk.index += nwritten
+            chunk['chrom'] = pd.Categorical(chunk['chrom'], categories=chroms)
+            if normalized:
+                (orf_table, link_table) = normalize_orfs(chunk, tfam_ids, tid_ids, norfs)
+                append_table(store, 'orfs', orf_table, chrom_ids, index=False)
+                append_table(store, 'orf_tids', link_table, chrom_ids, index=False)
+                norfs += len(orf_table)
+            else:
+                append_table(store, 'all_orfs', chunk, chrom_ids, index=False)
+            nwritten += len(chunk)
+        for table in (['orfs', 'orf_tids'] if normalized else ['all_orfs']):
+            finish_table(store, table, chrom_ids)
+        if normalized:
+            write_names(store, tfam_names, tid_names)
+
+
+def _sorted_entries(df):
+    return df[ORF_COLUMNS].astype({'chrom': str}).sort_values(['orfname', 'tid']).reset_index(drop=True)
+
+
+@pytest.mark.parametrize('partitioned', [False, True])
+@pytest.mark.parametrize('normalized', [False, True])
+def test_iter_orfs(tmpdir, partitioned, normalized):
+    rng = np.random.RandomState(0)
+    tfam_dfs = [_tfam_orfs(rng, 'tfam%d' % i, 'chr%d' % rng.randint(3), rng.randint(1, 4), rng.randint(1, 20)) for i in xrange(25)]
+    path = str(tmpdir.join('orf.parquet'))
+    _write_store(path, tfam_dfs, partitioned, normalized, 3)
+    max_tfam_rows = max(len(df) for df in tfam_dfs)
+    for chroms in [None, {'chr0', 'chr2'}]:
+        for chunkrows in [20, 150, 100000]:
+            pieces = list(iter_orfs(path, chroms, chunkrows))
+            assert all(len(piece) < chunkrows + max_tfam_rows for piece in pieces)
+            tfams_seen = [tfam for piece in pieces for tfam in piece['tfam'].unique()]
+            assert len(tfams_seen) == len(set(tfams_seen))  # no tfam split between pieces
+            expected = read_orfs(path)
+            if chroms is not None:
+                expected = expected[expected['chrom'].isin(chroms)]
+            pd.testing.assert_frame_equal(_sorted_entries(pd.concat(pieces, ignore_index=True)), _sorted_entries(expected))
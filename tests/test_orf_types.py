@@ -0,0 +1,116 @@
+import pytest
+from plastid.genomics.roitools import Transcript
+from sequence_codes import codon_table
+from orf_types import identify_tfam_orfs
+
+START_CODONS = codon_table(['ATG'])
+STOP_CODONS = codon_table(['TAG', 'TAA', 'TGA'])
+
+
+def _bed_line(name, strand, blocks, thick=None):
+    """BED12 line on chr1 for a feature made of (start, end) blocks, coding between the (start, end) of thick if given"""
+    blocks = sorted(blocks)
+    (start, end) = (blocks[0][0], blocks[-1][1])
+    (thick_start, thick_end) = thick if thick else (start, start)
+    return '\t'.join(['chr1', str(start), str(end), name, '0', strand, str(thick_start), str(thick_end), '0', str(len(blocks)),
+                      ','.join(str(block_end - block_start) for (block_start, block_end) in blocks) + ',',
+                      ','.join(str(block_start - start) for (block_start, _) in blocks) + ',']) + '\n'
+
+
+def _merge(blocks):
+    """Merge overlapping or touching blocks, as in the BED line of a tfam"""
+    merged = []
+    for (start, end) in sorted(blocks):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _orftypes(genomelen, motifs, transcripts, cdss, strand):
+    """Identify the ORFs of a made-up tfam with identify_tfam_orfs(), and return the orftype at each (tid, tcoord). The tfam is described on the
+    plus strand, as ATG and TAA motifs placed at genomic positions in a sequence of Cs (which contains neither), and transcripts and annotated
+    CDSs given as exon blocks; on the minus strand, every coordinate is mirrored, so that the transcript sequences and ORFs are unchanged."""
+    genome = ['C'] * genomelen
+    for (pos, motif) in motifs:
+        genome[pos:pos+len(motif)] = motif
+    genome = ''.join(genome)
+
+    def _stranded(blocks):
+        return blocks if strand == '+' else [(genomelen - end, genomelen - start) for (start, end) in blocks]
+
+    tfam_trans = []
+    for (tid, blocks) in sorted(transcripts.iteritems()):
+        tseq = ''.join(genome[start:end] for (start, end) in sorted(blocks))
+        tfam_trans.append((tid, Transcript.from_bed(_bed_line(tid, strand, _stranded(blocks))), tseq))
+    annot_bedlines = [(0, tid, _bed_line(tid, strand, _stranded(transcripts[tid]), _stranded([thick])[0]))
+                      for (tid, thick) in sorted(cdss.iteritems())]
+    tfam_bedline = _bed_line('tfam', strand, _merge(_stranded(sum(transcripts.values(), []))))
+    tfam_orfs = identify_tfam_orfs('tfam', tfam_bedline, tfam_trans, annot_bedlines, START_CODONS, STOP_CODONS)
+    return {(tid, tcoord): orftype for (tid, tcoord, orftype) in tfam_orfs[['tid', 'tcoord', 'orftype']].itertuples(False)}
+
+
+# One transcript with a CDS from 200 to 320 (in frame 2), and ORFs around it in every frame
+SINGLE_MOTIFS = [(20, 'ATG'), (50, 'TAA'), (100, 'ATG'), (110, 'ATG'), (150, 'ATG'), (200, 'ATG'), (210, 'TAA'), (231, 'ATG'), (252, 'TAA'),
+                 (260, 'ATG'), (295, 'ATG'), (317, 'TAA'), (340, 'TAA'), (400, 'ATG'), (430, 'TAA'), (580, 'ATG')]
+SINGLE_TYPES = {20: 'upstream',  # stops at 53
+                100: 'LOOF',  # out of frame, stops at 343
+                110: 'extension',
+                150: 'start_overlap',  # out of frame, stops at 213
+                200: 'annotated',
+                231: 'internal',  # out of frame, stops at 255
+                260: 'truncation',
+                295: 'stop_overlap',  # out of frame, stops at 343
+                400: 'downstream',  # stops at 433
+                580: 'nonstop'}
+
+
+@pytest.mark.parametrize('strand', ['+', '-'])
+def test_single_transcript_types(strand):
+    orftypes = _orftypes(600, SINGLE_MOTIFS, {'t1': [(0, 600)]}, {'t1': (200, 320)}, strand)
+    assert orftypes == {('t1', tcoord): orftype for (tcoord, orftype) in SINGLE_TYPES.iteritems()}
+
+
+@pytest.mark.parametrize('strand', ['+', '-'])
+def test_unannotated_tfam_types(strand):
+    orftypes = _orftypes(600, SINGLE_MOTIFS, {'t1': [(0, 600)]}, {}, strand)
+    assert orftypes == {('t1', tcoord): ('nonstop' if orftype == 'nonstop' else 'new') for (tcoord, orftype) in SINGLE_TYPES.iteritems()}
+
+
+# Isoforms of a transcript with exons E1, E2, and E4, and a CDS from 50 (in E1) to 633 (in E4), which is in frame with genomic position 201 in E2
+ISOFORM_EXONS = {'E1': (0, 100), 'E7': (120, 170), 'E2': (200, 300), 'G': (250, 350), 'E3': (400, 500), 'E6': (520, 570), 'E4': (600, 700),
+                 'E5': (800, 850), 'E8': (900, 950)}
+ISOFORM_TRANSCRIPTS = {'annot': ['E1', 'E2', 'E4'],
+                       'xiso': ['E1', 'E3', 'E4'],  # E3 is as long as E2, so the same start reaches the same stop
+                       'ciso': ['E1', 'E2', 'E5'],  # stop at 803 in E5
+                       'niso': ['E6', 'E4'],  # start at 540 in E6, in frame with the annotated stop
+                       'nciso': ['E7', 'E2', 'E8'],  # start at 141 in E7, in frame with the CDS through E2, stop at 909 in E8
+                       'giso': ['G']}  # start at 280 out of frame with the CDS in E2, and an ORF from 320 to 335 in the intron after it
+ISOFORM_MOTIFS = [(50, 'ATG'), (141, 'ATG'), (280, 'ATG'), (310, 'TAA'), (320, 'ATG'), (332, 'TAA'), (540, 'ATG'), (630, 'TAA'), (803, 'TAA'),
+                  (909, 'TAA')]
+ISOFORM_TYPES = {('annot', 50): 'annotated',
+                 ('xiso', 50): 'Xiso',
+                 ('ciso', 50): 'Ciso',
+                 ('niso', 20): 'Niso',
+                 ('nciso', 21): 'NCiso',
+                 ('giso', 30): 'Giso',
+                 ('giso', 70): 'new_iso'}
+
+
+@pytest.mark.parametrize('strand', ['+', '-'])
+def test_isoform_types(strand):
+    transcripts = {tid: [ISOFORM_EXONS[exon] for exon in exons] for (tid, exons) in ISOFORM_TRANSCRIPTS.iteritems()}
+    orftypes = _orftypes(1200, ISOFORM_MOTIFS, transcripts, {'annot': (50, 633)}, strand)
+    assert {key: orftypes[key] for key in ISOFORM_TYPES} == ISOFORM_TYPES
+    assert set(orftypes.values()) - set(ISOFORM_TYPES.values()) == {'nonstop'}  # the start at 280 on transcripts through all of E2
+
+
+@pytest.mark.parametrize('strand', ['+', '-'])
+def test_spliced_isoform_types(strand):
+    transcripts = {'cds1': [(0, 60), (100, 160)],
+                   'cds2': [(200, 260), (300, 360)],
+                   'siso': [(0, 60), (300, 360)]}  # the start of the first CDS, spliced in frame to the stop of the second
+    orftypes = _orftypes(400, [(10, 'ATG'), (140, 'TAA'), (210, 'ATG'), (322, 'TAA')], transcripts,
+                         {'cds1': (10, 143), 'cds2': (210, 325)}, strand)
+    assert orftypes == {('cds1', 10): 'annotated', ('cds2', 10): 'annotated', ('siso', 10): 'Siso'}
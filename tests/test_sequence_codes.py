@@ -0,0 +1,85 @@
+import re
+import string
+import numpy as np
+import pytest
+from sequence_codes import IUPAC_TABLE_DNA, encode_kmers, codon_table, codon_codes, find_all_orfs
+
+KMER_TRANSLATION = string.maketrans('ACGT', '0123')
+
+
+def _encode_kmers_by_slicing(seq, k):
+    """Encoding of every k-mer as in the original prune_transcripts.py, one slice and int() call at a time"""
+    numseq = seq.upper().translate(KMER_TRANSLATION)
+    return np.array([int(numseq[i:i+k], 4) if 'N' not in numseq[i:i+k] else -1 for i in xrange(len(seq) + 1 - k)], dtype=np.int64)
+
+
+@pytest.mark.parametrize('seq', ['ACGT', 'TTTTTTTT', 'NACGTACGTN', 'NNNNNNNN', 'ACGTNACGTACGTNNACGT', 'acgtNACGTacgt'])
+@pytest.mark.parametrize('k', [1, 2, 3, 4, 7, 8])
+def test_encode_kmers_edge_cases(seq, k):
+    if k <= len(seq):
+        assert (encode_kmers(seq, k) == _encode_kmers_by_slicing(seq, k)).all()
+
+
+@pytest.mark.parametrize('k', [1, 5, 16, 29, 30, 31])
+def test_encode_kmers_random(k):
+    rng = np.random.RandomState(k)
+    for _ in xrange(20):
+        seq = ''.join(rng.choice(list('ACGTN'), size=rng.randint(k, 200), p=[.24, .24, .24, .24, .04]))
+        assert (encode_kmers(seq, k) == _encode_kmers_by_slicing(seq, k)).all()
+
+
+def test_encode_kmers_whole_sequence():
+    seq = 'T' * 31
+    assert encode_kmers(seq, 31).tolist() == [4 ** 31 - 1]
+    assert encode_kmers('ACGTN', 5).tolist() == [-1]
+
+
+def _seq_to_regex(inp, nucleotide_table=IUPAC_TABLE_DNA):
+    """IUPAC codons to a regular expression, as in the original find_orfs_and_types.py"""
+    out = []
+    for ch in inp.upper():
+        if len(nucleotide_table.get(ch, ch)) == 1:
+            out.append(ch)
+        else:
+            out.append("["+"".join(nucleotide_table.get(ch, ch))+"]")
+    return re.compile("".join(out))
+
+
+def _find_all_orfs_by_regex(myseq, codons):
+    """ORF finding as in the original find_orfs_and_types.py, matching regular expressions at every position"""
+    (start_re, stop_re) = (_seq_to_regex('|'.join(codons)), re.compile(r'(?:...)*?(?:TAG|TAA|TGA)'))
+    result = []
+    for i in range(len(myseq)-2):
+        if start_re.match(myseq[i:i+3]):
+            m = stop_re.match(myseq[i:])
+            if m:
+                result.append((i, m.end()+i, myseq[i:i+3]))
+            else:
+                result.append((i, 0, myseq[i:i+3]))
+    return result
+
+
+CODON_SETS = [['ATG'], ['NTG'], ['ATG', 'CTG', 'GTG'], ['RTG'], ['ATG', 'TAG']]
+
+
+def test_codon_codes():
+    assert codon_codes('ACGTN').tolist() == [0*25 + 1*5 + 2, 1*25 + 2*5 + 3, 2*25 + 3*5 + 4]
+    assert len(codon_codes('AC')) == 0
+    assert codon_table(['NTG']).sum() == 4
+    assert not codon_table(['NTG'])[codon_codes('NTG')].any()  # an N in the sequence is not a wildcard
+
+
+@pytest.mark.parametrize('codons', CODON_SETS)
+@pytest.mark.parametrize('seq', ['', 'A', 'AT', 'ATG', 'TAG', 'TAGATGTAA', 'ATGTAA', 'ATGATGATG', 'CATGAAATAGTGA', 'ATGNNNTAA', 'NTGATNTGA',
+                                 'ATGCTGTTGAATGAACTAG', 'NNNNNN', 'ATGA', 'TGATGTAGTGA'])
+def test_find_all_orfs_edge_cases(seq, codons):
+    assert find_all_orfs(seq, codon_table(codons), codon_table(['TAG', 'TAA', 'TGA'])) == _find_all_orfs_by_regex(seq, codons)
+
+
+@pytest.mark.parametrize('codons', CODON_SETS)
+def test_find_all_orfs_random(codons):
+    rng = np.random.RandomState(len(''.join(codons)))
+    (start_codons, stop_codons) = (codon_table(codons), codon_table(['TAG', 'TAA', 'TGA']))
+    for _ in xrange(50):
+        seq = ''.join(rng.choice(list('ACGTN'), size=rng.randint(0, 300), p=[.3, .2, .2, .27, .03]))
+        assert find_all_orfs(seq, start_codons, stop_codons) == _find_all_orfs_by_regex(seq, codons)
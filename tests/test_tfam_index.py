@@ -0,0 +1,160 @@
+import itertools
+from collections import defaultdict
+import numpy as np
+import pytest
+from tfam_index import bed_blocks, build_tfam_exon_index, find_cds_tfams, cluster_exons
+
+
+def _bed_line(name, chrom, strand, blocks):
+    """BED12 line for a feature made of (start, end) blocks"""
+    blocks = sorted(blocks)
+    (start, end) = (blocks[0][0], max(block_end for (_, block_end) in blocks))
+    return '\t'.join([chrom, str(start), str(end), name, '0', strand, str(start), str(end), '0', str(len(blocks)),
+                      ','.join(str(block_end - block_start) for (block_start, block_end) in blocks) + ',',
+                      ','.join(str(block_start - start) for (block_start, _) in blocks) + ',']) + '\n'
+
+
+def _find_cds_tfams_by_pairs(cdsbedlines, tfambedlines):
+    """Pairs of overlapping CDSs and tfams as reported by `bedtools intersect -split -s -wa -wb` in the original find_orfs_and_types.py,
+    comparing every block of every CDS with every block of every tfam"""
+    res = set()
+    for line in cdsbedlines:
+        (chrom, strand, starts, ends) = bed_blocks(line)
+        for (tfam, tfam_line) in tfambedlines.iteritems():
+            (tfam_chrom, tfam_strand, tfam_starts, tfam_ends) = bed_blocks(tfam_line)
+            if (tfam_chrom, tfam_strand) == (chrom, strand) and \
+                    any(start < tfam_end and tfam_start < end for (start, end) in zip(starts, ends)
+                        for (tfam_start, tfam_end) in zip(tfam_starts, tfam_ends)):
+                res.add((tfam, line.split()[3]))
+    return res
+
+
+TFAMS = {'long': _bed_line('long', 'chr1', '+', [(100, 1000)]),
+         'nested': _bed_line('nested', 'chr1', '+', [(200, 220), (400, 450)]),  # within the long tfam, so found only via the running maximum
+         'spliced': _bed_line('spliced', 'chr1', '+', [(1100, 1200), (1500, 1600), (1900, 2000)]),
+         'minus': _bed_line('minus', 'chr1', '-', [(100, 300)]),
+         'other': _bed_line('other', 'chr2', '+', [(0, 50)])}
+
+CDS_CASES = [[(300, 310)],  # within the nested tfam's span, but only the long tfam's blocks
+             [(205, 210)],
+             [(990, 1010), (1190, 1210)],  # overlapping runs across the end of one tfam and an exon of the next
+             [(1000, 1100)],  # touches the ends of blocks on either side without overlapping
+             [(1200, 1500)],  # entirely within an intron
+             [(1150, 1160), (1950, 1960)],  # intron spans an exon of the tfam, but the blocks overlap others
+             [(1210, 1220), (1580, 1590)],
+             [(1210, 1220), (1880, 1890)],  # blocks in the tfam's introns, and intron over its exon: no overlap
+             [(0, 100)],
+             [(0, 101)],
+             [(5000, 5100)]]
+
+
+@pytest.mark.parametrize('strand', ['+', '-'])
+@pytest.mark.parametrize('blocks', CDS_CASES)
+def test_find_cds_tfams_edge_cases(blocks, strand):
+    cdsbedlines = [_bed_line('cds', 'chr1', strand, blocks)]
+    res = find_cds_tfams(cdsbedlines, build_tfam_exon_index(TFAMS))
+    assert len(res) == len(set(res))
+    assert set(res) == _find_cds_tfams_by_pairs(cdsbedlines, TFAMS)
+
+
+def test_find_cds_tfams_overlapping_cdss():
+    cdsbedlines = [_bed_line('cds%d' % i, 'chr1', '+', blocks) for (i, blocks) in enumerate(CDS_CASES)] + \
+                  [_bed_line('cds_chr2', 'chr2', '+', [(10, 20)]), _bed_line('cds_chr3', 'chr3', '+', [(10, 20)]),
+                   'chr1\t180\t210\tcds_bed6\t0\t+\n']
+    res = find_cds_tfams(cdsbedlines, build_tfam_exon_index(TFAMS))
+    cds_nums = [[line.split()[3] for line in cdsbedlines].index(tid) for (_, tid) in res]
+    assert cds_nums == sorted(cds_nums)  # in the order of the CDSs
+    assert set(res) == _find_cds_tfams_by_pairs(cdsbedlines, TFAMS)
+
+
+def _merge(blocks):
+    """Merge overlapping or touching blocks, as they would be in a valid BED line"""
+    merged = []
+    for (start, end) in sorted(blocks):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def test_find_cds_tfams_random():
+    rng = np.random.RandomState(0)
+
+    def random_blocks(maxlen):
+        starts = np.sort(rng.choice(5000, size=rng.randint(1, 5), replace=False))
+        return [(start, start + rng.randint(1, maxlen)) for start in starts]
+
+    for _ in xrange(20):
+        tfams = {'tfam%d' % i: _bed_line('tfam%d' % i, 'chr1', rng.choice(['+', '-']), _merge(random_blocks(800))) for i in xrange(15)}
+        cdsbedlines = [_bed_line('cds%d' % i, 'chr1', rng.choice(['+', '-']), _merge(random_blocks(200))) for i in xrange(40)]
+        res = find_cds_tfams(cdsbedlines, build_tfam_exon_index(tfams))
+        assert len(res) == len(set(res))
+        assert set(res) == _find_cds_tfams_by_pairs(cdsbedlines, tfams)
+
+
+def _cluster_bed_lines(bedlines):
+    """Families of the transcripts in a list of BED lines, as make_tfams.py finds them: exons are grouped by chromosome and strand, and each group
+    is clustered with cluster_exons(). Returns a list of (transcript IDs, chrom, strand, merged segments)."""
+    exons = defaultdict(list)
+    for (trans_idx, line) in enumerate(bedlines):
+        (chrom, strand, starts, ends) = bed_blocks(line)
+        exons[(chrom, strand)].extend((start, end, trans_idx) for (start, end) in zip(starts.tolist(), ends.tolist()))
+    return [([bedlines[trans_idx].split()[3] for trans_idx in fam_trans], chrom, strand, segs)
+            for (chrom, strand) in sorted(exons) for (fam_trans, segs) in cluster_exons(exons[(chrom, strand)])]
+
+
+def _cluster_by_pairs(bedlines):
+    """Families as connected components of transcripts sharing a position on the same chromosome and strand, comparing every pair of blocks"""
+    blocks = [bed_blocks(line) for line in bedlines]
+    fams = [{i} for i in xrange(len(bedlines))]
+    for (i, j) in itertools.combinations(xrange(len(bedlines)), 2):
+        ((chrom1, strand1, starts1, ends1), (chrom2, strand2, starts2, ends2)) = (blocks[i], blocks[j])
+        if (chrom1, strand1) == (chrom2, strand2) and \
+                any(start1 < end2 and start2 < end1 for (start1, end1) in zip(starts1, ends1) for (start2, end2) in zip(starts2, ends2)):
+            (fam_i, fam_j) = ([fam for fam in fams if i in fam][0], [fam for fam in fams if j in fam][0])
+            if fam_i is not fam_j:
+                fams.remove(fam_j)
+                fam_i |= fam_j
+    return {frozenset(bedlines[i].split()[3] for i in fam) for fam in fams}
+
+
+def test_cluster_exons():
+    bedlines = [_bed_line('overlap1', 'chr1', '+', [(100, 200)]),
+                _bed_line('abut1', 'chr1', '+', [(300, 400)]),
+                _bed_line('overlap2', 'chr1', '+', [(150, 250)]),
+                _bed_line('abut2', 'chr1', '+', [(400, 500)]),  # ends where abut1 begins: no shared position
+                _bed_line('minus', 'chr1', '-', [(100, 200)]),  # overlaps overlap1 and overlap2 on the other strand
+                _bed_line('spliced', 'chr1', '+', [(1000, 1100), (1300, 1400)]),
+                _bed_line('intronic', 'chr1', '+', [(1100, 1300)]),  # fills the intron of spliced, abutting both exons
+                _bed_line('long', 'chr1', '+', [(2000, 2500)]),
+                _bed_line('nested', 'chr1', '+', [(2100, 2200)]),
+                _bed_line('after_nested', 'chr1', '+', [(2200, 2300)]),  # abuts nested, but within long
+                _bed_line('after_long', 'chr1', '+', [(2500, 2600)]),  # abuts long, the end of the run
+                _bed_line('other_chrom', 'chr2', '+', [(100, 200)])]
+    assert _cluster_bed_lines(bedlines) == [(['overlap1', 'overlap2'], 'chr1', '+', [(100, 250)]),
+                                            (['abut1'], 'chr1', '+', [(300, 400)]),
+                                            (['abut2'], 'chr1', '+', [(400, 500)]),
+                                            (['spliced'], 'chr1', '+', [(1000, 1100), (1300, 1400)]),
+                                            (['intronic'], 'chr1', '+', [(1100, 1300)]),
+                                            (['long', 'nested', 'after_nested'], 'chr1', '+', [(2000, 2500)]),
+                                            (['after_long'], 'chr1', '+', [(2500, 2600)]),
+                                            (['minus'], 'chr1', '-', [(100, 200)]),
+                                            (['other_chrom'], 'chr2', '+', [(100, 200)])]
+
+
+def test_cluster_exons_random():
+    rng = np.random.RandomState(0)
+    for _ in xrange(20):
+        bedlines = []
+        for i in xrange(40):
+            starts = np.sort(rng.choice(np.arange(0, 5000, 50), size=rng.randint(1, 4), replace=False))  # on a coarse grid, so many abut
+            bedlines.append(_bed_line('t%d' % i, 'chr1', rng.choice(['+', '-']),
+                                      _merge([(start, start + 50 * rng.randint(1, 6)) for start in starts])))
+        tfams = _cluster_bed_lines(bedlines)
+        assert {frozenset(fam_tids) for (fam_tids, _, _, _) in tfams} == _cluster_by_pairs(bedlines)
+        for (fam_tids, _, strand, segs) in tfams:
+            fam_pos = {pos for line in bedlines if line.split()[3] in fam_tids
+                       for (_, _, starts, ends) in [bed_blocks(line)] for (start, end) in zip(starts, ends) for pos in xrange(start, end)}
+            assert {pos for (start, end) in segs for pos in xrange(start, end)} == fam_pos
+            assert all(end < next_start for ((_, end), (next_start, _)) in zip(segs[:-1], segs[1:]))  # merged, so never abutting
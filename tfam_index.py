@@ -0,0 +1,135 @@
+import itertools
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+
+
+def bed_blocks(line):
+    """Parse the chromosome, strand, and arrays of (block) starts and ends from a BED line, as split by its blocks if it has them"""
+    ls = line.split()
+    start = int(ls[1])
+    if len(ls) >= 12 and int(ls[9]) > 0:
+        starts = start + np.array([int(x) for x in ls[11].rstrip(',').split(',')], dtype=np.int64)
+        ends = starts + np.array([int(x) for x in ls[10].rstrip(',').split(',')], dtype=np.int64)
+    else:
+        (starts, ends) = (np.array([start], dtype=np.int64), np.array([int(ls[2])], dtype=np.int64))
+    return (ls[0], ls[5] if len(ls) >= 6 else '.', starts, ends)
+
+
+def build_tfam_exon_index(tfambedlines):
+    """Index the exons of all tfams by chromosome and strand, as arrays of starts (sorted), ends, running maximum of ends, and tfam names, for
+    use by find_cds_tfams()
+
+    Parameters
+    ----------
+    tfambedlines : dict
+        BED line of each tfam, keyed by tfam name
+
+    Returns
+    -------
+    dict
+        Tuple of arrays for the exons on each (chrom, strand)
+    """
+    tfam_exons = defaultdict(list)
+    for (tfam, line) in tfambedlines.iteritems():
+        (chrom, strand, starts, ends) = bed_blocks(line)
+        tfam_exons[(chrom, strand)].extend(zip(starts, ends, itertools.repeat(tfam)))
+    exon_index = {}
+    for (chrom_strand, cs_exons) in tfam_exons.iteritems():
+        cs_exons.sort()
+        (starts, ends, names) = zip(*cs_exons)
+        (starts, ends) = (np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64))
+        exon_index[chrom_strand] = (starts, ends, np.maximum.accumulate(ends), np.array(names, dtype=object))
+    return exon_index
+
+
+def find_cds_tfams(cdsbedlines, exon_index):
+    """Identify the tfams overlapping each of a list of CDS BED lines, requiring the same strand and counting only positions within the blocks of
+    each (as would `bedtools intersect -split -s`). Returns a list of (tfam, transcript ID) pairs.
+
+    Parameters
+    ----------
+    cdsbedlines : list
+        BED lines of the CDSs, with the transcript ID as the name
+
+    exon_index : dict
+        Exons of all tfams, from build_tfam_exon_index()
+
+    Returns
+    -------
+    list
+        (tfam, transcript ID) for every tfam overlapping each CDS, in the order of `cdsbedlines`
+    """
+    res = []
+    for line in cdsbedlines:
+        (chrom, strand, starts, ends) = bed_blocks(line)
+        if (chrom, strand) not in exon_index:
+            continue
+        (tfam_starts, tfam_ends, tfam_maxends, tfam_names) = exon_index[(chrom, strand)]
+        # exons that could overlap a block are those starting before its end, from the first whose running maximum end is past its start
+        lo = tfam_maxends.searchsorted(starts, side='right')
+        hi = tfam_starts.searchsorted(ends, side='left')
+        counts = np.maximum(hi - lo, 0)
+        cand = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - lo, counts)
+        cand = cand[tfam_ends[cand] > np.repeat(starts, counts)]
+        tid = line.split()[3]
+        res.extend((tfam, tid) for tfam in pd.unique(tfam_names[cand]))
+    return res
+
+
+def _find_root(parent, trans_idx):
+    """Representative transcript of the family containing trans_idx in the union-find forest parent, compressing the path to it along the way"""
+    root = trans_idx
+    while parent[root] != root:
+        root = parent[root]
+    while parent[trans_idx] != root:
+        (parent[trans_idx], trans_idx) = (root, parent[trans_idx])
+    return root
+
+
+def _merge_exons(fam_exons):
+    """Merge a family's exons (sorted by start) into the (start, end) of the segments covering every position in any of them"""
+    segs = []
+    for (start, end, _) in fam_exons:
+        if segs and start <= segs[-1][1]:
+            segs[-1][1] = max(segs[-1][1], end)
+        else:
+            segs.append([start, end])
+    return [tuple(seg) for seg in segs]
+
+
+def cluster_exons(cs_exons):
+    """Group the transcripts on one chromosome and strand into families of transcripts sharing at least one position, by sweeping across their
+    sorted exons: any exon beginning before the end of the current run of overlapping exons shares at least one position with an exon already in
+    the run, so its transcript is joined to that run's family by union-find. Exons that merely abut (one ending where the next begins) share no
+    position, and do not join families.
+
+    Parameters
+    ----------
+    cs_exons : list
+        (start, end, transcript index) of every exon on the chromosome and strand
+
+    Returns
+    -------
+    list
+        (transcript indices, merged (start, end) segments) of each family, ordered by the earliest (lowest-indexed) transcript in each
+    """
+    cs_exons = sorted(cs_exons)
+    parent = {trans_idx: trans_idx for (_, _, trans_idx) in cs_exons}  # each family is represented by its earliest transcript
+    run_end = None
+    for (start, end, trans_idx) in cs_exons:
+        if run_end is not None and start < run_end:
+            (root1, root2) = (_find_root(parent, trans_idx), _find_root(parent, run_trans))
+            parent[max(root1, root2)] = min(root1, root2)
+            run_end = max(run_end, end)
+        else:
+            run_end = end
+        run_trans = trans_idx
+
+    fam_exons = defaultdict(list)
+    for exon in cs_exons:
+        fam_exons[_find_root(parent, exon[2])].append(exon)
+    fam_trans = defaultdict(list)
+    for trans_idx in sorted(parent):
+        fam_trans[_find_root(parent, trans_idx)].append(trans_idx)
+    return [(fam_trans[root], _merge_exons(fam_exons[root])) for root in sorted(fam_exons)]